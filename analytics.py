@@ -0,0 +1,268 @@
+"""
+Sales analytics: top products, category revenue, hour-of-day heatmap and
+payment method mix over a date range.
+
+Reports read only aggregate tables, never orders/order_items:
+
+    daily_product_sales   (day, product_id) -> quantity, revenue
+    hourly_sales_summary  (day, hour)       -> order count, total
+    daily_sales_summary   (day, payment_method), maintained by services
+
+They are kept current inside the checkout and void transactions (see
+add_order_delta/apply_deltas) and can be recomputed with
+rebuild_rollups.py. Revenue is the line amount after discounts; only paid
+orders count. Results are cached per range for ANALYTICS_CACHE_TTL seconds.
+"""
+import datetime
+import os
+import threading
+import time
+from psycopg2.extras import execute_values
+from db import get_db_cursor
+
+CACHE_TTL = float(os.environ.get('ANALYTICS_CACHE_TTL', 60))
+CACHE_SIZE = 256
+DEFAULT_RANGE_DAYS = 30
+
+# --- INCREMENTAL MAINTENANCE ---
+
+def new_deltas():
+    return {'products': {}, 'hours': {}}
+
+def add_order_delta(deltas, order, lines, voided=False):
+    """
+    Accumulates the change caused by creating (or voiding) `order` into
+    `deltas`. `order` needs created_at and total_amount; each line needs
+    product_id, product_name, quantity and revenue.
+    """
+    sign = -1 if voided else 1
+    day = order['created_at'].date()
+
+    hour = deltas['hours'].setdefault((day, order['created_at'].hour), [0, 0])
+    hour[0] += sign
+    hour[1] += sign * order['total_amount']
+
+    for line in lines:
+        # Legacy lines without a product id are pooled under 0
+        key = (day, line['product_id'] or 0)
+        product = deltas['products'].setdefault(key, [line['product_name'], 0, 0])
+        product[1] += sign * line['quantity']
+        product[2] += sign * line['revenue']
+
+def apply_deltas(cur, deltas):
+    """Upserts accumulated deltas, one statement per table, rows in key order."""
+    if deltas['hours']:
+        execute_values(
+            cur,
+            """
+            INSERT INTO hourly_sales_summary (day, hour, order_count, total) VALUES %s
+            ON CONFLICT (day, hour) DO UPDATE SET
+                order_count = hourly_sales_summary.order_count + EXCLUDED.order_count,
+                total = hourly_sales_summary.total + EXCLUDED.total
+            """,
+            [key + tuple(delta) for key, delta in sorted(deltas['hours'].items())],
+            page_size=len(deltas['hours'])
+        )
+    if deltas['products']:
+        execute_values(
+            cur,
+            """
+            INSERT INTO daily_product_sales (day, product_id, product_name, quantity, revenue) VALUES %s
+            ON CONFLICT (day, product_id) DO UPDATE SET
+                product_name = CASE WHEN EXCLUDED.quantity > 0 THEN EXCLUDED.product_name
+                                    ELSE daily_product_sales.product_name END,
+                quantity = daily_product_sales.quantity + EXCLUDED.quantity,
+                revenue = daily_product_sales.revenue + EXCLUDED.revenue
+            """,
+            [key + tuple(delta) for key, delta in sorted(deltas['products'].items())],
+            page_size=len(deltas['products'])
+        )
+
+def load_order_lines(cur, order_ids):
+    """{order_id: [line]} in the form add_order_delta expects, for voiding."""
+    cur.execute(
+        """
+        SELECT order_id, product_id, product_name_snapshot AS product_name, quantity,
+               subtotal - discount_amount AS revenue
+        FROM order_items
+        WHERE order_id = ANY(%s)
+        """,
+        (list(order_ids),)
+    )
+    lines = {}
+    for row in cur.fetchall():
+        lines.setdefault(row['order_id'], []).append(row)
+    return lines
+
+def rebuild(cur, date_from=None, date_to=None):
+    """
+    Recomputes the analytics tables from orders for all days or for the
+    inclusive [date_from, date_to] range. Expects orders to be locked
+    against writers already (see services.rebuild_daily_sales_summary).
+    Returns {table: rows inserted}.
+    """
+    clauses, params = [], []
+    if date_from:
+        clauses.append("day >= %s")
+        params.append(date_from)
+    if date_to:
+        clauses.append("day <= %s")
+        params.append(date_to)
+    day_where = ("WHERE " + " AND ".join(clauses)) if clauses else ""
+    order_where = " ".join(
+        "AND " + c.replace("day", "o.created_at::date") for c in clauses
+    )
+
+    counts = {}
+    cur.execute(f"DELETE FROM hourly_sales_summary {day_where}", tuple(params))
+    cur.execute(
+        f"""
+        INSERT INTO hourly_sales_summary (day, hour, order_count, total)
+        SELECT o.created_at::date, EXTRACT(HOUR FROM o.created_at)::int, COUNT(*), SUM(o.total_amount)
+        FROM orders o
+        WHERE o.status = 'paid' {order_where}
+        GROUP BY 1, 2
+        """,
+        tuple(params)
+    )
+    counts['hourly_sales_summary'] = cur.rowcount
+
+    cur.execute(f"DELETE FROM daily_product_sales {day_where}", tuple(params))
+    cur.execute(
+        f"""
+        INSERT INTO daily_product_sales (day, product_id, product_name, quantity, revenue)
+        SELECT o.created_at::date, COALESCE(i.product_id, 0),
+               (array_agg(i.product_name_snapshot ORDER BY o.created_at DESC))[1],
+               SUM(i.quantity), SUM(i.subtotal - i.discount_amount)
+        FROM orders o
+        JOIN order_items i ON i.order_id = o.id
+        WHERE o.status = 'paid' {order_where}
+        GROUP BY 1, 2
+        """,
+        tuple(params)
+    )
+    counts['daily_product_sales'] = cur.rowcount
+
+    clear_cache()
+    return counts
+
+# --- REPORTS ---
+
+_cache = {}
+_cache_lock = threading.Lock()
+
+def clear_cache():
+    with _cache_lock:
+        _cache.clear()
+
+def _cached(key, compute):
+    now = time.monotonic()
+    with _cache_lock:
+        hit = _cache.get(key)
+        if hit and hit[0] > now:
+            return hit[1]
+
+    result = compute()
+    with _cache_lock:
+        if len(_cache) >= CACHE_SIZE:
+            # Drop the oldest entry; dicts keep insertion order
+            _cache.pop(next(iter(_cache)))
+        _cache[key] = (now + CACHE_TTL, result)
+    return result
+
+def default_range(date_from=None, date_to=None):
+    """Fills in a missing end with today and a missing start with DEFAULT_RANGE_DAYS before it."""
+    date_to = date_to or datetime.date.today()
+    date_from = date_from or date_to - datetime.timedelta(days=DEFAULT_RANGE_DAYS - 1)
+    if date_from > date_to:
+        raise ValueError("date_from must not be after date_to")
+    return date_from, date_to
+
+def _query(sql, params):
+    with get_db_cursor(readonly=True) as cur:
+        cur.execute(sql, params)
+        return cur.fetchall()
+
+def top_products(date_from=None, date_to=None, limit=10, order_by='revenue'):
+    """Best selling products by revenue or quantity: [{product_id, name, quantity, revenue}]."""
+    if order_by not in ('revenue', 'quantity'):
+        raise ValueError("order_by must be 'revenue' or 'quantity'")
+    date_from, date_to = default_range(date_from, date_to)
+
+    def compute():
+        rows = _query(
+            f"""
+            SELECT product_id, (array_agg(product_name ORDER BY day DESC))[1] AS name,
+                   SUM(quantity) AS quantity, SUM(revenue) AS revenue
+            FROM daily_product_sales
+            WHERE day BETWEEN %s AND %s
+            GROUP BY product_id
+            HAVING SUM(quantity) > 0
+            ORDER BY {order_by} DESC, product_id
+            LIMIT %s
+            """,
+            (date_from, date_to, limit)
+        )
+        return [dict(r, quantity=int(r['quantity']), revenue=int(r['revenue'])) for r in rows]
+
+    return _cached(('top_products', date_from, date_to, limit, order_by), compute)
+
+def category_revenue(date_from=None, date_to=None):
+    """Revenue per product category (as currently assigned): [{category, quantity, revenue}]."""
+    date_from, date_to = default_range(date_from, date_to)
+
+    def compute():
+        rows = _query(
+            """
+            SELECT COALESCE(p.category, 'Uncategorized') AS category,
+                   SUM(s.quantity) AS quantity, SUM(s.revenue) AS revenue
+            FROM daily_product_sales s
+            LEFT JOIN products p ON p.id = s.product_id
+            WHERE s.day BETWEEN %s AND %s
+            GROUP BY 1
+            ORDER BY revenue DESC, category
+            """,
+            (date_from, date_to)
+        )
+        return [dict(r, quantity=int(r['quantity']), revenue=int(r['revenue'])) for r in rows]
+
+    return _cached(('category_revenue', date_from, date_to), compute)
+
+def hourly_heatmap(date_from=None, date_to=None):
+    """Paid orders by ISO weekday (1 = Monday) and hour: [{weekday, hour, orders, total}]."""
+    date_from, date_to = default_range(date_from, date_to)
+
+    def compute():
+        rows = _query(
+            """
+            SELECT EXTRACT(ISODOW FROM day)::int AS weekday, hour,
+                   SUM(order_count) AS orders, SUM(total) AS total
+            FROM hourly_sales_summary
+            WHERE day BETWEEN %s AND %s
+            GROUP BY 1, 2
+            ORDER BY 1, 2
+            """,
+            (date_from, date_to)
+        )
+        return [dict(r, orders=int(r['orders']), total=int(r['total'])) for r in rows]
+
+    return _cached(('hourly_heatmap', date_from, date_to), compute)
+
+def payment_mix(date_from=None, date_to=None):
+    """Paid orders and totals per payment method: [{payment_method, orders, total}]."""
+    date_from, date_to = default_range(date_from, date_to)
+
+    def compute():
+        rows = _query(
+            """
+            SELECT payment_method, SUM(paid_count) AS orders, SUM(paid_total) AS total
+            FROM daily_sales_summary
+            WHERE day BETWEEN %s AND %s
+            GROUP BY 1
+            ORDER BY total DESC, payment_method
+            """,
+            (date_from, date_to)
+        )
+        return [dict(r, orders=int(r['orders']), total=int(r['total'])) for r in rows]
+
+    return _cached(('payment_mix', date_from, date_to), compute)
@@ -1,24 +1,60 @@
-import os
+import csv
+import datetime
+import io
+import logging
+import tempfile
 from flask import Flask, render_template, request, redirect, url_for, flash, send_from_directory, jsonify
-from werkzeug.utils import secure_filename
+from flask import Response, abort, g, session, stream_with_context
 from auth import auth_bp, login_required, admin_required
+import psycopg2.errors
+import db
 from db import get_db_cursor
 import services
-import openpyxl
-from io import BytesIO
+import analytics
+import audit
+import events
+import images
+import metrics
+import pricing
+import shifts
 from flask import send_file
 
 app = Flask(__name__)
+log = logging.getLogger('pos.app')
 app.config['SECRET_KEY'] = 'dev_secret_key' # Change in production
-app.config['UPLOAD_FOLDER'] = 'static/uploads'
 app.config['MAX_CONTENT_LENGTH'] = 16 * 1024 * 1024 # 16MB max
 
-# Ensure upload directory exists
-os.makedirs(app.config['UPLOAD_FOLDER'], exist_ok=True)
+# Request/query instrumentation and /metrics; registered before the auth
+# blueprint so the per-request identity lookup is measured too
+metrics.init_app(app)
+
+# Content-addressed product images and thumbnails under /media/
+images.init_app(app)
+
+# Live stock/price pushes to POS terminals (/api/events)
+events.init_app(app)
 
 # Register Auth Blueprint
 app.register_blueprint(auth_bp)
 
+# Read-your-writes with a replica: reads stay on the primary for a short
+# while after this user's last write (see db.read_target), in any worker
+@app.before_request
+def restore_last_write():
+    db.set_last_write(session.get('last_write'))
+
+@app.after_request
+def remember_last_write(response):
+    written = db.last_write()
+    if 'replica' in db.TARGETS and written is not None and written != session.get('last_write'):
+        session['last_write'] = written
+    return response
+
+@app.route('/healthz')
+def healthz():
+    """Readiness probe (see run_gui.py); answers without touching the database."""
+    return 'ok'
+
 @app.route('/')
 def index():
     return redirect(url_for('auth.login'))
@@ -31,26 +67,12 @@ def admin_dashboard():
     stats = services.get_dashboard_stats()
 
     # Get Chart Data (Last 7 days sales)
-    # Simple query for chart
     chart_labels = []
     chart_data = []
 
-    with get_db_cursor() as cur:
-        cur.execute("""
-            SELECT DATE(created_at) as date, SUM(total_amount) as total
-            FROM orders
-            WHERE status = 'paid'
-            GROUP BY DATE(created_at)
-            ORDER BY date DESC
-            LIMIT 7
-        """)
-        results = cur.fetchall()
-
-        # Sort back to ascending for chart
-        results.reverse()
-        for row in results:
-            chart_labels.append(row['date'].strftime('%Y-%m-%d'))
-            chart_data.append(int(row['total']))
+    for row in services.get_sales_chart(days=7):
+        chart_labels.append(row['date'].strftime('%Y-%m-%d'))
+        chart_data.append(int(row['total']))
 
     return render_template('admin/dashboard.html', stats=stats, chart_labels=chart_labels, chart_data=chart_data)
 
@@ -63,24 +85,37 @@ def admin_products():
         category = request.form['category']
         is_managed = 'is_inventory_managed' in request.form
         stock = request.form['stock'] if is_managed else 0
+        barcode = request.form.get('barcode', '').strip() or None
 
         image = request.files.get('image')
         image_url = 'https://placehold.co/400x300?text=No+Image' # Default
 
         if image and image.filename:
-            filename = secure_filename(image.filename)
-            filepath = os.path.join(app.config['UPLOAD_FOLDER'], filename)
-            image.save(filepath)
-            image_url = f"/static/uploads/{filename}"
-
-        with get_db_cursor(commit=True) as cur:
-            cur.execute(
-                """
-                INSERT INTO products (name, price, category, image_url, is_inventory_managed, stock)
-                VALUES (%s, %s, %s, %s, %s, %s)
-                """,
-                (name, price, category, image_url, is_managed, stock)
-            )
+            try:
+                image_url = images.store_upload(image)
+            except ValueError as e:
+                flash(str(e))
+                return redirect(url_for('admin_products'))
+
+        try:
+            with get_db_cursor(commit=True) as cur:
+                cur.execute(
+                    """
+                    INSERT INTO products (name, price, category, image_url, is_inventory_managed, stock, barcode)
+                    VALUES (%s, %s, %s, %s, %s, %s, %s)
+                    RETURNING id
+                    """,
+                    (name, price, category, image_url, is_managed, stock, barcode)
+                )
+                product_id = cur.fetchone()['id']
+                services.bump_catalog_version(cur, [product_id])
+        except psycopg2.errors.UniqueViolation:
+            flash(f'Barcode {barcode} is already used by another product.')
+            return redirect(url_for('admin_products'))
+        audit.record('product.created', product_id, {
+            'name': name, 'price': price, 'category': category, 'image_url': image_url,
+            'is_inventory_managed': is_managed, 'stock': stock, 'barcode': barcode,
+        })
         flash('Product created successfully.')
         return redirect(url_for('admin_products'))
 
@@ -91,17 +126,96 @@ def admin_products():
 @admin_required
 def delete_product(id):
     with get_db_cursor(commit=True) as cur:
-        cur.execute("DELETE FROM products WHERE id = %s", (id,))
+        cur.execute("DELETE FROM products WHERE id = %s RETURNING name, price", (id,))
+        deleted = cur.fetchone()
+        if deleted:
+            services.bump_catalog_version(cur, deleted_ids=[id])
+    if deleted:
+        audit.record('product.deleted', id, {'name': deleted['name'], 'price': deleted['price']})
     flash('Product deleted.')
     return redirect(url_for('admin_products'))
 
+@app.route('/admin/products/import', methods=('POST',))
+@admin_required
+def import_products():
+    upload = request.files.get('file')
+    if not upload or not upload.filename:
+        flash('Choose an .xlsx or .csv file to import.')
+        return redirect(url_for('admin_products'))
+
+    try:
+        rows = services.parse_product_rows(upload.filename, upload.stream)
+        result = services.import_products(rows)
+        audit.record('product.imported', payload=dict(result, filename=upload.filename, rows=len(rows)))
+        flash(f"Imported {len(rows)} rows: {result['created']} created, {result['updated']} updated.")
+    except ValueError as e:
+        flash(f'Import failed: {str(e)}')
+    return redirect(url_for('admin_products'))
+
+def parse_date_arg(args, key):
+    value = args.get(key)
+    if not value:
+        return None
+    try:
+        return datetime.date.fromisoformat(value)
+    except ValueError:
+        abort(400, f"Invalid {key}: expected YYYY-MM-DD")
+
+def parse_sales_filters(args):
+    status = args.get('status') or None
+    if status not in (None, 'paid', 'void'):
+        abort(400, "Invalid status")
+    return {
+        'date_from': parse_date_arg(args, 'date_from'),
+        'date_to': parse_date_arg(args, 'date_to'),
+        'status': status,
+        'payment_method': args.get('payment_method') or None,
+        'code_prefix': args.get('code_prefix') or None,
+    }
+
+SALES_PAGE_SIZE = 50
+
+def get_sales_page(args):
+    filters = parse_sales_filters(args)
+    try:
+        limit = min(max(int(args.get('limit', SALES_PAGE_SIZE)), 1), 200)
+        return services.list_orders(filters, cursor=args.get('cursor'), limit=limit)
+    except ValueError as e:
+        abort(400, str(e))
+
 @app.route('/admin/sales')
 @admin_required
 def admin_sales():
-    with get_db_cursor() as cur:
-        cur.execute("SELECT * FROM orders ORDER BY created_at DESC")
-        orders = cur.fetchall()
-    return render_template('admin/sales.html', orders=orders)
+    page = get_sales_page(request.args)
+    export_args = {k: v for k, v in request.args.items() if k != 'cursor' and v}
+    return render_template(
+        'admin/sales.html',
+        orders=page['orders'],
+        next_cursor=page['next_cursor'],
+        filters=request.args,
+        export_args=export_args
+    )
+
+@app.route('/admin/sales/data')
+@admin_required
+def admin_sales_data():
+    page = get_sales_page(request.args)
+    return jsonify({
+        'orders': [
+            {
+                'id': o['id'],
+                'transaction_code': o['transaction_code'],
+                'created_at': o['created_at'].isoformat(),
+                'total_amount': int(o['total_amount']),
+                'tax_amount': int(o['tax_amount']),
+                'discount_amount': int(o['discount_amount']),
+                'payment_method': o['payment_method'],
+                'status': o['status'],
+            }
+            for o in page['orders']
+        ],
+        'next_cursor': page['next_cursor']
+    })
 
 @app.route('/admin/sales/void/<int:id>', methods=('POST',))
 @admin_required
@@ -113,32 +227,141 @@ def void_transaction(id):
         flash(f'Error: {str(e)}')
     return redirect(url_for('admin_sales'))
 
-@app.route('/admin/sales/export')
+@app.route('/admin/sales/void', methods=('POST',))
 @admin_required
-def export_sales():
-    with get_db_cursor() as cur:
-        cur.execute("SELECT * FROM orders ORDER BY created_at DESC")
-        orders = cur.fetchall()
+def bulk_void_transactions():
+    """
+    Voids many orders in one transaction. JSON body: {"order_ids": [...]}
+    or {"filters": {"date_from": ..., "date_to": ..., "payment_method": ...,
+    "code_prefix": ...}}.
+    """
+    data = request.get_json(silent=True) or {}
+    try:
+        if 'order_ids' in data:
+            if not isinstance(data['order_ids'], list):
+                return jsonify({'error': 'order_ids must be a list'}), 400
+            result = services.void_orders(order_ids=data['order_ids'])
+        else:
+            filters = parse_sales_filters(data.get('filters') or {})
+            result = services.void_orders(filters=filters)
+    except (TypeError, ValueError) as e:
+        return jsonify({'error': str(e)}), 400
+    return jsonify({'status': 'success', 'data': result})
+
+AUDIT_PAGE_LIMIT = 500
 
-    wb = openpyxl.Workbook()
-    ws = wb.active
-    ws.title = "Sales Report"
+@app.route('/admin/audit')
+@admin_required
+def admin_audit():
+    """
+    Audit records as JSON, newest first. Filters: event (a trailing '.'
+    matches a prefix, e.g. order.), user_id, entity_id, date_from, date_to;
+    page with before_id=<next_before_id of the previous page>.
+    """
+    try:
+        result = audit.query(
+            event=request.args.get('event') or None,
+            user_id=request.args.get('user_id', type=int),
+            entity_id=request.args.get('entity_id', type=int),
+            date_from=parse_date_arg(request.args, 'date_from'),
+            date_to=parse_date_arg(request.args, 'date_to'),
+            before_id=request.args.get('before_id', type=int),
+            limit=min(max(request.args.get('limit', 100, type=int), 1), AUDIT_PAGE_LIMIT),
+        )
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    return jsonify(result)
 
-    headers = ['ID', 'Transaction Code', 'Date', 'Total', 'Tax', 'Payment', 'Status']
+@app.route('/admin/shifts')
+@admin_required
+def admin_shifts():
+    """Shifts opened on ?date= (default today) with their net totals, as JSON."""
+    day = parse_date_arg(request.args, 'date') or datetime.date.today()
+    rows = shifts.list_shifts(day)
+    return jsonify({
+        'date': day.isoformat(),
+        'shifts': [
+            {
+                'id': r['id'],
+                'cashier_id': r['cashier_id'],
+                'cashier': r['cashier'],
+                'opened_at': r['opened_at'].isoformat(),
+                'closed_at': r['closed_at'].isoformat() if r['closed_at'] else None,
+                'order_count': int(r['paid_count']),
+                'net': int(r['paid_total']),
+                'void_count': int(r['void_count']),
+            }
+            for r in rows
+        ]
+    })
+
+SALES_EXPORT_HEADERS = ['ID', 'Transaction Code', 'Date', 'Total', 'Tax', 'Discount', 'Payment', 'Status']
+SALES_EXPORT_ITEM_HEADERS = ['Product', 'Price', 'Qty', 'Subtotal']
+
+def sales_export_row(o, include_items):
+    row = [
+        o['id'],
+        o['transaction_code'],
+        o['created_at'],
+        o['total_amount'],
+        o['tax_amount'],
+        o['discount_amount'],
+        o['payment_method'],
+        o['status']
+    ]
+    if include_items:
+        row += [o['product_name_snapshot'], o['price_snapshot'], o['quantity'], o['subtotal']]
+    return row
+
+@app.route('/admin/sales/export')
+@admin_required
+def export_sales():
+    """
+    Exports orders as XLSX (default) or CSV (?format=csv).
+
+    Rows are streamed from a server-side cursor. CSV is written to the
+    response as it is read; XLSX goes through openpyxl's write-only mode into
+    a temporary file, so neither path holds the whole table in memory.
+    Accepts date_from/date_to/status filters and items=1 for line items.
+    """
+    filters = parse_sales_filters(request.args)
+    include_items = request.args.get('items') == '1'
+    export_format = request.args.get('format', 'xlsx')
+    if export_format not in ('xlsx', 'csv'):
+        abort(400, "Invalid format")
+
+    headers = SALES_EXPORT_HEADERS + (SALES_EXPORT_ITEM_HEADERS if include_items else [])
+    rows = services.iter_sales_export(filters, include_items=include_items)
+
+    if export_format == 'csv':
+        def generate():
+            buf = io.StringIO()
+            writer = csv.writer(buf)
+            writer.writerow(headers)
+            for i, o in enumerate(rows, 1):
+                writer.writerow(sales_export_row(o, include_items))
+                if i % 500 == 0:
+                    yield buf.getvalue()
+                    buf.seek(0)
+                    buf.truncate()
+            yield buf.getvalue()
+
+        return Response(
+            stream_with_context(generate()),
+            mimetype='text/csv',
+            headers={'Content-Disposition': 'attachment; filename=sales_report.csv'}
+        )
+
+    import openpyxl  # only needed for exports
+
+    wb = openpyxl.Workbook(write_only=True)
+    ws = wb.create_sheet("Sales Report")
     ws.append(headers)
 
-    for o in orders:
-        ws.append([
-            o['id'],
-            o['transaction_code'],
-            o['created_at'],
-            o['total_amount'],
-            o['tax_amount'],
-            o['payment_method'],
-            o['status']
-        ])
-
-    out = BytesIO()
+    for o in rows:
+        ws.append(sales_export_row(o, include_items))
+
+    out = tempfile.TemporaryFile()
     wb.save(out)
     out.seek(0)
 
@@ -149,6 +372,37 @@ def export_sales():
         as_attachment=True
     )
 
+# --- ANALYTICS ---
+
+@app.route('/admin/analytics/<report>')
+@admin_required
+def admin_analytics(report):
+    """
+    Sales breakdowns as JSON, read from the analytics aggregates:
+    top-products (?limit=10&by=revenue|quantity), categories, hourly
+    (weekday x hour) and payments. All take date_from/date_to, defaulting
+    to the last 30 days.
+    """
+    try:
+        date_from, date_to = analytics.default_range(
+            parse_date_arg(request.args, 'date_from'), parse_date_arg(request.args, 'date_to')
+        )
+        if report == 'top-products':
+            limit = min(max(int(request.args.get('limit', 10)), 1), 100)
+            rows = analytics.top_products(date_from, date_to, limit, request.args.get('by', 'revenue'))
+        elif report == 'categories':
+            rows = analytics.category_revenue(date_from, date_to)
+        elif report == 'hourly':
+            rows = analytics.hourly_heatmap(date_from, date_to)
+        elif report == 'payments':
+            rows = analytics.payment_mix(date_from, date_to)
+        else:
+            abort(404)
+    except ValueError as e:
+        abort(400, str(e))
+
+    return jsonify({'date_from': date_from.isoformat(), 'date_to': date_to.isoformat(), 'rows': rows})
+
 # --- POS ROUTES ---
 
 @app.route('/pos')
@@ -156,11 +410,97 @@ def export_sales():
 def pos_index():
     return render_template('pos/index.html')
 
+@app.route('/pos/shifts/<int:shift_id>/report')
+@login_required
+def shift_report(shift_id):
+    """Printable Z-report; cashiers can only see their own shifts."""
+    report = shifts.get_report(shift_id)
+    if report is None or (g.user['role'] != 'admin' and report['cashier_id'] != g.user['id']):
+        abort(404)
+    if request.args.get('format') == 'json':
+        return jsonify(report)
+    return render_template('pos/z_report.html', report=report)
+
+@app.route('/api/shift')
+@login_required
+def api_current_shift():
+    """The logged-in cashier's open shift with its running totals, or null."""
+    return jsonify({'shift': shifts.current_shift(g.user['id'])})
+
+@app.route('/api/shift/open', methods=('POST',))
+@login_required
+def api_open_shift():
+    data = request.get_json(silent=True) or {}
+    try:
+        shift = shifts.open_shift(g.user['id'], data.get('opening_float'))
+    except (TypeError, ValueError) as e:
+        message = str(e) if isinstance(e, ValueError) else 'Invalid opening_float'
+        return jsonify({'error': message}), 400
+    audit.record('shift.opened', shift['shift_id'], {'opening_float': shift['opening_float']})
+    return jsonify({'status': 'success', 'data': shift})
+
+@app.route('/api/shift/close', methods=('POST',))
+@login_required
+def api_close_shift():
+    """Closes the cashier's shift. JSON body: {"counted_cash": n} (optional). Returns the Z-report."""
+    data = request.get_json(silent=True) or {}
+    try:
+        report = shifts.close_shift(g.user['id'], data.get('counted_cash'))
+    except (TypeError, ValueError) as e:
+        message = str(e) if isinstance(e, ValueError) else 'Invalid counted_cash'
+        return jsonify({'error': message}), 400
+    audit.record('shift.closed', report['shift_id'], {
+        'net': report['net'], 'order_count': report['order_count'], 'cash_variance': report['cash_variance'],
+    })
+    return jsonify({'status': 'success', 'data': report})
+
 @app.route('/api/products')
 @login_required
 def api_products():
-    products = services.get_products()
-    return jsonify(products)
+    """
+    Full catalog as a JSON list, revalidated with ETag/If-None-Match against
+    the catalog version. With ?since=<version> returns only the products
+    changed and ids removed after that version.
+    """
+    since = request.args.get('since', type=int)
+    if since is not None:
+        return jsonify(services.get_catalog_changes(since))
+
+    version = services.get_catalog_version()
+    etag = f"catalog-{version}"
+    if request.if_none_match.contains(etag):
+        response = Response(status=304)
+    else:
+        version, products = services.get_catalog(version)
+        etag = f"catalog-{version}"
+        response = jsonify(products)
+
+    response.set_etag(etag)
+    response.headers['Cache-Control'] = 'no-cache'
+    response.headers['X-Catalog-Version'] = str(version)
+    return response
+
+@app.route('/api/products/search')
+@login_required
+def api_product_search():
+    """
+    Ranked product search: ?q= matches barcodes, name prefixes and (from
+    three characters) fuzzy names. Optional category, limit (max 100),
+    offset (pass the returned next_offset) and fields=id,name,... to
+    return only those columns.
+    """
+    fields = request.args.get('fields')
+    try:
+        result = services.search_products(
+            request.args.get('q', ''),
+            category=request.args.get('category') or None,
+            fields=[f.strip() for f in fields.split(',') if f.strip()] if fields else None,
+            limit=request.args.get('limit', 20, type=int),
+            offset=request.args.get('offset', 0, type=int),
+        )
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    return jsonify(result)
 
 @app.route('/api/order', methods=('POST',))
 @login_required
@@ -173,7 +513,13 @@ def api_create_order():
         if not items:
             return jsonify({'error': 'Cart is empty'}), 400
 
-        result = services.create_order(items, payment_method)
+        idempotency_key = data.get('idempotency_key')
+        if idempotency_key is not None and not (isinstance(idempotency_key, str) and 0 < len(idempotency_key) <= 64):
+            return jsonify({'error': 'Invalid idempotency_key'}), 400
+
+        result = services.create_order(items, payment_method, idempotency_key, data.get('discount'),
+                                       cashier_id=g.user['id'],
+                                       max_discount_percent=pricing.discount_limit(g.user['role']))
         return jsonify({'status': 'success', 'data': result})
 
     except ValueError as e:
@@ -182,5 +528,50 @@ def api_create_order():
         print(f"Order Error: {e}")
         return jsonify({'error': 'Internal Server Error'}), 500
 
+@app.route('/api/price', methods=('POST',))
+@login_required
+def api_price():
+    """
+    Prices a cart without placing the order, for the POS summary. Takes the
+    same items/discount as /api/order; cheap enough to call on every change.
+    """
+    data = request.get_json(silent=True) or {}
+    try:
+        return jsonify(services.quote_order(data.get('items') or [], data.get('discount'),
+                                            pricing.discount_limit(g.user['role'])))
+    except (ValueError, KeyError, TypeError) as e:
+        message = str(e) if isinstance(e, ValueError) else 'Malformed cart'
+        return jsonify({'error': message}), 400
+
+ORDER_BATCH_LIMIT = 100
+
+@app.route('/api/orders/batch', methods=('POST',))
+@login_required
+def api_create_orders_batch():
+    """
+    Commits orders queued by an offline terminal. JSON body:
+    {"orders": [{"idempotency_key": ..., "items": [...], "payment_method": ...}]}.
+    Each order gets its own result, so one rejected order does not fail the
+    batch; resending a batch is safe.
+    """
+    data = request.get_json(silent=True) or {}
+    orders = data.get('orders')
+    if not isinstance(orders, list) or not orders:
+        return jsonify({'error': 'No orders'}), 400
+    if len(orders) > ORDER_BATCH_LIMIT:
+        return jsonify({'error': f'At most {ORDER_BATCH_LIMIT} orders per batch'}), 400
+    for order in orders:
+        key = order.get('idempotency_key') if isinstance(order, dict) else None
+        if not (isinstance(key, str) and 0 < len(key) <= 64):
+            return jsonify({'error': 'Every order needs an idempotency_key'}), 400
+
+    try:
+        results = services.create_orders_batch(orders, cashier_id=g.user['id'],
+                                               max_discount_percent=pricing.discount_limit(g.user['role']))
+        return jsonify({'status': 'success', 'results': results})
+    except Exception:
+        log.exception("Order batch failed")
+        return jsonify({'error': 'Internal Server Error'}), 500
+
 if __name__ == '__main__':
     app.run(debug=True, port=5000)
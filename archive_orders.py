@@ -0,0 +1,167 @@
+import argparse
+import datetime
+import gzip
+import os
+import psycopg2
+import psycopg2.extensions
+from psycopg2.extras import RealDictCursor
+from db import get_db_connection
+
+# Archives whole months of orders: each orders_pYYYYMM / order_items_pYYYYMM
+# partition pair older than the cutoff is exported to gzipped CSV, then
+# detached and dropped (or, with --keep, detached and left as plain tables).
+# Dashboard and analytics rollups are kept, so reports still cover archived
+# months; rebuild_rollups.py never rebuilds days before the oldest order.
+#
+# Nothing here holds a lock that voids or checkouts wait on for longer than
+# a catalog update: the export is a plain read in its own transaction, and
+# the partitions are detached with DETACH PARTITION ... CONCURRENTLY (which
+# cannot run inside a transaction block, hence the autocommit connection).
+# A month interrupted half-way is picked up where it stopped on the next run.
+
+# For the DDL that briefly locks the parent tables (dropping the lines' foreign
+# key to orders): give up rather than queue checkouts behind a long query
+LOCK_TIMEOUT = os.environ.get('ARCHIVE_LOCK_TIMEOUT', '5s')
+
+def list_partitions(cur, before_month):
+    """Months (YYYYMM) that have an orders partition and start before `before_month`."""
+    cur.execute(
+        """
+        SELECT substr(c.relname, length('orders_p') + 1) AS month
+        FROM pg_inherits i
+        JOIN pg_class c ON c.oid = i.inhrelid
+        WHERE i.inhparent = 'orders'::regclass AND c.relname ~ '^orders_p[0-9]{6}$'
+        ORDER BY 1
+        """
+    )
+    cutoff = before_month.strftime('%Y%m')
+    return [r['month'] for r in cur.fetchall() if r['month'] < cutoff]
+
+def partition_state(cur, table):
+    """'attached', 'pending' (an interrupted concurrent detach) or None if not a partition."""
+    cur.execute(
+        "SELECT inhdetachpending FROM pg_inherits WHERE inhrelid = to_regclass(%s)",
+        (table,)
+    )
+    row = cur.fetchone()
+    if row is None:
+        return None
+    return 'pending' if row['inhdetachpending'] else 'attached'
+
+def detach(cur, parent, table, state):
+    if state == 'pending':
+        cur.execute(f"ALTER TABLE {parent} DETACH PARTITION {table} FINALIZE")
+    elif state == 'attached':
+        cur.execute(f"ALTER TABLE {parent} DETACH PARTITION {table} CONCURRENTLY")
+
+def export_table(cur, table, path):
+    with gzip.open(path, 'wt', encoding='utf-8', newline='') as f:
+        cur.copy_expert(f"COPY {table} TO STDOUT WITH (FORMAT csv, HEADER)", f)
+
+def count_voids(cur, table):
+    cur.execute(f"SELECT COUNT(*) AS n FROM {table} WHERE status = 'void'")
+    return cur.fetchone()['n']
+
+def archive_month(conn, month, directory, keep=False):
+    """
+    Exports, detaches and (unless `keep`) drops one month's partitions
+    using `conn`, which must be in autocommit mode. Returns the file paths.
+    """
+    orders_table = f"orders_p{month}"
+    items_table = f"order_items_p{month}"
+    orders_path = os.path.join(directory, f"{orders_table}.csv.gz")
+    items_path = os.path.join(directory, f"{items_table}.csv.gz")
+
+    with conn.cursor() as cur:
+        items_state = partition_state(cur, items_table)
+        orders_state = partition_state(cur, orders_table)
+
+        # 1. Export from one snapshot. Lines never change once written; the
+        # only change to an order is a void, checked for after the detach
+        cur.execute("BEGIN ISOLATION LEVEL REPEATABLE READ READ ONLY")
+        if items_state is not None:
+            # Otherwise an earlier run already exported and detached them
+            export_table(cur, items_table, items_path)
+        export_table(cur, orders_table, orders_path)
+        exported_voids = count_voids(cur, orders_table)
+        cur.execute("COMMIT")
+
+        # 2. Lines first: while they are attached, the orders partition is still referenced
+        detach(cur, 'order_items', items_table, items_state)
+        cur.execute("SET lock_timeout = %s", (LOCK_TIMEOUT,))
+        if keep:
+            cur.execute(
+                """
+                SELECT conname FROM pg_constraint
+                WHERE conrelid = to_regclass(%s) AND confrelid = 'orders'::regclass
+                """,
+                (items_table,)
+            )
+            for row in cur.fetchall():
+                cur.execute(f'ALTER TABLE {items_table} DROP CONSTRAINT "{row["conname"]}"')
+        else:
+            cur.execute(f"DROP TABLE IF EXISTS {items_table}")
+        cur.execute("RESET lock_timeout")
+
+        # 3. Once detached no void can reach the orders; re-export if one did meanwhile
+        detach(cur, 'orders', orders_table, orders_state)
+        if count_voids(cur, orders_table) != exported_voids:
+            export_table(cur, orders_table, orders_path)
+        if not keep:
+            cur.execute(f"DROP TABLE {orders_table}")
+
+        start = datetime.datetime.strptime(month, '%Y%m')
+        end = (start + datetime.timedelta(days=32)).replace(day=1)
+        cur.execute(
+            "DELETE FROM order_idempotency_keys WHERE order_created_at >= %s AND order_created_at < %s",
+            (start, end)
+        )
+    return [orders_path, items_path]
+
+def archive_orders(before_month, directory, keep=False):
+    if before_month > datetime.date.today().replace(day=1):
+        print("Refusing to archive the current month or later.")
+        return
+    print(f"Archiving orders before {before_month.strftime('%Y-%m')}...")
+    os.makedirs(directory, exist_ok=True)
+
+    conn = None
+    try:
+        # A dedicated connection rather than the pool: DETACH ... CONCURRENTLY
+        # needs autocommit
+        conn = get_db_connection()
+        conn.set_isolation_level(psycopg2.extensions.ISOLATION_LEVEL_AUTOCOMMIT)
+        conn.cursor_factory = RealDictCursor
+        with conn.cursor() as cur:
+            months = list_partitions(cur, before_month)
+        if not months:
+            print("Nothing to archive.")
+            return
+
+        # Month by month, so a failure leaves earlier months archived
+        for month in months:
+            paths = archive_month(conn, month, directory, keep)
+            print(f"{month}: {', '.join(paths)}{' (tables kept)' if keep else ''}")
+        print("Archive complete.")
+
+    except psycopg2.OperationalError as e:
+        print(f"Error connecting to database: {e}")
+        print("Ensure PostgreSQL is running and credentials in db.py are correct.")
+    except Exception as e:
+        print(f"An error occurred: {e}")
+    finally:
+        if conn is not None:
+            conn.close()
+
+def parse_month(value):
+    return datetime.datetime.strptime(value, '%Y-%m').date()
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Export and detach monthly order partitions.")
+    parser.add_argument('--before', type=parse_month, required=True,
+                        help="archive every month before this one (YYYY-MM)")
+    parser.add_argument('--dir', default='archive', help="directory for the .csv.gz files (default: archive)")
+    parser.add_argument('--keep', action='store_true',
+                        help="keep the detached partitions as standalone tables instead of dropping them")
+    args = parser.parse_args()
+    archive_orders(args.before, args.dir, args.keep)
@@ -0,0 +1,238 @@
+"""
+Append-only audit log: who created and voided which orders, changed which
+products, and logged in when.
+
+record() only appends to an in-process queue, so auditing adds no database
+round trip to the request. A background thread drains the queue and writes
+it to audit_log with one COPY per batch (up to BATCH_SIZE rows, or whatever
+arrived within FLUSH_SECONDS of the first).
+
+Memory is bounded by AUDIT_QUEUE_SIZE. When the queue is full (e.g. the
+database has been unreachable for a while) new records are dropped and
+counted, or with AUDIT_OVERFLOW=block the caller waits up to
+AUDIT_BLOCK_MS for room first. Each run of drops is itself logged as an
+'audit.dropped' record once writing resumes, so gaps are visible in the log.
+
+Connection trouble is retried with backoff. A batch the database refuses
+as bad data is split until the offending records are isolated; those are
+logged and counted as rejected rather than retried forever.
+"""
+import atexit
+import csv
+import datetime
+import io
+import json
+import logging
+import os
+import queue
+import threading
+import time
+import psycopg2
+from flask import g, has_request_context, request
+from db import get_db_cursor
+
+QUEUE_SIZE = int(os.environ.get('AUDIT_QUEUE_SIZE', 10000))
+OVERFLOW = os.environ.get('AUDIT_OVERFLOW', 'drop')
+BLOCK_SECONDS = float(os.environ.get('AUDIT_BLOCK_MS', 50)) / 1000.0
+BATCH_SIZE = 500
+FLUSH_SECONDS = 0.5
+MAX_RETRY_SECONDS = 30
+
+COLUMNS = ('occurred_at', 'event', 'entity_id', 'user_id', 'username', 'remote_addr', 'payload')
+COUNTERS = ('written', 'dropped', 'rejected', 'failed_flushes')
+
+log = logging.getLogger('pos.audit')
+
+_queue = queue.Queue(QUEUE_SIZE)
+_stats = dict.fromkeys(COUNTERS, 0)
+_unreported_drops = 0
+_stats_lock = threading.Lock()
+
+
+def record(event, entity_id=None, payload=None, user=None):
+    """
+    Queues an audit record. `user` defaults to the logged-in user of the
+    current request; `payload` is any JSON-serializable dict (Decimals and
+    dates are written as strings, NUL characters are removed and payloads
+    with NaN or infinities are replaced by a marker, since jsonb refuses
+    them). Never blocks unless AUDIT_OVERFLOW=block.
+    """
+    global _unreported_drops
+    remote_addr = None
+    if has_request_context():
+        if user is None:
+            user = g.get('user')
+        remote_addr = request.remote_addr
+    if payload is not None:
+        try:
+            payload = json.dumps(_strip_nul(payload), default=str, allow_nan=False)
+        except ValueError:
+            payload = json.dumps({'unserializable': True})
+    row = (
+        datetime.datetime.now(), event, entity_id,
+        user['id'] if user else None, user['username'] if user else None,
+        remote_addr, payload,
+    )
+
+    ensure_writer()
+    try:
+        if OVERFLOW == 'block':
+            _queue.put(row, timeout=BLOCK_SECONDS)
+        else:
+            _queue.put_nowait(row)
+    except queue.Full:
+        with _stats_lock:
+            _stats['dropped'] += 1
+            _unreported_drops += 1
+
+def _strip_nul(value):
+    if isinstance(value, str):
+        return value.replace('\x00', '')
+    if isinstance(value, dict):
+        return {_strip_nul(str(k)): _strip_nul(v) for k, v in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [_strip_nul(v) for v in value]
+    return value
+
+def stats():
+    with _stats_lock:
+        return dict(_stats, queued=_queue.qsize())
+
+def write_batch(rows):
+    """Writes rows (tuples in COLUMNS order) with a single COPY."""
+    buf = io.StringIO()
+    csv.writer(buf).writerows(rows)
+    buf.seek(0)
+    with get_db_cursor(commit=True) as cur:
+        cur.copy_expert(f"COPY audit_log ({', '.join(COLUMNS)}) FROM STDIN WITH (FORMAT csv)", buf)
+
+def _next_batch():
+    """Blocks for the first record, then collects more for up to FLUSH_SECONDS."""
+    batch = [_queue.get()]
+    deadline = time.monotonic() + FLUSH_SECONDS
+    while len(batch) < BATCH_SIZE:
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            break
+        try:
+            batch.append(_queue.get(timeout=remaining))
+        except queue.Empty:
+            break
+    return batch
+
+def _take_drop_marker():
+    global _unreported_drops
+    with _stats_lock:
+        dropped, _unreported_drops = _unreported_drops, 0
+    if not dropped:
+        return []
+    return [(datetime.datetime.now(), 'audit.dropped', None, None, None, None, json.dumps({'count': dropped}))]
+
+def _write(rows):
+    """
+    Writes rows, retrying connection trouble until it succeeds (the queue
+    bounds memory meanwhile). Chunks refused as bad data are halved until
+    the bad records are isolated and rejected.
+    """
+    pending = [rows]
+    delay = 1
+    while pending:
+        chunk = pending.pop()
+        try:
+            write_batch(chunk)
+        except psycopg2.DataError as e:
+            # Retrying the same data cannot succeed
+            if len(chunk) == 1:
+                with _stats_lock:
+                    _stats['rejected'] += 1
+                log.error("Audit record rejected by the database, dropped: %r: %s", chunk[0], e)
+            else:
+                middle = len(chunk) // 2
+                pending += [chunk[middle:], chunk[:middle]]
+            continue
+        except Exception as e:
+            pending.append(chunk)
+            with _stats_lock:
+                _stats['failed_flushes'] += 1
+            log.warning("Audit flush of %d records failed, retrying in %ds: %s", len(chunk), delay, e)
+            time.sleep(delay)
+            delay = min(delay * 2, MAX_RETRY_SECONDS)
+            continue
+        with _stats_lock:
+            _stats['written'] += len(chunk)
+        delay = 1
+
+def _run():
+    while True:
+        batch = _next_batch()
+        _write(_take_drop_marker() + batch)
+        for _ in batch:
+            _queue.task_done()
+
+_writer = None
+_writer_lock = threading.Lock()
+
+def ensure_writer():
+    """Starts this process's writer thread on first use (i.e. after any fork)."""
+    global _writer
+    if _writer is None:
+        with _writer_lock:
+            if _writer is None:
+                _writer = threading.Thread(target=_run, name='audit-writer', daemon=True)
+                _writer.start()
+                atexit.register(flush)
+    return _writer
+
+def flush(timeout=5):
+    """Waits up to `timeout` seconds for queued records to be written. Returns True if they were."""
+    with _queue.all_tasks_done:
+        return _queue.all_tasks_done.wait_for(lambda: not _queue.unfinished_tasks, timeout)
+
+def query(event=None, user_id=None, entity_id=None, date_from=None, date_to=None, before_id=None, limit=100):
+    """
+    Audit records newest first, one page at a time: pass the returned
+    next_before_id to get the next page (None on the last one). `event`
+    ending in '.' matches a prefix, e.g. 'order.'. Dates are inclusive days.
+    """
+    clauses, params = [], []
+    if event:
+        if event.endswith('.'):
+            clauses.append("event LIKE %s")
+            # Backslash first, or it would double the escapes added after it
+            escaped = event.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+            params.append(escaped + '%')
+        else:
+            clauses.append("event = %s")
+            params.append(event)
+    if user_id is not None:
+        clauses.append("user_id = %s")
+        params.append(user_id)
+    if entity_id is not None:
+        clauses.append("entity_id = %s")
+        params.append(entity_id)
+    if date_from:
+        clauses.append("occurred_at >= %s")
+        params.append(date_from)
+    if date_to:
+        clauses.append("occurred_at < %s")
+        params.append(date_to + datetime.timedelta(days=1))
+    if before_id:
+        clauses.append("id < %s")
+        params.append(before_id)
+    where_sql = ("WHERE " + " AND ".join(clauses)) if clauses else ""
+
+    with get_db_cursor(readonly=True) as cur:
+        cur.execute(
+            f"""
+            SELECT id, occurred_at, event, entity_id, user_id, username, remote_addr, payload
+            FROM audit_log
+            {where_sql}
+            ORDER BY id DESC
+            LIMIT %s
+            """,
+            tuple(params) + (limit + 1,)
+        )
+        rows = cur.fetchall()
+
+    next_before_id = rows[limit - 1]['id'] if len(rows) > limit else None
+    return {'rows': rows[:limit], 'next_before_id': next_before_id}
@@ -1,10 +1,67 @@
 import functools
+import os
+import threading
+import time
+from collections import OrderedDict
 from flask import Blueprint, render_template, request, redirect, url_for, flash, session, g
 from werkzeug.security import check_password_hash
 from db import get_db_cursor
+import audit
 
 auth_bp = Blueprint('auth', __name__, url_prefix='/auth')
 
+class UserCache:
+    """
+    Small thread-safe TTL + LRU cache of user identities keyed by user id.
+
+    Entries expire after `ttl` seconds, which bounds how long another worker
+    process can act on a changed or deleted user; within this process call
+    invalidate_user() right after changing one. A ttl of 0 disables caching.
+    """
+
+    def __init__(self, maxsize=256, ttl=60):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, user_id):
+        with self._lock:
+            entry = self._entries.get(user_id)
+            if entry is None:
+                return None
+            expires, user = entry
+            if expires < time.monotonic():
+                del self._entries[user_id]
+                return None
+            self._entries.move_to_end(user_id)
+            return user
+
+    def set(self, user_id, user):
+        if self.ttl <= 0:
+            return
+        with self._lock:
+            self._entries[user_id] = (time.monotonic() + self.ttl, user)
+            self._entries.move_to_end(user_id)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, user_id=None):
+        with self._lock:
+            if user_id is None:
+                self._entries.clear()
+            else:
+                self._entries.pop(user_id, None)
+
+user_cache = UserCache(
+    maxsize=int(os.environ.get('AUTH_CACHE_SIZE', 256)),
+    ttl=float(os.environ.get('AUTH_CACHE_TTL', 60))
+)
+
+def invalidate_user(user_id=None):
+    """Drops a cached identity; call after updating or deleting a user (None clears all)."""
+    user_cache.invalidate(user_id)
+
 @auth_bp.route('/login', methods=('GET', 'POST'))
 def login():
     if request.method == 'POST':
@@ -27,12 +84,15 @@ def login():
             session.clear()
             session['user_id'] = user['id']
             session['role'] = user['role']
+            invalidate_user(user['id'])
+            audit.record('user.login', user['id'], user=user)
 
             if user['role'] == 'admin':
                 return redirect(url_for('admin_dashboard'))
             else:
                 return redirect(url_for('pos_index'))
 
+        audit.record('user.login_failed', payload={'username': username})
         flash(error)
 
     return render_template('login.html')
@@ -48,10 +108,16 @@ def load_logged_in_user():
 
     if user_id is None:
         g.user = None
-    else:
+        return
+
+    user = user_cache.get(user_id)
+    if user is None:
         with get_db_cursor() as cur:
-            cur.execute("SELECT * FROM users WHERE id = %s", (user_id,))
-            g.user = cur.fetchone()
+            cur.execute("SELECT id, username, role FROM users WHERE id = %s", (user_id,))
+            user = cur.fetchone()
+        if user is not None:
+            user_cache.set(user_id, user)
+    g.user = user
 
 def login_required(view):
     @functools.wraps(view)
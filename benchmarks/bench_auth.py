@@ -0,0 +1,91 @@
+"""
+Micro-benchmark for auth.load_logged_in_user: requests/sec through a
+login_required route with and without the identity cache.
+
+By default the users lookup is simulated with a fixed delay (--db-latency,
+in milliseconds) so the benchmark runs without a database; pass --real-db
+to hit the database configured through DB_* instead.
+
+    python benchmarks/bench_auth.py --requests 2000 --db-latency 1.5
+"""
+import argparse
+import os
+import sys
+import time
+from contextlib import contextmanager
+from unittest.mock import MagicMock, patch
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from flask import Flask
+import auth
+
+def make_app():
+    app = Flask(__name__)
+    app.config['SECRET_KEY'] = 'bench'
+    app.register_blueprint(auth.auth_bp)
+
+    @app.route('/ping')
+    @auth.login_required
+    def ping():
+        return 'ok'
+
+    return app
+
+def simulated_cursor(latency):
+    @contextmanager
+    def get_db_cursor(commit=False):
+        cur = MagicMock()
+
+        def execute(sql, params=None):
+            time.sleep(latency)
+            cur.fetchone.return_value = {'id': params[0], 'username': 'cashier', 'role': 'cashier'}
+
+        cur.execute.side_effect = execute
+        yield cur
+
+    return get_db_cursor
+
+def run(app, user_id, requests):
+    client = app.test_client()
+    with client.session_transaction() as sess:
+        sess['user_id'] = user_id
+
+    client.get('/ping')  # warm up
+    started = time.perf_counter()
+    for _ in range(requests):
+        res = client.get('/ping')
+        assert res.status_code == 200, res.status_code
+    return requests / (time.perf_counter() - started)
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--requests', type=int, default=2000)
+    parser.add_argument('--db-latency', type=float, default=1.0, help="simulated lookup latency in ms")
+    parser.add_argument('--real-db', action='store_true', help="use the configured database")
+    parser.add_argument('--user-id', type=int, default=1)
+    args = parser.parse_args()
+
+    app = make_app()
+    patcher = None
+    if not args.real_db:
+        patcher = patch('auth.get_db_cursor', simulated_cursor(args.db_latency / 1000.0))
+        patcher.start()
+
+    try:
+        results = {}
+        for label, ttl in (('no cache', 0), ('cached', 60)):
+            auth.user_cache = auth.UserCache(ttl=ttl)
+            results[label] = run(app, args.user_id, args.requests)
+    finally:
+        if patcher:
+            patcher.stop()
+
+    source = 'real database' if args.real_db else f'simulated {args.db_latency}ms lookup'
+    print(f"load_logged_in_user, {args.requests} requests, {source}")
+    for label, rps in results.items():
+        print(f"  {label:<10} {rps:10.0f} req/s")
+    print(f"  speedup    {results['cached'] / results['no cache']:10.1f}x")
+
+if __name__ == '__main__':
+    main()
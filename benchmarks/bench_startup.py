@@ -0,0 +1,87 @@
+"""
+Cold-start benchmark for the desktop/terminal server: each run is a fresh
+interpreter that imports the app, starts the waitress server run_gui.py
+uses and polls /healthz until it answers, as run_gui.py does before
+showing the app. Reports, per phase, the median and worst of --runs runs:
+
+    interpreter   process start until the first line of the script
+    import        import serve + create_server (loads the app)
+    ready         server thread started until /healthz answers 200
+    total         process start until ready
+    warm_up       serve.warm_up(): pools + catalog (only with --warm)
+
+--warm needs the database configured through DB_*; without it no
+connection is made.
+
+    python benchmarks/bench_startup.py --runs 10
+    python benchmarks/bench_startup.py --runs 5 --warm
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+CHILD = r"""
+import json, sys, threading, time, urllib.request
+entered = time.time()
+started = time.perf_counter()
+sys.path.insert(0, sys.argv[1])
+
+import serve
+server = serve.create_server(host='127.0.0.1', port=0)
+imported = time.perf_counter()
+threading.Thread(target=server.run, daemon=True).start()
+
+url = f"http://127.0.0.1:{server.effective_port}/healthz"
+deadline = time.monotonic() + 30
+while True:
+    try:
+        with urllib.request.urlopen(url, timeout=1) as res:
+            if res.status == 200:
+                break
+    except OSError:
+        if time.monotonic() > deadline:
+            sys.exit("server did not become ready")
+        time.sleep(0.005)
+ready = time.perf_counter()
+
+result = {'entered': entered, 'import': imported - started, 'ready': ready - imported, 'done': time.time()}
+if sys.argv[2] == '1':
+    result['warm_up'] = serve.warm_up()
+print(json.dumps(result))
+"""
+
+PHASES = ('interpreter', 'import', 'ready', 'total', 'warm_up')
+
+def run_once(warm):
+    launched = time.time()
+    out = subprocess.run(
+        [sys.executable, '-c', CHILD, ROOT, '1' if warm else '0'],
+        check=True, capture_output=True, text=True, cwd=ROOT
+    ).stdout
+    result = json.loads(out.strip().splitlines()[-1])
+    result['interpreter'] = result['entered'] - launched
+    result['total'] = result['done'] - launched
+    return result
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--runs', type=int, default=10)
+    parser.add_argument('--warm', action='store_true', help="also time serve.warm_up() (needs the database)")
+    args = parser.parse_args()
+
+    results = [run_once(args.warm) for _ in range(args.runs)]
+
+    print(f"{'phase':<12} {'median ms':>10} {'max ms':>10}")
+    for phase in PHASES:
+        values = [r[phase] * 1000 for r in results if phase in r]
+        if values:
+            print(f"{phase:<12} {statistics.median(values):>10.1f} {max(values):>10.1f}")
+
+if __name__ == '__main__':
+    main()
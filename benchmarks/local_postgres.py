@@ -0,0 +1,113 @@
+"""
+Throwaway PostgreSQL cluster for benchmarks, built with the initdb/pg_ctl
+binaries on PATH (or in PG_BIN). Data lives in a temporary directory that
+is removed on stop.
+"""
+import os
+import shutil
+import socket
+import subprocess
+import tempfile
+
+
+def _find_binary(name):
+    pg_bin = os.environ.get('PG_BIN')
+    if pg_bin and os.path.exists(os.path.join(pg_bin, name)):
+        return os.path.join(pg_bin, name)
+    return shutil.which(name)
+
+def available():
+    return all(_find_binary(name) for name in ('initdb', 'pg_ctl', 'createdb'))
+
+def _free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+class LocalPostgres:
+    def __init__(self, dbname='kasir_bench', port=None):
+        self.dbname = dbname
+        self.port = port or _free_port()
+        self.user = 'postgres'
+        self.datadir = None
+
+    def start(self):
+        if not available():
+            raise RuntimeError("initdb/pg_ctl not found; set PG_BIN or point DB_* at an existing server")
+
+        self.datadir = tempfile.mkdtemp(prefix='pos-bench-pg-')
+        data = os.path.join(self.datadir, 'data')
+        subprocess.run(
+            [_find_binary('initdb'), '-D', data, '-U', self.user, '-A', 'trust', '--no-sync'],
+            check=True, stdout=subprocess.DEVNULL
+        )
+        self._pg_ctl_start(data)
+        subprocess.run(
+            [_find_binary('createdb'), '-h', '127.0.0.1', '-p', str(self.port), '-U', self.user, self.dbname],
+            check=True
+        )
+        return self
+
+    def _pg_ctl_start(self, data):
+        subprocess.run(
+            [_find_binary('pg_ctl'), '-D', data, '-w', '-l', os.path.join(self.datadir, 'postgres.log'),
+             '-o', f'-p {self.port} -k {self.datadir} -c listen_addresses=127.0.0.1 -c fsync=off', 'start'],
+            check=True, stdout=subprocess.DEVNULL
+        )
+
+    def env(self):
+        """DB_* settings for db.py; must be applied before db is imported."""
+        return {
+            'DB_NAME': self.dbname,
+            'DB_USER': self.user,
+            'DB_PASSWORD': '',
+            'DB_HOST': '127.0.0.1',
+            'DB_PORT': str(self.port),
+        }
+
+    def stop(self):
+        if self.datadir is None:
+            return
+        subprocess.run(
+            [_find_binary('pg_ctl'), '-D', os.path.join(self.datadir, 'data'), '-m', 'fast', 'stop'],
+            stdout=subprocess.DEVNULL
+        )
+        shutil.rmtree(self.datadir, ignore_errors=True)
+        self.datadir = None
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+
+class LocalReplica(LocalPostgres):
+    """Streaming hot standby of a running LocalPostgres, cloned with pg_basebackup."""
+
+    def __init__(self, primary, port=None):
+        super().__init__(primary.dbname, port)
+        self.primary = primary
+
+    def start(self):
+        if not _find_binary('pg_basebackup'):
+            raise RuntimeError("pg_basebackup not found; set PG_BIN")
+
+        self.datadir = tempfile.mkdtemp(prefix='pos-bench-pg-replica-')
+        data = os.path.join(self.datadir, 'data')
+        # -R writes the standby settings, so it starts replicating right away
+        subprocess.run(
+            [_find_binary('pg_basebackup'), '-h', '127.0.0.1', '-p', str(self.primary.port), '-U', self.user,
+             '-D', data, '-R', '-X', 'stream', '--no-sync'],
+            check=True
+        )
+        self._pg_ctl_start(data)
+        return self
+
+    def env(self):
+        """DB_REPLICA_* settings for db.py; must be applied before db is imported."""
+        return {
+            'DB_REPLICA_HOST': '127.0.0.1',
+            'DB_REPLICA_PORT': str(self.port),
+        }
@@ -0,0 +1,320 @@
+"""
+Load/benchmark runner for checkout, catalog and reporting endpoints.
+
+Drives the Flask app in-process (one test client per worker thread) against
+the database configured through DB_*, or against a throwaway cluster with
+--spawn-postgres. Each workload reports throughput, p50/p95/p99 latency and
+database queries per request. Results can be saved as a baseline and later
+runs compared against it; --compare exits non-zero on a regression.
+
+    python benchmarks/run.py --spawn-postgres --seed --save-baseline
+    python benchmarks/run.py --spawn-postgres --seed --compare
+    python benchmarks/run.py --spawn-postgres --replica   # reports on a replica
+
+Workloads run one after another so their numbers do not mix; checkouts
+modify the data, so compare runs seeded with the same volumes.
+"""
+import argparse
+import json
+import os
+import random
+import sys
+import threading
+import time
+import uuid
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+DEFAULT_BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'baselines.json')
+
+
+class QueryCounter:
+    """db listener counting statements per thread; requests run on the worker's thread."""
+
+    def __init__(self):
+        self._local = threading.local()
+
+    @property
+    def count(self):
+        return getattr(self._local, 'count', 0)
+
+    def reset(self):
+        self._local.count = 0
+
+    def on_connect(self, duration):
+        pass
+
+    def on_query(self, sql, duration):
+        self._local.count = self.count + 1
+
+
+# --- WORKLOADS ---
+# Each takes (client, context, rng) and returns a response; any status
+# other than 200/304 counts as an error.
+
+def _checkout(cart_size):
+    def run(client, ctx, rng):
+        products = rng.sample(ctx['products'], min(cart_size, len(ctx['products'])))
+        return client.post('/api/order', json={
+            'items': [{'id': p['id'], 'quantity': rng.randint(1, 3)} for p in products],
+            'payment_method': rng.choice(['cash', 'qris']),
+            'idempotency_key': uuid.uuid4().hex,
+        })
+    return run
+
+def catalog_poll(client, ctx, rng):
+    return client.get('/api/products', headers={'If-None-Match': f'"{ctx["catalog_etag"]}"'})
+
+def catalog_full(client, ctx, rng):
+    return client.get('/api/products')
+
+def search(client, ctx, rng):
+    # A typed fragment of a real name: prefix, substring or one typo
+    name = rng.choice(ctx['products'])['name'].lower()
+    kind = rng.randrange(3)
+    if kind == 0:
+        q = name[:rng.randint(2, 4)]
+    elif kind == 1:
+        start = rng.randrange(max(len(name) - 4, 1))
+        q = name[start:start + 5]
+    else:
+        i = rng.randrange(len(name))
+        q = name[:i] + name[i + 1:]
+    return client.get('/api/products/search', query_string={'q': q, 'limit': 48, 'fields': 'id,name,price,stock'})
+
+def dashboard(client, ctx, rng):
+    return client.get('/admin')
+
+def export_csv(client, ctx, rng):
+    # Last 30 days so the export size does not depend on how much history was seeded
+    response = client.get('/admin/sales/export', query_string={'format': 'csv', 'date_from': ctx['export_from']})
+    response.get_data()
+    return response
+
+WORKLOADS = {
+    # name: (function, role)
+    'checkout_1': (_checkout(1), 'cashier'),
+    'checkout_5': (_checkout(5), 'cashier'),
+    'checkout_15': (_checkout(15), 'cashier'),
+    'catalog_poll': (catalog_poll, 'cashier'),
+    'catalog_full': (catalog_full, 'cashier'),
+    'search': (search, 'cashier'),
+    'dashboard': (dashboard, 'admin'),
+    'export_csv': (export_csv, 'admin'),
+}
+
+
+def percentile(sorted_values, pct):
+    if not sorted_values:
+        return 0.0
+    index = max(int(round(pct / 100.0 * len(sorted_values))) - 1, 0)
+    return sorted_values[min(index, len(sorted_values) - 1)]
+
+def run_workload(app, counter, name, ctx, requests, concurrency, warmup=3):
+    func, role = WORKLOADS[name]
+    user_id = ctx['users'][role]
+    per_worker = max(requests // concurrency, 1)
+    latencies, queries, errors = [], [], []
+    lock = threading.Lock()
+    barrier = threading.Barrier(concurrency + 1)
+
+    def worker(index):
+        rng = random.Random(index)
+        client = app.test_client()
+        with client.session_transaction() as sess:
+            sess['user_id'] = user_id
+
+        for _ in range(warmup):
+            func(client, ctx, rng)
+
+        mine, mine_queries, mine_errors = [], [], 0
+        barrier.wait()
+        for _ in range(per_worker):
+            counter.reset()
+            start = time.perf_counter()
+            response = func(client, ctx, rng)
+            mine.append(time.perf_counter() - start)
+            mine_queries.append(counter.count)
+            if response.status_code not in (200, 304):
+                mine_errors += 1
+
+        with lock:
+            latencies.extend(mine)
+            queries.extend(mine_queries)
+            errors.append(mine_errors)
+
+    threads = [threading.Thread(target=worker, args=(i,)) for i in range(concurrency)]
+    for t in threads:
+        t.start()
+    barrier.wait()
+    start = time.perf_counter()
+    for t in threads:
+        t.join()
+    elapsed = time.perf_counter() - start
+
+    latencies.sort()
+    return {
+        'requests': len(latencies),
+        'errors': sum(errors),
+        'throughput': round(len(latencies) / elapsed, 1) if elapsed else 0.0,
+        'p50_ms': round(percentile(latencies, 50) * 1000, 2),
+        'p95_ms': round(percentile(latencies, 95) * 1000, 2),
+        'p99_ms': round(percentile(latencies, 99) * 1000, 2),
+        'queries_per_request': round(sum(queries) / len(queries), 2) if queries else 0.0,
+    }
+
+def load_context():
+    import datetime
+    from db import get_db_cursor
+
+    with get_db_cursor() as cur:
+        cur.execute("SELECT id, username FROM users WHERE username IN ('admin', 'cashier')")
+        users = {row['username']: row['id'] for row in cur.fetchall()}
+        # Benchmark products are seeded with effectively unlimited stock
+        cur.execute("SELECT id, name FROM products WHERE is_inventory_managed = FALSE OR stock >= 1000000")
+        products = cur.fetchall()
+
+    if len(users) < 2 or not products:
+        raise RuntimeError("Database is not seeded; run with --seed or benchmarks/seed.py first")
+
+    return {
+        'users': users,
+        'products': products,
+        'export_from': (datetime.date.today() - datetime.timedelta(days=30)).isoformat(),
+    }
+
+
+def compare(results, baseline, tolerance):
+    """Returns a list of regression messages against `baseline`."""
+    regressions = []
+    for name, result in results.items():
+        base = baseline.get(name)
+        if not base:
+            continue
+        if result['p95_ms'] > base['p95_ms'] * (1 + tolerance):
+            regressions.append(f"{name}: p95 {result['p95_ms']}ms vs baseline {base['p95_ms']}ms")
+        if result['throughput'] < base['throughput'] * (1 - tolerance):
+            regressions.append(f"{name}: throughput {result['throughput']}/s vs baseline {base['throughput']}/s")
+        # Query counts are deterministic, so any increase is a real change
+        if result['queries_per_request'] > base['queries_per_request'] + 0.5:
+            regressions.append(
+                f"{name}: {result['queries_per_request']} queries/request vs baseline {base['queries_per_request']}"
+            )
+        if result['errors'] and not base.get('errors'):
+            regressions.append(f"{name}: {result['errors']} errors")
+    return regressions
+
+def print_table(results):
+    columns = ('requests', 'errors', 'throughput', 'p50_ms', 'p95_ms', 'p99_ms', 'queries_per_request')
+    widths = [max(len(c), 8) + 2 for c in columns]
+    print(f"{'workload':<14}" + ''.join(f"{c:>{w}}" for c, w in zip(columns, widths)))
+    for name, result in results.items():
+        print(f"{name:<14}" + ''.join(f"{result[c]:>{w}}" for c, w in zip(columns, widths)))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--spawn-postgres', action='store_true', help="Run against a temporary local cluster")
+    parser.add_argument('--replica', action='store_true',
+                        help="With --spawn-postgres, also start a streaming replica for read-only queries")
+    parser.add_argument('--seed', action='store_true', help="(Re)create and seed the database first")
+    parser.add_argument('--products', type=int, default=500)
+    parser.add_argument('--orders', type=int, default=50000)
+    parser.add_argument('--days', type=int, default=365)
+    parser.add_argument('--workloads', default=','.join(WORKLOADS),
+                        help="Comma-separated subset of: " + ', '.join(WORKLOADS))
+    parser.add_argument('--requests', type=int, default=500, help="Requests per workload")
+    parser.add_argument('--concurrency', type=int, default=8)
+    parser.add_argument('--baseline', default=DEFAULT_BASELINE)
+    parser.add_argument('--save-baseline', action='store_true')
+    parser.add_argument('--compare', action='store_true')
+    parser.add_argument('--tolerance', type=float, default=0.25,
+                        help="Allowed relative slowdown before --compare fails (default 0.25)")
+    args = parser.parse_args()
+
+    names = [n.strip() for n in args.workloads.split(',') if n.strip()]
+    unknown = [n for n in names if n not in WORKLOADS]
+    if unknown:
+        parser.error(f"Unknown workloads: {', '.join(unknown)}")
+
+    if args.replica and not args.spawn_postgres:
+        parser.error("--replica needs --spawn-postgres; otherwise set DB_REPLICA_HOST")
+
+    cluster = replica = None
+    if args.spawn_postgres:
+        from local_postgres import LocalPostgres, LocalReplica
+        cluster = LocalPostgres().start()
+        # db reads DB_* at import time
+        os.environ.update(cluster.env())
+        if args.replica:
+            # Cloned before seeding; the seed data arrives by streaming
+            replica = LocalReplica(cluster).start()
+            os.environ.update(replica.env())
+        args.seed = True
+
+    try:
+        if args.seed:
+            from seed import seed
+            seed(args.products, args.orders, args.days)
+
+        import db
+        import services
+        from app import app
+
+        # The pool must hold at least one connection per worker, or the
+        # numbers measure pool waits
+        db.POOL_CONFIG['maxconn'] = max(db.POOL_CONFIG['maxconn'], args.concurrency)
+        db.REPLICA_POOL_CONFIG['maxconn'] = max(db.REPLICA_POOL_CONFIG['maxconn'], args.concurrency)
+        db.close_pool()
+
+        counter = QueryCounter()
+        db.add_listener(counter)
+        ctx = load_context()
+
+        results = {}
+        for name in names:
+            print(f"Running {name}...")
+            # Checkouts bump the catalog version; polls must revalidate the current one
+            ctx['catalog_etag'] = f"catalog-{services.get_catalog_version()}"
+            results[name] = run_workload(app, counter, name, ctx, args.requests, args.concurrency)
+        print_table(results)
+
+        status = 0
+        if args.compare:
+            if not os.path.exists(args.baseline):
+                print(f"No baseline at {args.baseline}; run with --save-baseline first.")
+                status = 1
+            else:
+                with open(args.baseline) as f:
+                    regressions = compare(results, json.load(f)['results'], args.tolerance)
+                for message in regressions:
+                    print(f"REGRESSION {message}")
+                if regressions:
+                    status = 1
+                else:
+                    print("No regressions.")
+
+        if args.save_baseline:
+            with open(args.baseline, 'w') as f:
+                json.dump({
+                    'config': {
+                        'products': args.products, 'orders': args.orders, 'days': args.days,
+                        'requests': args.requests, 'concurrency': args.concurrency,
+                    },
+                    'results': results,
+                }, f, indent=2, sort_keys=True)
+            print(f"Baseline saved to {args.baseline}.")
+
+        return status
+    finally:
+        if cluster is not None:
+            import db
+            db.close_pool()
+            if replica is not None:
+                replica.stop()
+            cluster.stop()
+
+if __name__ == '__main__':
+    sys.exit(main())
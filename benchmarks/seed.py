@@ -0,0 +1,144 @@
+"""
+Seeds a benchmark database: runs init_db (schema, users, demo products),
+then bulk-loads generated products and a sales history with COPY and
+rebuilds the rollups. Deterministic for a given --seed.
+
+    python benchmarks/seed.py --products 2000 --orders 200000 --days 365
+"""
+import argparse
+import csv
+import datetime
+import io
+import os
+import random
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+CATEGORIES = ['Coffee', 'Tea', 'Pastry', 'Beverage', 'Snack', 'Meal']
+PAYMENT_METHODS = ['cash', 'qris']
+CHUNK = 10000
+
+
+def _copy(cur, table, columns, rows):
+    buf = io.StringIO()
+    csv.writer(buf).writerows(rows)
+    buf.seek(0)
+    cur.copy_expert(f"COPY {table} ({', '.join(columns)}) FROM STDIN WITH (FORMAT csv)", buf)
+
+def seed_products(cur, count, rng):
+    rows = []
+    for i in range(count):
+        managed = rng.random() < 0.5
+        price = rng.randrange(5, 150) * 1000
+        rows.append((
+            f"Bench {CATEGORIES[i % len(CATEGORIES)]} {i:05d}",
+            price,
+            CATEGORIES[i % len(CATEGORIES)],
+            f"https://placehold.co/400x300?text=P{i}",
+            managed,
+            # Plenty of stock so checkout workloads do not run dry
+            10 ** 7 if managed else 0,
+        ))
+    _copy(cur, 'products', ['name', 'price', 'category', 'image_url', 'is_inventory_managed', 'stock'], rows)
+
+    cur.execute("SELECT id, name, price FROM products ORDER BY id")
+    return cur.fetchall()
+
+def seed_orders(cur, count, days, products, rng, max_items=8):
+    """Generates `count` orders spread over the last `days` days, oldest first."""
+    from services import calculate_tax
+
+    today = datetime.date.today()
+    per_day = max(count // days, 1)
+    order_id = 0
+    orders, items = [], []
+
+    def flush():
+        _copy(cur, 'orders',
+              ['id', 'transaction_code', 'total_amount', 'tax_amount', 'payment_method', 'created_at', 'status'],
+              orders)
+        _copy(cur, 'order_items',
+              ['order_id', 'order_created_at', 'product_id', 'product_name_snapshot', 'price_snapshot',
+               'quantity', 'subtotal'],
+              items)
+        orders.clear()
+        items.clear()
+
+    # Monthly partitions for the whole history
+    cur.execute("SELECT ensure_order_partitions(%s, %s)", (today - datetime.timedelta(days=days), today))
+
+    for day_offset in range(days, -1, -1):
+        day = today - datetime.timedelta(days=day_offset)
+        n = min(per_day, count - order_id)
+        times = sorted(rng.randrange(7 * 3600, 22 * 3600) for _ in range(n))
+        for seq, seconds in enumerate(times, start=1):
+            order_id += 1
+            created_at = datetime.datetime.combine(day, datetime.time()) + datetime.timedelta(seconds=seconds)
+            subtotal = 0
+            for product in rng.sample(products, rng.randint(1, max_items)):
+                qty = rng.randint(1, 3)
+                line = int(product['price']) * qty
+                subtotal += line
+                items.append((order_id, created_at, product['id'], product['name'], int(product['price']), qty, line))
+            tax = calculate_tax(subtotal)
+            orders.append((
+                order_id,
+                f"TRX-{day.strftime('%Y%m%d')}-{seq:04d}",
+                subtotal + tax,
+                tax,
+                rng.choice(PAYMENT_METHODS),
+                created_at,
+                'void' if rng.random() < 0.02 else 'paid',
+            ))
+            if len(orders) >= CHUNK:
+                flush()
+        if order_id >= count:
+            break
+    if orders:
+        flush()
+
+    cur.execute("SELECT setval('orders_id_seq', GREATEST((SELECT MAX(id) FROM orders), 1))")
+    cur.execute(
+        """
+        INSERT INTO transaction_counters (day, last_seq)
+        SELECT to_date(split_part(transaction_code, '-', 2), 'YYYYMMDD'),
+               MAX(split_part(transaction_code, '-', 3)::int)
+        FROM orders GROUP BY 1
+        ON CONFLICT (day) DO UPDATE
+        SET last_seq = GREATEST(transaction_counters.last_seq, EXCLUDED.last_seq)
+        """
+    )
+    return order_id
+
+def seed(products=500, orders=50000, days=365, random_seed=42):
+    # init_db reads schema.sql relative to the working directory
+    os.chdir(ROOT)
+    from db import get_db_cursor
+    from init_db import init_db
+    from rebuild_rollups import rebuild_rollups
+
+    init_db()
+    rng = random.Random(random_seed)
+
+    with get_db_cursor(commit=True) as cur:
+        catalog = seed_products(cur, products, rng)
+        print(f"Seeded {len(catalog)} products.")
+        seeded = seed_orders(cur, orders, days, catalog, rng)
+        print(f"Seeded {seeded} orders.")
+        cur.execute("ANALYZE")
+
+    rebuild_rollups()
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--products', type=int, default=500)
+    parser.add_argument('--orders', type=int, default=50000)
+    parser.add_argument('--days', type=int, default=365)
+    parser.add_argument('--seed', type=int, default=42)
+    args = parser.parse_args()
+    seed(args.products, args.orders, args.days, args.seed)
+
+if __name__ == '__main__':
+    main()
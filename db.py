@@ -1,31 +1,443 @@
+import contextvars
+import os
+import threading
+import time
 import psycopg2
+import psycopg2.extensions
 import psycopg2.extras
 from contextlib import contextmanager
 
 DB_CONFIG = {
-    'dbname': 'kasir_db',
-    'user': 'postgres',
-    'password': '5432',
-    'host': 'localhost',
-    'port': 5432
+    'dbname': os.environ.get('DB_NAME', 'kasir_db'),
+    'user': os.environ.get('DB_USER', 'postgres'),
+    'password': os.environ.get('DB_PASSWORD', '5432'),
+    'host': os.environ.get('DB_HOST', 'localhost'),
+    'port': int(os.environ.get('DB_PORT', 5432)),
+    # Seconds; an unreachable server fails fast instead of after the OS TCP timeout
+    'connect_timeout': int(os.environ.get('DB_CONNECT_TIMEOUT', 10)),
 }
 
+# Pool sizing and lifetime, overridable per deployment (e.g. DB_POOL_MAX=20)
+POOL_CONFIG = {
+    'minconn': int(os.environ.get('DB_POOL_MIN', 1)),
+    'maxconn': int(os.environ.get('DB_POOL_MAX', 10)),
+    'timeout': float(os.environ.get('DB_POOL_TIMEOUT', 5)),
+    'max_age': float(os.environ.get('DB_POOL_MAX_AGE', 1800)),
+    'check_idle': float(os.environ.get('DB_POOL_CHECK_IDLE', 30)),
+}
+
+# Optional streaming replica for read-only work (reports, listings,
+# exports; see get_db_cursor(readonly=True)). Unset DB_REPLICA_HOST means
+# everything runs on the primary. Other settings default to the primary's.
+REPLICA_CONFIG = dict(
+    DB_CONFIG,
+    host=os.environ.get('DB_REPLICA_HOST'),
+    port=int(os.environ.get('DB_REPLICA_PORT', DB_CONFIG['port'])),
+    dbname=os.environ.get('DB_REPLICA_NAME', DB_CONFIG['dbname']),
+    user=os.environ.get('DB_REPLICA_USER', DB_CONFIG['user']),
+    password=os.environ.get('DB_REPLICA_PASSWORD', DB_CONFIG['password']),
+    # Connected to on the request path (replica_lag, read routing), where
+    # giving up quickly means falling back to the primary
+    connect_timeout=int(os.environ.get('DB_REPLICA_CONNECT_TIMEOUT', 2)),
+)
+REPLICA_POOL_CONFIG = dict(POOL_CONFIG, maxconn=int(os.environ.get('DB_REPLICA_POOL_MAX', POOL_CONFIG['maxconn'])))
+
+# Readers fall back to the primary while the replica is further behind than
+# this, and for this long after their own session last wrote, which keeps
+# read-your-writes without tracking WAL positions.
+REPLICA_MAX_LAG = float(os.environ.get('DB_REPLICA_MAX_LAG', 5))
+REPLICA_LAG_CHECK = 1.0
+REPLICA_RETRY = 10.0
+
+TARGETS = {'primary': (DB_CONFIG, POOL_CONFIG)}
+if REPLICA_CONFIG['host']:
+    TARGETS['replica'] = (REPLICA_CONFIG, REPLICA_POOL_CONFIG)
+
+
+_listeners = []
+
+def add_listener(listener):
+    """
+    Registers an instrumentation listener. It must provide
+    on_connect(duration) and on_query(sql, duration), durations in seconds,
+    and is called synchronously on the calling thread.
+    """
+    if listener not in _listeners:
+        _listeners.append(listener)
+
+def remove_listener(listener):
+    if listener in _listeners:
+        _listeners.remove(listener)
+
+
+class InstrumentedCursor(psycopg2.extras.RealDictCursor):
+    """RealDictCursor that reports each statement's duration to the listeners."""
+
+    def _timed(self, method, sql, *args):
+        if not _listeners:
+            return method(sql, *args)
+        start = time.perf_counter()
+        try:
+            return method(sql, *args)
+        finally:
+            duration = time.perf_counter() - start
+            for listener in _listeners:
+                listener.on_query(sql, duration)
+
+    def execute(self, query, vars=None):
+        return self._timed(super().execute, query, vars)
+
+    def executemany(self, query, vars_list):
+        return self._timed(super().executemany, query, vars_list)
+
+    def copy_expert(self, sql, file, size=8192):
+        return self._timed(super().copy_expert, sql, file, size)
+
+
+class PoolTimeout(Exception):
+    """Raised when no connection becomes available within the pool timeout."""
+
+
+class ConnectionPool:
+    """
+    Bounded, thread-safe pool of psycopg2 connections.
+
+    Connections idle for longer than `check_idle` seconds are pinged before
+    being handed out, and connections older than `max_age` seconds are
+    replaced instead of reused.
+    """
+
+    def __init__(self, minconn=1, maxconn=10, timeout=5, max_age=1800, check_idle=30,
+                 connect=None, **conn_kwargs):
+        if maxconn < 1 or minconn > maxconn:
+            raise ValueError("Invalid pool size: min=%s max=%s" % (minconn, maxconn))
+        self.minconn = minconn
+        self.maxconn = maxconn
+        self.timeout = timeout
+        self.max_age = max_age
+        self.check_idle = check_idle
+        self._connect = connect or psycopg2.connect
+        self._conn_kwargs = conn_kwargs
+
+        self._lock = threading.Condition()
+        self._idle = []      # [(conn, last_used)] - most recently used last
+        self._born = {}      # id(conn) -> creation time
+        self._size = 0       # open connections, idle + checked out
+        self._closed = False
+        self._stats = {
+            'checkouts': 0,
+            'waits': 0,
+            'wait_time': 0.0,
+            'timeouts': 0,
+            'connects': 0,
+            'discarded': 0,
+        }
+
+        for _ in range(minconn):
+            conn = self._new_connection()
+            self._idle.append((conn, time.monotonic()))
+            self._size += 1
+
+    def _new_connection(self):
+        start = time.perf_counter()
+        conn = self._connect(**self._conn_kwargs)
+        duration = time.perf_counter() - start
+        for listener in _listeners:
+            listener.on_connect(duration)
+        self._born[id(conn)] = time.monotonic()
+        self._stats['connects'] += 1
+        return conn
+
+    def _expired(self, conn, now):
+        return self.max_age and now - self._born.get(id(conn), now) > self.max_age
+
+    def _healthy(self, conn, last_used, now):
+        if conn.closed:
+            return False
+        if self.check_idle is not None and now - last_used >= self.check_idle:
+            try:
+                with conn.cursor() as cur:
+                    cur.execute("SELECT 1")
+                conn.rollback()
+            except psycopg2.Error:
+                return False
+        return True
+
+    def _close(self, conn):
+        self._born.pop(id(conn), None)
+        self._stats['discarded'] += 1
+        try:
+            conn.close()
+        except Exception:
+            pass
+
+    def getconn(self):
+        deadline = time.monotonic() + self.timeout
+        waited = None
+
+        with self._lock:
+            while True:
+                if self._closed:
+                    raise PoolTimeout("Connection pool is closed")
+
+                if self._idle:
+                    conn, last_used = self._idle.pop()
+                    break
+
+                if self._size < self.maxconn:
+                    # Reserve the slot, connect outside the lock
+                    self._size += 1
+                    conn, last_used = None, None
+                    break
+
+                if waited is None:
+                    waited = time.monotonic()
+                    self._stats['waits'] += 1
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    self._stats['timeouts'] += 1
+                    self._stats['wait_time'] += time.monotonic() - waited
+                    raise PoolTimeout(
+                        "No database connection available after %.1fs (max %d)" % (self.timeout, self.maxconn)
+                    )
+                self._lock.wait(remaining)
+
+            self._stats['checkouts'] += 1
+            if waited is not None:
+                self._stats['wait_time'] += time.monotonic() - waited
+
+        if conn is not None:
+            now = time.monotonic()
+            if not self._expired(conn, now) and self._healthy(conn, last_used, now):
+                return conn
+            with self._lock:
+                self._close(conn)
+
+        try:
+            return self._new_connection()
+        except Exception:
+            with self._lock:
+                self._size -= 1
+                self._lock.notify()
+            raise
+
+    def putconn(self, conn, discard=False):
+        with self._lock:
+            now = time.monotonic()
+            if (discard or self._closed or conn.closed or self._expired(conn, now)
+                    or conn.get_transaction_status() != psycopg2.extensions.TRANSACTION_STATUS_IDLE):
+                self._close(conn)
+                self._size -= 1
+            else:
+                self._idle.append((conn, now))
+            self._lock.notify()
+
+    def closeall(self):
+        with self._lock:
+            self._closed = True
+            for conn, _ in self._idle:
+                self._close(conn)
+                self._size -= 1
+            self._idle = []
+            self._lock.notify_all()
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+            stats['size'] = self._size
+            stats['idle'] = len(self._idle)
+            stats['in_use'] = self._size - len(self._idle)
+            stats['maxconn'] = self.maxconn
+            return stats
+
+
+_pools = {}
+_pool_lock = threading.Lock()
+
+def get_pool(target='primary'):
+    """Returns the process-wide pool for `target`, creating it on first use (i.e. after any fork)."""
+    pool = _pools.get(target)
+    if pool is None:
+        with _pool_lock:
+            pool = _pools.get(target)
+            if pool is None:
+                conn_config, pool_config = TARGETS[target]
+                pool = _pools[target] = ConnectionPool(**pool_config, **conn_config)
+    return pool
+
+def close_pool():
+    with _pool_lock:
+        for pool in _pools.values():
+            pool.closeall()
+        _pools.clear()
+
+def reset_pool_after_fork():
+    """
+    Forgets pools inherited across fork() without closing them: their
+    sockets are shared with the parent, and closing them would end the
+    parent's sessions. The child opens its own pools on first use.
+    """
+    global _pools, _pool_lock, _replica_state
+    _pools = {}
+    _pool_lock = threading.Lock()
+    _replica_state = {'lag': None, 'checked': 0.0, 'down_until': 0.0}
+
+def pool_stats(target='primary'):
+    pool = _pools.get(target)
+    return pool.stats() if pool is not None else {}
+
+# --- READ ROUTING ---
+
+# Wall-clock time of the current session's last commit on the primary. The
+# web app carries it across requests in the user's session (see app.py).
+_last_write = contextvars.ContextVar('last_write', default=None)
+_replica_state = {'lag': None, 'checked': 0.0, 'down_until': 0.0}
+
+def last_write():
+    return _last_write.get()
+
+def set_last_write(timestamp):
+    _last_write.set(timestamp)
+
+def _mark_replica_down():
+    # Unreachable: use the primary and stop retrying for REPLICA_RETRY seconds
+    _replica_state['down_until'] = time.monotonic() + REPLICA_RETRY
+    _replica_state['lag'] = None
+
+def replica_lag():
+    """
+    Seconds the replica is behind the primary, re-measured at most every
+    REPLICA_LAG_CHECK seconds; None if it cannot be reached.
+
+    A replica counts as current only while its WAL receiver is streaming
+    and it has replayed everything received; a receiver that lost the
+    primary has nothing more to replay but is not current. Otherwise the
+    lag is the age of the last replayed transaction, which overstates it
+    while the primary is idle, so such reads stay on the primary. Seeing
+    the receiver's status takes pg_read_all_stats for the replica's user;
+    without it the age is always used.
+    """
+    now = time.monotonic()
+    if now < _replica_state['down_until']:
+        return None
+    if now - _replica_state['checked'] < REPLICA_LAG_CHECK:
+        return _replica_state['lag']
+
+    _replica_state['checked'] = now
+    try:
+        pool = get_pool('replica')
+        conn = pool.getconn()
+    except (psycopg2.Error, PoolTimeout):
+        _mark_replica_down()
+        return None
+    broken = False
+    try:
+        with conn.cursor() as cur:
+            cur.execute(
+                """
+                SELECT CASE
+                    WHEN NOT pg_is_in_recovery() THEN 0
+                    WHEN pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn()
+                         AND EXISTS (SELECT 1 FROM pg_stat_wal_receiver WHERE status = 'streaming') THEN 0
+                    ELSE COALESCE(EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp()), 'Infinity')
+                END
+                """
+            )
+            lag = float(cur.fetchone()[0])
+        conn.rollback()
+    except psycopg2.Error:
+        broken = True
+        _mark_replica_down()
+        return None
+    finally:
+        pool.putconn(conn, discard=broken)
+    _replica_state['lag'] = lag
+    return lag
+
+def last_replica_lag():
+    """The most recent lag measurement, without measuring; None if unknown or unreachable."""
+    return _replica_state['lag']
+
+def read_target():
+    """'replica' when a read-only transaction may use it, otherwise 'primary'."""
+    if 'replica' not in TARGETS:
+        return 'primary'
+    written = _last_write.get()
+    if written is not None and time.time() - written < REPLICA_MAX_LAG:
+        return 'primary'
+    lag = replica_lag()
+    if lag is None or lag > REPLICA_MAX_LAG:
+        return 'primary'
+    return 'replica'
+
 def get_db_connection():
     conn = psycopg2.connect(**DB_CONFIG)
     return conn
 
+def _checkout(readonly):
+    """(pool, connection) for a transaction; read-only ones may go to the replica."""
+    if readonly and read_target() == 'replica':
+        pool = get_pool('replica')
+        try:
+            return pool, pool.getconn()
+        except (psycopg2.Error, PoolTimeout):
+            _mark_replica_down()
+    pool = get_pool()
+    return pool, pool.getconn()
+
 @contextmanager
-def get_db_cursor(commit=False):
-    conn = get_db_connection()
+def get_db_cursor(commit=False, name=None, itersize=2000, readonly=False):
+    """
+    Yields a RealDictCursor on a pooled connection.
+
+    Passing `name` opens a server-side cursor instead: rows are fetched from
+    Postgres `itersize` at a time while iterating, so large result sets never
+    have to fit in memory.
+
+    With readonly=True the transaction is started READ ONLY and runs on the
+    replica when there is one that is current enough (see read_target), so
+    reporting stays off the primary; otherwise on the primary.
+    """
+    if readonly and commit:
+        raise ValueError("A read-only transaction cannot commit")
+    pool, conn = _checkout(readonly)
+    cur = None
+    broken = False
     try:
+        if readonly:
+            # Sent with the BEGIN, so it costs no extra round trip
+            conn.readonly = True
         # Use RealDictCursor to access columns by name
-        cur = conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor)
+        cur = conn.cursor(name, cursor_factory=InstrumentedCursor)
+        if name:
+            cur.itersize = itersize
         yield cur
+        # Before the transaction ends: a named cursor's portal goes with it,
+        # and closing it afterwards fails
+        cur.close()
         if commit:
             conn.commit()
-    except Exception:
-        conn.rollback()
+            _last_write.set(time.time())
+        else:
+            # Never hand a connection back to the pool mid-transaction
+            conn.rollback()
+    except BaseException:
+        # BaseException too: a streaming response abandoned mid-way closes
+        # its generator with GeneratorExit
+        if cur is not None and not cur.closed:
+            try:
+                cur.close()
+            except psycopg2.Error:
+                pass  # the rollback below ends it anyway
+        try:
+            conn.rollback()
+        except psycopg2.Error:
+            broken = True
         raise
     finally:
-        cur.close()
-        conn.close()
+        if readonly and not broken:
+            try:
+                conn.readonly = None
+            except psycopg2.Error:
+                broken = True
+        pool.putconn(conn, discard=broken)
@@ -0,0 +1,154 @@
+"""
+Live catalog updates for POS terminals over Server-Sent Events.
+
+Every transaction that changes products NOTIFYs services.CATALOG_CHANNEL
+on commit (see services.notify_catalog_change). Each worker process holds
+one dedicated LISTEN connection, started with its first subscriber, and
+fans the payloads out to the terminals connected to GET /api/events.
+
+A terminal that falls behind (a full queue, or a listener reconnect during
+which notifications may have been lost) is sent {"resync": true} and
+catches up through /api/products?since=. Every stream holds a worker
+thread, so their number per process is capped by EVENTS_MAX_CLIENTS (see
+serve.py); over the cap the route answers 503 and terminals fall back to
+refetching after checkout.
+"""
+import json
+import logging
+import os
+import queue
+import select
+import threading
+import time
+import psycopg2.extensions
+from flask import Response, stream_with_context
+
+import db
+import services
+from auth import login_required
+
+MAX_CLIENTS = int(os.environ.get('EVENTS_MAX_CLIENTS', 16))
+KEEPALIVE_SECONDS = 15
+QUEUE_SIZE = 100
+RECONNECT_SECONDS = 2
+RESYNC = json.dumps({'resync': True})
+
+log = logging.getLogger('pos.events')
+
+
+class Broadcaster:
+    """Fans messages out to per-subscriber bounded queues."""
+
+    def __init__(self, max_clients=MAX_CLIENTS):
+        self.max_clients = max_clients
+        self._subscribers = set()
+        self._lock = threading.Lock()
+
+    def subscribe(self):
+        """A new queue receiving every later message, or None when full."""
+        with self._lock:
+            if len(self._subscribers) >= self.max_clients:
+                return None
+            q = queue.Queue(QUEUE_SIZE)
+            self._subscribers.add(q)
+            return q
+
+    def unsubscribe(self, q):
+        with self._lock:
+            self._subscribers.discard(q)
+
+    def publish(self, message):
+        with self._lock:
+            subscribers = list(self._subscribers)
+        for q in subscribers:
+            try:
+                q.put_nowait(message)
+            except queue.Full:
+                # Too slow to keep up: drop its backlog, it refetches instead
+                with q.mutex:
+                    q.queue.clear()
+                q.put_nowait(RESYNC)
+
+    def __len__(self):
+        return len(self._subscribers)
+
+
+broadcaster = Broadcaster()
+
+
+class Listener(threading.Thread):
+    """LISTENs on a dedicated connection and publishes each payload."""
+
+    def __init__(self, target, channel=services.CATALOG_CHANNEL):
+        super().__init__(name='catalog-listener', daemon=True)
+        self.target = target
+        self.channel = channel
+
+    def run(self):
+        while True:
+            conn = None
+            try:
+                conn = db.get_db_connection()
+                conn.set_isolation_level(psycopg2.extensions.ISOLATION_LEVEL_AUTOCOMMIT)
+                conn.cursor().execute(f"LISTEN {self.channel}")
+                # Anything committed while we were not listening is lost
+                self.target.publish(RESYNC)
+                self.listen(conn)
+            except Exception as e:
+                log.warning("Catalog listener disconnected: %s", e)
+            finally:
+                if conn is not None:
+                    conn.close()
+            time.sleep(RECONNECT_SECONDS)
+
+    def listen(self, conn):
+        while True:
+            if select.select([conn], [], [], KEEPALIVE_SECONDS) == ([], [], []):
+                continue
+            conn.poll()
+            while conn.notifies:
+                self.target.publish(conn.notifies.pop(0).payload)
+
+
+_listener = None
+_listener_lock = threading.Lock()
+
+def ensure_listener():
+    """Starts this process's listener on first use (i.e. after any fork)."""
+    global _listener
+    if _listener is None:
+        with _listener_lock:
+            if _listener is None:
+                _listener = Listener(broadcaster)
+                _listener.start()
+    return _listener
+
+def stream(q):
+    """SSE frames for the messages on `q`, with keep-alive comments."""
+    try:
+        yield f"retry: {RECONNECT_SECONDS * 1000}\n\n"
+        while True:
+            try:
+                message = q.get(timeout=KEEPALIVE_SECONDS)
+            except queue.Empty:
+                yield ": keep-alive\n\n"
+                continue
+            yield f"data: {message}\n\n"
+    finally:
+        broadcaster.unsubscribe(q)
+
+@login_required
+def catalog_events():
+    ensure_listener()
+    q = broadcaster.subscribe()
+    if q is None:
+        return Response("Too many event streams", status=503, headers={'Retry-After': '30'})
+    response = Response(stream_with_context(stream(q)), mimetype='text/event-stream')
+    response.headers['Cache-Control'] = 'no-cache'
+    # Keep reverse proxies from buffering the stream
+    response.headers['X-Accel-Buffering'] = 'no'
+    return response
+
+def init_app(app):
+    """Registers GET /api/events."""
+    app.add_url_rule('/api/events', 'api_events', catalog_events)
@@ -0,0 +1,214 @@
+"""
+Product image storage.
+
+Uploads are stored once under their SHA-256 (so re-uploading a file reuses
+it and nothing is ever overwritten) and served from /media/ with immutable
+cache headers, since a URL can never change content. Thumbnails are made
+by a background thread pool right after upload; a thumbnail requested
+before it is ready is generated on the spot. Without Pillow installed,
+uploads are accepted by extension and thumbnail URLs serve the original.
+
+    media/<aa>/<sha256>.<ext>              original
+    media/thumbs/<sha256>-<width>.<fmt>    thumbnail, fmt webp or jpg
+"""
+import hashlib
+import logging
+import os
+import re
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from flask import abort, current_app, redirect, send_from_directory
+
+THUMB_WIDTHS = (200, 400)
+THUMB_FORMATS = {'webp': 'WEBP', 'jpg': 'JPEG'}
+THUMB_QUALITY = 80
+WORKERS = int(os.environ.get('IMAGE_WORKERS', 2))
+CACHE_MAX_AGE = 365 * 24 * 3600
+ALLOWED_EXTENSIONS = {'jpg', 'jpeg', 'png', 'gif', 'webp'}
+PIL_EXTENSIONS = {'JPEG': 'jpg', 'PNG': 'png', 'GIF': 'gif', 'WEBP': 'webp'}
+CHUNK_SIZE = 64 * 1024
+
+_MEDIA_URL_RE = re.compile(r'^/media/([0-9a-f]{64})\.([a-z]+)$')
+_THUMB_NAME_RE = re.compile(r'^([0-9a-f]{64})-(\d+)\.([a-z]+)$')
+_DIGEST_RE = re.compile(r'^[0-9a-f]{64}$')
+
+log = logging.getLogger('pos.images')
+
+try:
+    from PIL import Image, ImageOps
+except ImportError:  # optional; see module docstring
+    Image = None
+
+
+def media_root():
+    return current_app.config['MEDIA_FOLDER']
+
+def original_path(root, digest, ext):
+    return os.path.join(root, digest[:2], f"{digest}.{ext}")
+
+def thumbnail_path(root, digest, width, fmt):
+    return os.path.join(root, 'thumbs', f"{digest}-{width}.{fmt}")
+
+def _detect_extension(path, filename):
+    """Image type of the file at `path`; ValueError if it is not an image we accept."""
+    if Image is not None:
+        try:
+            with Image.open(path) as im:
+                im.verify()
+                ext = PIL_EXTENSIONS.get(im.format)
+        except Exception:
+            ext = None
+        if ext is None:
+            raise ValueError("Unsupported image file.")
+        return ext
+
+    ext = filename.rsplit('.', 1)[-1].lower() if '.' in filename else ''
+    if ext not in ALLOWED_EXTENSIONS:
+        raise ValueError("Unsupported image file.")
+    return 'jpg' if ext == 'jpeg' else ext
+
+def store_upload(upload, root=None):
+    """
+    Saves an uploaded FileStorage by content hash and queues its
+    thumbnails. Returns the image URL. Streams to disk while hashing, so
+    the upload is never held in memory.
+    """
+    root = root or media_root()
+    os.makedirs(root, exist_ok=True)
+    sha = hashlib.sha256()
+    fd, tmp_path = tempfile.mkstemp(dir=root, suffix='.upload')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            for chunk in iter(lambda: upload.stream.read(CHUNK_SIZE), b''):
+                sha.update(chunk)
+                f.write(chunk)
+
+        digest = sha.hexdigest()
+        ext = _detect_extension(tmp_path, upload.filename or '')
+        path = original_path(root, digest, ext)
+        if os.path.exists(path):
+            os.remove(tmp_path)
+        else:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+    schedule_thumbnails(root, digest, ext)
+    return f"/media/{digest}.{ext}"
+
+def make_thumbnail(root, digest, ext, width, fmt):
+    """Writes one thumbnail (atomically) unless it exists. Returns its path."""
+    path = thumbnail_path(root, digest, width, fmt)
+    if os.path.exists(path):
+        return path
+
+    with Image.open(original_path(root, digest, ext)) as im:
+        im = ImageOps.exif_transpose(im)
+        im.thumbnail((width, width))
+        if fmt == 'jpg' and im.mode != 'RGB':
+            # JPEG has no alpha; flatten onto white
+            background = Image.new('RGB', im.size, (255, 255, 255))
+            im = im.convert('RGBA')
+            background.paste(im, mask=im.getchannel('A'))
+            im = background
+        elif im.mode not in ('RGB', 'RGBA'):
+            im = im.convert('RGBA')
+
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                im.save(f, THUMB_FORMATS[fmt], quality=THUMB_QUALITY)
+            os.replace(tmp_path, path)
+        except BaseException:
+            os.remove(tmp_path)
+            raise
+    return path
+
+def make_thumbnails(root, digest, ext):
+    for width in THUMB_WIDTHS:
+        for fmt in THUMB_FORMATS:
+            try:
+                make_thumbnail(root, digest, ext, width, fmt)
+            except Exception:
+                log.exception("Thumbnail %s-%s.%s failed", digest, width, fmt)
+
+_executor = None
+_executor_lock = threading.Lock()
+
+def get_executor():
+    """Process-wide thumbnail pool, created on first use (i.e. after any fork)."""
+    global _executor
+    if _executor is None:
+        with _executor_lock:
+            if _executor is None:
+                _executor = ThreadPoolExecutor(max_workers=WORKERS, thread_name_prefix='thumbnails')
+    return _executor
+
+def schedule_thumbnails(root, digest, ext):
+    if Image is None:
+        return None
+    return get_executor().submit(make_thumbnails, root, digest, ext)
+
+def thumbnail_urls(image_url, width=400):
+    """
+    {'thumbnail_url', 'thumbnail_jpeg_url'} for a product image. Images not
+    stored here (placeholders, legacy uploads) are returned unchanged.
+    """
+    match = _MEDIA_URL_RE.match(image_url or '')
+    if not match or Image is None:
+        return {'thumbnail_url': image_url, 'thumbnail_jpeg_url': image_url}
+    digest = match.group(1)
+    return {
+        'thumbnail_url': f"/media/thumbs/{digest}-{width}.webp",
+        'thumbnail_jpeg_url': f"/media/thumbs/{digest}-{width}.jpg",
+    }
+
+
+def _immutable(response):
+    response.cache_control.public = True
+    response.cache_control.max_age = CACHE_MAX_AGE
+    response.cache_control.immutable = True
+    return response
+
+def _find_original(root, digest):
+    directory = os.path.join(root, digest[:2])
+    if os.path.isdir(directory):
+        for name in os.listdir(directory):
+            if name.startswith(digest + '.'):
+                return name.rsplit('.', 1)[1]
+    return None
+
+def serve_original(digest, ext):
+    if not _DIGEST_RE.match(digest) or ext not in ALLOWED_EXTENSIONS:
+        abort(404)
+    root = media_root()
+    return _immutable(send_from_directory(os.path.join(root, digest[:2]), f"{digest}.{ext}"))
+
+def serve_thumbnail(name):
+    match = _THUMB_NAME_RE.match(name)
+    if not match or int(match.group(2)) not in THUMB_WIDTHS or match.group(3) not in THUMB_FORMATS:
+        abort(404)
+    digest, width, fmt = match.group(1), int(match.group(2)), match.group(3)
+    root = media_root()
+
+    if not os.path.exists(thumbnail_path(root, digest, width, fmt)):
+        ext = _find_original(root, digest)
+        if ext is None:
+            abort(404)
+        if Image is None:
+            return redirect(f"/media/{digest}.{ext}")
+        # Not made yet (upload moments ago, or pool backlog): make it now
+        make_thumbnail(root, digest, ext, width, fmt)
+
+    return _immutable(send_from_directory(os.path.join(root, 'thumbs'), name))
+
+def init_app(app):
+    """Registers the /media/ routes; MEDIA_FOLDER defaults to media/ next to the app."""
+    app.config.setdefault('MEDIA_FOLDER', os.path.join(app.root_path, 'media'))
+    app.add_url_rule('/media/<digest>.<ext>', 'media_original', serve_original)
+    app.add_url_rule('/media/thumbs/<name>', 'media_thumbnail', serve_thumbnail)
@@ -0,0 +1,265 @@
+import contextvars
+import logging
+import os
+import re
+import threading
+import time
+from flask import Response, abort, g, request
+
+import audit
+import db
+
+SLOW_QUERY_SECONDS = float(os.environ.get('SLOW_QUERY_MS', 200)) / 1000.0
+SERVER_TIMING = os.environ.get('METRICS_SERVER_TIMING') == '1'
+METRICS_TOKEN = os.environ.get('METRICS_TOKEN')
+# Without a token, /metrics is served to local clients only, as on a desktop
+# terminal. Behind a reverse proxy every request arrives from localhost, so
+# serve.py turns this off under gunicorn: set METRICS_TOKEN there.
+METRICS_LOCAL = os.environ.get('METRICS_LOCAL', '1') == '1'
+FORWARDED_HEADERS = ('Forwarded', 'X-Forwarded-For', 'X-Real-IP')
+MAX_FINGERPRINTS = 500
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+COUNT_BUCKETS = (0, 1, 2, 3, 5, 8, 13, 21, 34, 55, 89)
+POOL_COUNTERS = ('checkouts', 'waits', 'wait_time', 'timeouts', 'connects', 'discarded')
+
+slow_query_log = logging.getLogger('pos.slow_query')
+
+
+class Histogram:
+    """Cumulative histogram in the Prometheus sense. Not locked; see Registry."""
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.count += 1
+        self.sum += value
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+                break
+
+    def cumulative(self):
+        total = 0
+        for bound, count in zip(self.buckets, self.counts):
+            total += count
+            yield bound, total
+
+
+class Registry:
+    """Process-wide metric store: histograms and counters keyed by label tuples."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.histograms = {}   # name -> {labels: Histogram}
+        self.counters = {}     # name -> {labels: float}
+        self.help = {}
+
+    def observe(self, name, labels, value, buckets=LATENCY_BUCKETS):
+        with self._lock:
+            series = self.histograms.setdefault(name, {})
+            hist = series.get(labels)
+            if hist is None:
+                hist = series[labels] = Histogram(buckets)
+            hist.observe(value)
+
+    def inc(self, name, labels, amount=1):
+        with self._lock:
+            series = self.counters.setdefault(name, {})
+            series[labels] = series.get(labels, 0) + amount
+
+    def snapshot(self):
+        with self._lock:
+            histograms = {
+                name: {labels: (list(h.cumulative()), h.sum, h.count) for labels, h in series.items()}
+                for name, series in self.histograms.items()
+            }
+            counters = {name: dict(series) for name, series in self.counters.items()}
+        return histograms, counters
+
+
+registry = Registry()
+registry.help.update({
+    'pos_http_request_duration_seconds': 'Request latency by route.',
+    'pos_http_request_queries': 'Database queries issued per request, by route.',
+    'pos_db_connect_duration_seconds': 'Time to open a new database connection.',
+    'pos_db_query_duration_seconds': 'Query latency by normalized query fingerprint.',
+    'pos_db_slow_queries_total': 'Queries slower than SLOW_QUERY_MS, by fingerprint.',
+})
+
+# Per-request accumulators; None outside a request
+_request_stats = contextvars.ContextVar('request_stats', default=None)
+
+_LITERAL_RE = re.compile(r"'(?:[^']|'')*'")
+_NUMBER_RE = re.compile(r"\b\d+(?:\.\d+)?\b")
+_LIST_RE = re.compile(r"\((?:\s*(?:\?|%s)\s*,)+\s*(?:\?|%s)\s*\)")
+_ROWS_RE = re.compile(r"\(\.\.\.\)(?:\s*,\s*\(\.\.\.\))+")
+_SPACE_RE = re.compile(r"\s+")
+_fingerprints = set()
+
+def fingerprint(sql):
+    """Normalizes a statement so executions that differ only in values group together."""
+    if isinstance(sql, bytes):
+        sql = sql.decode('utf-8', 'replace')
+    sql = _LITERAL_RE.sub('?', str(sql))
+    sql = _NUMBER_RE.sub('?', sql)
+    sql = _SPACE_RE.sub(' ', sql).strip()
+    sql = _LIST_RE.sub('(...)', sql)
+    sql = _ROWS_RE.sub('(...)', sql)  # multi-row VALUES of any length
+    sql = sql[:200]
+
+    # Bound label cardinality; unexpected dynamic SQL must not grow memory
+    if sql not in _fingerprints:
+        if len(_fingerprints) >= MAX_FINGERPRINTS:
+            return 'other'
+        _fingerprints.add(sql)
+    return sql
+
+
+class Instrumentation:
+    """db listener recording connection and query timings into the registry."""
+
+    def on_connect(self, duration):
+        registry.observe('pos_db_connect_duration_seconds', (), duration)
+        stats = _request_stats.get()
+        if stats is not None:
+            stats['connect_time'] += duration
+
+    def on_query(self, sql, duration):
+        fp = fingerprint(sql)
+        registry.observe('pos_db_query_duration_seconds', (('query', fp),), duration)
+
+        stats = _request_stats.get()
+        if stats is not None:
+            stats['queries'] += 1
+            stats['query_time'] += duration
+
+        if duration >= SLOW_QUERY_SECONDS:
+            registry.inc('pos_db_slow_queries_total', (('query', fp),))
+            slow_query_log.warning("slow query %.1fms: %s", duration * 1000, fp)
+
+
+def _before_request():
+    g._metrics_start = time.perf_counter()
+    g._metrics_token = _request_stats.set({'queries': 0, 'query_time': 0.0, 'connect_time': 0.0})
+
+def _record(status):
+    """Records the current request once; (elapsed, stats), or None if it already was."""
+    start = g.pop('_metrics_start', None)
+    if start is None:
+        return None
+
+    elapsed = time.perf_counter() - start
+    stats = _request_stats.get()
+    endpoint = request.endpoint or 'unmatched'
+    if endpoint != 'metrics':
+        labels = (('endpoint', endpoint), ('method', request.method), ('status', str(status)))
+        registry.observe('pos_http_request_duration_seconds', labels, elapsed)
+        registry.observe('pos_http_request_queries', (('endpoint', endpoint),), stats['queries'], COUNT_BUCKETS)
+    return elapsed, stats
+
+def _after_request(response):
+    recorded = _record(response.status_code)
+    if recorded is None:
+        return response
+    elapsed, stats = recorded
+
+    if SERVER_TIMING:
+        response.headers.add(
+            'Server-Timing',
+            'app;dur=%.2f, db;dur=%.2f;desc="%d queries", connect;dur=%.2f' % (
+                elapsed * 1000, stats['query_time'] * 1000, stats['queries'], stats['connect_time'] * 1000
+            )
+        )
+    return response
+
+def _teardown_request(exc):
+    # after_request is skipped when a view's exception propagates (debug,
+    # PROPAGATE_EXCEPTIONS) or another after_request hook fails: a 500
+    _record(500)
+    token = g.pop('_metrics_token', None)
+    if token is not None:
+        _request_stats.reset(token)
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def _labels(labels, extra=()):
+    pairs = list(labels) + list(extra)
+    if not pairs:
+        return ''
+    return '{' + ','.join(f'{k}="{_escape(v)}"' for k, v in pairs) + '}'
+
+def render():
+    """Renders all metrics in the Prometheus text exposition format."""
+    histograms, counters = registry.snapshot()
+    lines = []
+
+    for name, series in sorted(histograms.items()):
+        lines.append(f"# HELP {name} {registry.help.get(name, name)}")
+        lines.append(f"# TYPE {name} histogram")
+        for labels, (buckets, total, count) in sorted(series.items()):
+            for bound, cumulative in buckets:
+                lines.append(f"{name}_bucket{_labels(labels, [('le', bound)])} {cumulative}")
+            lines.append(f"{name}_bucket{_labels(labels, [('le', '+Inf')])} {count}")
+            lines.append(f"{name}_sum{_labels(labels)} {total}")
+            lines.append(f"{name}_count{_labels(labels)} {count}")
+
+    for name, series in sorted(counters.items()):
+        lines.append(f"# HELP {name} {registry.help.get(name, name)}")
+        lines.append(f"# TYPE {name} counter")
+        for labels, value in sorted(series.items()):
+            lines.append(f"{name}{_labels(labels)} {value}")
+
+    pools = {target: db.pool_stats(target) for target in db.TARGETS}
+    for key in sorted(set().union(*pools.values())):
+        if key in POOL_COUNTERS:
+            name = f"pos_db_pool_{key}_total"
+            lines.append(f"# TYPE {name} counter")
+        else:
+            name = f"pos_db_pool_{key}"
+            lines.append(f"# TYPE {name} gauge")
+        for target, stats in sorted(pools.items()):
+            if key in stats:
+                lines.append(f"{name}{_labels([('target', target)])} {stats[key]}")
+
+    lag = db.last_replica_lag()
+    if lag is not None:
+        lines.append("# TYPE pos_db_replica_lag_seconds gauge")
+        lines.append(f"pos_db_replica_lag_seconds {lag}")
+
+    for key, value in sorted(audit.stats().items()):
+        if key in audit.COUNTERS:
+            name = f"pos_audit_{key}_total"
+            lines.append(f"# TYPE {name} counter")
+        else:
+            name = f"pos_audit_{key}"
+            lines.append(f"# TYPE {name} gauge")
+        lines.append(f"{name} {value}")
+
+    return '\n'.join(lines) + '\n'
+
+def metrics():
+    # Scrapers authenticate with METRICS_TOKEN; without one only direct
+    # local requests are served (see METRICS_LOCAL), since fingerprints
+    # reveal the schema. Anything relayed by a proxy is not local.
+    if METRICS_TOKEN:
+        if request.headers.get('Authorization') != f'Bearer {METRICS_TOKEN}':
+            abort(403)
+    elif (not METRICS_LOCAL or request.remote_addr not in ('127.0.0.1', '::1')
+          or any(h in request.headers for h in FORWARDED_HEADERS)):
+        abort(403)
+    return Response(render(), mimetype='text/plain; version=0.0.4')
+
+def init_app(app):
+    """Hooks request timing, query instrumentation and /metrics into `app`."""
+    db.add_listener(Instrumentation())
+    app.before_request(_before_request)
+    app.after_request(_after_request)
+    app.teardown_request(_teardown_request)
+    app.add_url_rule('/metrics', 'metrics', metrics)
@@ -0,0 +1,394 @@
+import psycopg2
+from db import get_db_cursor
+
+# Upgrades for databases created from an older schema.sql, applied in order.
+# Each step is recorded in schema_migrations and runs only once, but should
+# still be idempotent since databases created from a newer schema.sql
+# already have most of it. Rollup tables created here start empty; fill
+# them with rebuild_rollups.py.
+MIGRATIONS = [
+    (
+        "transaction_counters table",
+        """
+        CREATE TABLE IF NOT EXISTS transaction_counters (
+            day DATE PRIMARY KEY,
+            last_seq INT NOT NULL
+        )
+        """
+    ),
+    (
+        "seed transaction_counters from existing orders",
+        """
+        INSERT INTO transaction_counters (day, last_seq)
+        SELECT to_date(split_part(transaction_code, '-', 2), 'YYYYMMDD'),
+               MAX(split_part(transaction_code, '-', 3)::int)
+        FROM orders
+        WHERE transaction_code ~ '^TRX-[0-9]{8}-[0-9]+$'
+        GROUP BY 1
+        ON CONFLICT (day) DO UPDATE
+        SET last_seq = GREATEST(transaction_counters.last_seq, EXCLUDED.last_seq)
+        """
+    ),
+    (
+        "orders listing indexes",
+        """
+        CREATE INDEX IF NOT EXISTS idx_orders_created_at_id ON orders (created_at DESC, id DESC);
+        CREATE INDEX IF NOT EXISTS idx_orders_status_created_at_id ON orders (status, created_at DESC, id DESC);
+        CREATE INDEX IF NOT EXISTS idx_orders_payment_created_at_id ON orders (payment_method, created_at DESC, id DESC);
+        CREATE INDEX IF NOT EXISTS idx_orders_transaction_code_prefix ON orders (transaction_code text_pattern_ops);
+        """
+    ),
+    (
+        "daily_sales_summary table",
+        """
+        CREATE TABLE IF NOT EXISTS daily_sales_summary (
+            day DATE NOT NULL,
+            payment_method VARCHAR(20) NOT NULL,
+            paid_count INT NOT NULL DEFAULT 0,
+            paid_total DECIMAL(15, 0) NOT NULL DEFAULT 0,
+            paid_tax DECIMAL(15, 0) NOT NULL DEFAULT 0,
+            void_count INT NOT NULL DEFAULT 0,
+            void_total DECIMAL(15, 0) NOT NULL DEFAULT 0,
+            void_tax DECIMAL(15, 0) NOT NULL DEFAULT 0,
+            PRIMARY KEY (day, payment_method)
+        )
+        """
+    ),
+    (
+        "catalog versioning",
+        """
+        ALTER TABLE products ADD COLUMN IF NOT EXISTS version BIGINT NOT NULL DEFAULT 0;
+        CREATE INDEX IF NOT EXISTS idx_products_version ON products (version);
+        CREATE TABLE IF NOT EXISTS catalog_state (
+            id BOOLEAN PRIMARY KEY DEFAULT TRUE CHECK (id),
+            version BIGINT NOT NULL
+        );
+        INSERT INTO catalog_state (version) VALUES (0) ON CONFLICT (id) DO NOTHING;
+        CREATE TABLE IF NOT EXISTS product_tombstones (
+            product_id INT PRIMARY KEY,
+            version BIGINT NOT NULL
+        );
+        """
+    ),
+    (
+        "order_items.product_id",
+        """
+        ALTER TABLE order_items
+            ADD COLUMN IF NOT EXISTS product_id INT REFERENCES products(id) ON DELETE SET NULL;
+        CREATE INDEX IF NOT EXISTS idx_order_items_order_id ON order_items (order_id);
+        CREATE INDEX IF NOT EXISTS idx_order_items_product_id ON order_items (product_id);
+        """
+    ),
+    (
+        "backfill order_items.product_id by product name",
+        # Only names that identify exactly one current product are matched;
+        # lines of deleted or ambiguously named products stay NULL.
+        """
+        UPDATE order_items AS i
+        SET product_id = p.id
+        FROM (
+            SELECT name, MIN(id) AS id FROM products GROUP BY name HAVING COUNT(*) = 1
+        ) AS p
+        WHERE i.product_id IS NULL AND i.product_name_snapshot = p.name
+        """
+    ),
+    (
+        "products name index",
+        "CREATE INDEX IF NOT EXISTS idx_products_name ON products (name)"
+    ),
+    (
+        "orders.idempotency_key",
+        """
+        DO $$
+        BEGIN
+            -- Partitioned orders keep their keys in order_idempotency_keys
+            IF EXISTS (SELECT 1 FROM pg_partitioned_table WHERE partrelid = 'orders'::regclass) THEN
+                RETURN;
+            END IF;
+            ALTER TABLE orders ADD COLUMN IF NOT EXISTS idempotency_key VARCHAR(64);
+            IF NOT EXISTS (SELECT 1 FROM pg_constraint WHERE conname = 'orders_idempotency_key_key') THEN
+                ALTER TABLE orders ADD CONSTRAINT orders_idempotency_key_key UNIQUE (idempotency_key);
+            END IF;
+        END $$;
+        """
+    ),
+    (
+        "tax_rules and orders.discount_amount",
+        """
+        CREATE TABLE IF NOT EXISTS tax_rules (
+            category VARCHAR(50) PRIMARY KEY,
+            rate DECIMAL(6, 4) NOT NULL CHECK (rate >= 0 AND rate < 1),
+            inclusive BOOLEAN NOT NULL DEFAULT FALSE
+        );
+        ALTER TABLE orders ADD COLUMN IF NOT EXISTS discount_amount DECIMAL(15, 0) NOT NULL DEFAULT 0;
+        """
+    ),
+    (
+        "analytics aggregates",
+        """
+        ALTER TABLE order_items ADD COLUMN IF NOT EXISTS discount_amount DECIMAL(15, 0) NOT NULL DEFAULT 0;
+        CREATE TABLE IF NOT EXISTS hourly_sales_summary (
+            day DATE NOT NULL,
+            hour SMALLINT NOT NULL,
+            order_count INT NOT NULL DEFAULT 0,
+            total DECIMAL(15, 0) NOT NULL DEFAULT 0,
+            PRIMARY KEY (day, hour)
+        );
+        CREATE TABLE IF NOT EXISTS daily_product_sales (
+            day DATE NOT NULL,
+            product_id INT NOT NULL,
+            product_name VARCHAR(100) NOT NULL,
+            quantity INT NOT NULL DEFAULT 0,
+            revenue DECIMAL(15, 0) NOT NULL DEFAULT 0,
+            PRIMARY KEY (day, product_id)
+        );
+        """
+    ),
+    (
+        "partition orders and order_items by month",
+        # Rewrites both tables in one transaction, which blocks checkouts
+        # while it runs; schedule it outside business hours. Order lines
+        # without an order are dropped. Sequences are kept so ids continue.
+        # Skipped when orders is already partitioned (newer schema.sql).
+        """
+        CREATE OR REPLACE FUNCTION ensure_order_partitions(first_month DATE, last_month DATE) RETURNS INT AS $$
+        DECLARE
+            month DATE := date_trunc('month', first_month);
+            suffix TEXT;
+            created INT := 0;
+        BEGIN
+            WHILE month <= last_month LOOP
+                suffix := to_char(month, 'YYYYMM');
+                IF to_regclass('orders_p' || suffix) IS NULL THEN
+                    EXECUTE format('CREATE TABLE %I PARTITION OF orders FOR VALUES FROM (%L) TO (%L)',
+                                   'orders_p' || suffix, month, (month + interval '1 month')::date);
+                    created := created + 1;
+                END IF;
+                IF to_regclass('order_items_p' || suffix) IS NULL THEN
+                    EXECUTE format('CREATE TABLE %I PARTITION OF order_items FOR VALUES FROM (%L) TO (%L)',
+                                   'order_items_p' || suffix, month, (month + interval '1 month')::date);
+                END IF;
+                month := (month + interval '1 month')::date;
+            END LOOP;
+            RETURN created;
+        END;
+        $$ LANGUAGE plpgsql;
+
+        DO $migrate$
+        DECLARE
+            idx RECORD;
+        BEGIN
+            IF EXISTS (SELECT 1 FROM pg_partitioned_table WHERE partrelid = 'orders'::regclass) THEN
+                RETURN;
+            END IF;
+
+            ALTER TABLE order_items RENAME TO order_items_unpartitioned;
+            ALTER TABLE orders RENAME TO orders_unpartitioned;
+            FOR idx IN SELECT indexname FROM pg_indexes
+                       WHERE schemaname = current_schema()
+                         AND tablename IN ('orders_unpartitioned', 'order_items_unpartitioned') LOOP
+                EXECUTE format('ALTER INDEX %I RENAME TO %I', idx.indexname, left(idx.indexname, 48) || '_unpartitioned');
+            END LOOP;
+
+            CREATE TABLE orders (
+                id INT NOT NULL DEFAULT nextval('orders_id_seq'),
+                transaction_code VARCHAR(50) NOT NULL,
+                total_amount DECIMAL(15, 0) NOT NULL,
+                tax_amount DECIMAL(15, 0) NOT NULL,
+                discount_amount DECIMAL(15, 0) NOT NULL DEFAULT 0,
+                payment_method VARCHAR(20) NOT NULL,
+                created_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+                status VARCHAR(20) DEFAULT 'paid' CHECK (status IN ('paid', 'void')),
+                PRIMARY KEY (id, created_at)
+            ) PARTITION BY RANGE (created_at);
+            CREATE TABLE order_idempotency_keys (
+                idempotency_key VARCHAR(64) NOT NULL,
+                order_id INT NOT NULL,
+                order_created_at TIMESTAMP NOT NULL,
+                CONSTRAINT orders_idempotency_key_key PRIMARY KEY (idempotency_key)
+            );
+            CREATE TABLE order_items (
+                id INT NOT NULL DEFAULT nextval('order_items_id_seq'),
+                order_id INT NOT NULL,
+                order_created_at TIMESTAMP NOT NULL,
+                product_id INT REFERENCES products(id) ON DELETE SET NULL,
+                product_name_snapshot VARCHAR(100) NOT NULL,
+                price_snapshot DECIMAL(15, 0) NOT NULL,
+                quantity INT NOT NULL,
+                subtotal DECIMAL(15, 0) NOT NULL,
+                discount_amount DECIMAL(15, 0) NOT NULL DEFAULT 0,
+                PRIMARY KEY (id, order_created_at),
+                FOREIGN KEY (order_id, order_created_at) REFERENCES orders (id, created_at)
+            ) PARTITION BY RANGE (order_created_at);
+
+            PERFORM ensure_order_partitions(
+                COALESCE((SELECT MIN(created_at) FROM orders_unpartitioned)::date, CURRENT_DATE),
+                GREATEST((SELECT MAX(created_at) FROM orders_unpartitioned)::date,
+                         (CURRENT_DATE + interval '3 months')::date)
+            );
+
+            INSERT INTO orders (id, transaction_code, total_amount, tax_amount, discount_amount,
+                                payment_method, created_at, status)
+            SELECT id, transaction_code, total_amount, tax_amount, discount_amount,
+                   payment_method, COALESCE(created_at, CURRENT_TIMESTAMP), status
+            FROM orders_unpartitioned;
+            INSERT INTO order_idempotency_keys (idempotency_key, order_id, order_created_at)
+            SELECT idempotency_key, id, COALESCE(created_at, CURRENT_TIMESTAMP)
+            FROM orders_unpartitioned
+            WHERE idempotency_key IS NOT NULL;
+            INSERT INTO order_items (id, order_id, order_created_at, product_id, product_name_snapshot,
+                                     price_snapshot, quantity, subtotal, discount_amount)
+            SELECT i.id, i.order_id, COALESCE(o.created_at, CURRENT_TIMESTAMP), i.product_id, i.product_name_snapshot,
+                   i.price_snapshot, i.quantity, i.subtotal, i.discount_amount
+            FROM order_items_unpartitioned i
+            JOIN orders_unpartitioned o ON o.id = i.order_id;
+
+            ALTER SEQUENCE orders_id_seq OWNED BY orders.id;
+            ALTER SEQUENCE order_items_id_seq OWNED BY order_items.id;
+            DROP TABLE order_items_unpartitioned;
+            DROP TABLE orders_unpartitioned;
+
+            CREATE INDEX idx_orders_created_at_id ON orders (created_at DESC, id DESC);
+            CREATE INDEX idx_orders_status_created_at_id ON orders (status, created_at DESC, id DESC);
+            CREATE INDEX idx_orders_payment_created_at_id ON orders (payment_method, created_at DESC, id DESC);
+            CREATE INDEX idx_orders_transaction_code_prefix ON orders (transaction_code text_pattern_ops);
+            CREATE INDEX idx_order_items_order_id ON order_items (order_id) INCLUDE (product_id, quantity);
+            CREATE INDEX idx_order_items_product_id ON order_items (product_id);
+        END $migrate$;
+        """
+    ),
+    (
+        "audit_log table",
+        """
+        CREATE TABLE IF NOT EXISTS audit_log (
+            id BIGSERIAL PRIMARY KEY,
+            occurred_at TIMESTAMP NOT NULL,
+            event VARCHAR(40) NOT NULL,
+            entity_id BIGINT,
+            user_id INT,
+            username VARCHAR(50),
+            remote_addr VARCHAR(45),
+            payload JSONB
+        );
+
+        CREATE INDEX IF NOT EXISTS idx_audit_log_event_id ON audit_log (event, id DESC);
+        CREATE INDEX IF NOT EXISTS idx_audit_log_user_id ON audit_log (user_id, id DESC);
+        CREATE INDEX IF NOT EXISTS idx_audit_log_entity_id ON audit_log (entity_id, id DESC);
+        CREATE INDEX IF NOT EXISTS idx_audit_log_occurred_at ON audit_log USING brin (occurred_at);
+        """
+    ),
+    (
+        "product search indexes and products.barcode",
+        """
+        CREATE EXTENSION IF NOT EXISTS pg_trgm;
+        ALTER TABLE products ADD COLUMN IF NOT EXISTS barcode VARCHAR(64);
+        CREATE UNIQUE INDEX IF NOT EXISTS idx_products_barcode ON products (barcode) WHERE barcode IS NOT NULL;
+        CREATE INDEX IF NOT EXISTS idx_products_name_prefix ON products (lower(name) text_pattern_ops);
+        CREATE INDEX IF NOT EXISTS idx_products_name_trgm ON products USING gin (lower(name) gin_trgm_ops);
+        """
+    ),
+    (
+        "cashier shifts",
+        """
+        CREATE TABLE IF NOT EXISTS shifts (
+            id SERIAL PRIMARY KEY,
+            cashier_id INT NOT NULL REFERENCES users(id),
+            opened_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+            closed_at TIMESTAMP,
+            opening_float DECIMAL(15, 0) NOT NULL DEFAULT 0,
+            counted_cash DECIMAL(15, 0),
+            z_report JSONB
+        );
+        CREATE UNIQUE INDEX IF NOT EXISTS idx_shifts_open_cashier ON shifts (cashier_id) WHERE closed_at IS NULL;
+        CREATE INDEX IF NOT EXISTS idx_shifts_opened_at ON shifts (opened_at);
+
+        ALTER TABLE orders ADD COLUMN IF NOT EXISTS cashier_id INT REFERENCES users(id) ON DELETE SET NULL;
+        ALTER TABLE orders ADD COLUMN IF NOT EXISTS shift_id INT REFERENCES shifts(id);
+
+        CREATE TABLE IF NOT EXISTS shift_totals (
+            shift_id INT NOT NULL REFERENCES shifts(id),
+            payment_method VARCHAR(20) NOT NULL,
+            paid_count INT NOT NULL DEFAULT 0,
+            paid_total DECIMAL(15, 0) NOT NULL DEFAULT 0,
+            paid_tax DECIMAL(15, 0) NOT NULL DEFAULT 0,
+            void_count INT NOT NULL DEFAULT 0,
+            void_total DECIMAL(15, 0) NOT NULL DEFAULT 0,
+            void_tax DECIMAL(15, 0) NOT NULL DEFAULT 0,
+            PRIMARY KEY (shift_id, payment_method)
+        );
+        """
+    ),
+    (
+        "ensure_order_partitions without creation races",
+        """
+        CREATE OR REPLACE FUNCTION ensure_order_partitions(first_month DATE, last_month DATE) RETURNS INT AS $$
+        DECLARE
+            month DATE := date_trunc('month', first_month);
+            suffix TEXT;
+            created INT := 0;
+        BEGIN
+            -- Concurrent callers would race to create the same tables: one does
+            -- the work, the others return NULL at once instead of waiting
+            IF NOT pg_try_advisory_xact_lock(hashtext('ensure_order_partitions')) THEN
+                RETURN NULL;
+            END IF;
+            WHILE month <= last_month LOOP
+                suffix := to_char(month, 'YYYYMM');
+                IF to_regclass('orders_p' || suffix) IS NULL THEN
+                    BEGIN
+                        EXECUTE format('CREATE TABLE %I PARTITION OF orders FOR VALUES FROM (%L) TO (%L)',
+                                       'orders_p' || suffix, month, (month + interval '1 month')::date);
+                        created := created + 1;
+                    EXCEPTION WHEN duplicate_table THEN
+                        NULL;
+                    END;
+                END IF;
+                IF to_regclass('order_items_p' || suffix) IS NULL THEN
+                    BEGIN
+                        EXECUTE format('CREATE TABLE %I PARTITION OF order_items FOR VALUES FROM (%L) TO (%L)',
+                                       'order_items_p' || suffix, month, (month + interval '1 month')::date);
+                    EXCEPTION WHEN duplicate_table THEN
+                        NULL;
+                    END;
+                END IF;
+                month := (month + interval '1 month')::date;
+            END LOOP;
+            RETURN created;
+        END;
+        $$ LANGUAGE plpgsql;
+        """
+    ),
+]
+
+def migrate():
+    print("Migrating Database...")
+
+    try:
+        with get_db_cursor(commit=True) as cur:
+            cur.execute(
+                """
+                CREATE TABLE IF NOT EXISTS schema_migrations (
+                    name VARCHAR(100) PRIMARY KEY,
+                    applied_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+                )
+                """
+            )
+            cur.execute("SELECT name FROM schema_migrations")
+            applied = {row['name'] for row in cur.fetchall()}
+
+            for name, sql in MIGRATIONS:
+                if name in applied:
+                    continue
+                cur.execute(sql)
+                cur.execute("INSERT INTO schema_migrations (name) VALUES (%s)", (name,))
+                print(f"Applied: {name}")
+        print("Migration complete.")
+
+    except psycopg2.OperationalError as e:
+        print(f"Error connecting to database: {e}")
+        print("Ensure PostgreSQL is running and credentials in db.py are correct.")
+    except Exception as e:
+        print(f"An error occurred: {e}")
+
+if __name__ == "__main__":
+    migrate()
@@ -0,0 +1,168 @@
+"""
+Money and cart pricing shared by checkout, the POS preview (/api/price)
+and anything else that needs order totals.
+
+Amounts are whole rupiah held as Decimal, so arithmetic is exact and only
+the final per-rate tax amounts (and percent discounts) are rounded, with
+PRICING_ROUNDING (default 'down', i.e. truncation as before).
+
+A PriceBook maps product ids to their price and tax rule once, so a cart
+is priced in one pass without touching the database.
+
+Cashiers may take at most PRICING_CASHIER_MAX_DISCOUNT percent (default
+20) off a cart in total; admins are not limited (see discount_limit).
+"""
+import os
+from collections import namedtuple
+from decimal import Decimal, InvalidOperation, ROUND_DOWN, ROUND_HALF_EVEN, ROUND_HALF_UP, ROUND_UP
+
+DEFAULT_TAX_RATE = Decimal('0.10')
+
+ROUNDING_MODES = {
+    'down': ROUND_DOWN,
+    'up': ROUND_UP,
+    'half_up': ROUND_HALF_UP,
+    'half_even': ROUND_HALF_EVEN,
+}
+ROUNDING = ROUNDING_MODES[os.environ.get('PRICING_ROUNDING', 'down')]
+CASHIER_MAX_DISCOUNT = Decimal(os.environ.get('PRICING_CASHIER_MAX_DISCOUNT', 20))
+
+ZERO = Decimal(0)
+ONE = Decimal(1)
+HUNDRED = Decimal(100)
+# Largest amount the DECIMAL(15, 0) money columns hold
+MAX_MONEY = Decimal(10 ** 15 - 1)
+
+# Per-product pricing data; `inclusive` means the price already contains the tax
+PriceEntry = namedtuple('PriceEntry', 'price rate inclusive')
+
+
+def to_money(value, rounding=None):
+    """Rounds to whole rupiah with the configured (or given) rounding mode; ValueError if out of range."""
+    try:
+        return Decimal(value).quantize(ONE, rounding=rounding or ROUNDING)
+    except InvalidOperation:
+        raise ValueError("Amount out of range.")
+
+def tax_for(amount, rate=DEFAULT_TAX_RATE, inclusive=False, rounding=None):
+    """Tax on `amount`; for tax-inclusive amounts, the tax part contained in it."""
+    amount = Decimal(amount)
+    if inclusive:
+        return to_money(amount * rate / (ONE + rate), rounding)
+    return to_money(amount * rate, rounding)
+
+def build_price_book(products, tax_rules=None):
+    """
+    Precomputes {product_id: PriceEntry} from product rows (id, price,
+    category) and {category: (rate, inclusive)}. Categories without a rule
+    use DEFAULT_TAX_RATE, exclusive.
+    """
+    tax_rules = tax_rules or {}
+    default = (DEFAULT_TAX_RATE, False)
+    book = {}
+    for p in products:
+        rate, inclusive = tax_rules.get(p.get('category'), default)
+        book[p['id']] = PriceEntry(Decimal(p['price']), Decimal(rate), bool(inclusive))
+    return book
+
+def parse_discount(spec):
+    """
+    Validates a discount given as {"type": "percent"|"amount", "value": n}.
+    Returns (type, Decimal value) or None; raises ValueError if malformed.
+    """
+    if not spec:
+        return None
+    if not isinstance(spec, dict) or spec.get('type') not in ('percent', 'amount'):
+        raise ValueError("Invalid discount.")
+    try:
+        # str() so a JSON float like 12.5 is taken at face value
+        value = Decimal(str(spec.get('value')))
+    except InvalidOperation:
+        raise ValueError("Invalid discount.")
+    if not value.is_finite() or value < 0 or value > (HUNDRED if spec['type'] == 'percent' else MAX_MONEY):
+        raise ValueError("Invalid discount.")
+    return spec['type'], value
+
+def discount_limit(role):
+    """The largest total discount, in percent of the cart, `role` may give; None for no limit."""
+    return None if role == 'admin' else CASHIER_MAX_DISCOUNT
+
+def _discount_amount(base, discount, rounding):
+    if discount is None or base <= 0:
+        return ZERO
+    kind, value = discount
+    amount = to_money(base * value / HUNDRED, rounding) if kind == 'percent' else to_money(value, ROUND_DOWN)
+    return min(amount, base)
+
+def _allocate(amount, weights):
+    """Splits whole-rupiah `amount` across `weights` proportionally, exactly (largest remainder)."""
+    total = sum(weights)
+    if not amount or not total:
+        return [ZERO] * len(weights)
+    shares = [amount * w // total for w in weights]
+    remainder = int(amount - sum(shares))
+    by_fraction = sorted(range(len(weights)), key=lambda i: (amount * weights[i]) % total, reverse=True)
+    for i in by_fraction[:remainder]:
+        shares[i] += 1
+    return shares
+
+def price_cart(book, quantities, line_discounts=None, discount=None, rounding=None, max_discount_percent=None):
+    """
+    Prices a cart given as {product_id: quantity} against a PriceBook.
+
+    `line_discounts` maps product ids to parsed discounts on that line and
+    `discount` is a parsed discount on the whole order, spread over the
+    lines in proportion to their amounts so each is taxed at its own rate.
+    Tax is rounded once per distinct rate, not per line. With
+    `max_discount_percent`, carts whose discounts add up to more than that
+    share of the subtotal are refused.
+
+    Returns {'lines', 'subtotal', 'discount', 'tax', 'total'} in Decimal,
+    where subtotal is before discounts and total is what the customer pays.
+    Raises ValueError for unknown products and refused discounts.
+    """
+    rounding = rounding or ROUNDING
+    line_discounts = line_discounts or {}
+
+    lines = []
+    for product_id, qty in quantities.items():
+        entry = book.get(product_id)
+        if entry is None:
+            raise ValueError(f"Product ID {product_id} not found.")
+        gross = entry.price * qty
+        lines.append({
+            'id': product_id,
+            'quantity': qty,
+            'unit_price': entry.price,
+            'subtotal': gross,
+            'discount': _discount_amount(gross, line_discounts.get(product_id), rounding),
+            'entry': entry,
+        })
+
+    nets = [line['subtotal'] - line['discount'] for line in lines]
+    order_discount = _discount_amount(sum(nets, ZERO), discount, rounding)
+    groups = {}
+    for line, net, share in zip(lines, nets, _allocate(order_discount, nets)):
+        line['discount'] += share
+        entry = line.pop('entry')
+        key = (entry.rate, entry.inclusive)
+        groups[key] = groups.get(key, ZERO) + net - share
+
+    tax = exclusive_tax = ZERO
+    for (rate, inclusive), amount in groups.items():
+        group_tax = tax_for(amount, rate, inclusive, rounding)
+        tax += group_tax
+        if not inclusive:
+            exclusive_tax += group_tax
+
+    subtotal = sum((line['subtotal'] for line in lines), ZERO)
+    discount_total = sum((line['discount'] for line in lines), ZERO)
+    if max_discount_percent is not None and discount_total * HUNDRED > subtotal * max_discount_percent:
+        raise ValueError(f"Discount exceeds the {max_discount_percent}% allowed.")
+    return {
+        'lines': lines,
+        'subtotal': subtotal,
+        'discount': discount_total,
+        'tax': tax,
+        'total': subtotal - discount_total + exclusive_tax,
+    }
@@ -0,0 +1,41 @@
+import argparse
+import datetime
+import psycopg2
+from db import get_db_cursor
+import analytics
+import services
+import shifts
+
+def rebuild_rollups(date_from=None, date_to=None):
+    print("Rebuilding rollups...")
+
+    try:
+        with get_db_cursor(commit=True) as cur:
+            if date_from is None:
+                # Days before the oldest remaining order may have been
+                # archived (archive_orders.py); their rollups are all that
+                # is left of them, so never rebuild those.
+                cur.execute("SELECT MIN(created_at)::date AS first_day FROM orders")
+                date_from = cur.fetchone()['first_day'] or datetime.date.today()
+                print(f"Rebuilding from {date_from}.")
+            rows = services.rebuild_daily_sales_summary(cur, date_from, date_to)
+            print(f"daily_sales_summary: {rows} rows.")
+            for table, rows in analytics.rebuild(cur, date_from, date_to).items():
+                print(f"{table}: {rows} rows.")
+            rows = shifts.rebuild(cur, date_from, date_to)
+            print(f"shift_totals: {rows} rows.")
+
+    except psycopg2.OperationalError as e:
+        print(f"Error connecting to database: {e}")
+        print("Ensure PostgreSQL is running and credentials in db.py are correct.")
+    except Exception as e:
+        print(f"An error occurred: {e}")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Recompute reporting rollups from orders.")
+    parser.add_argument('--from', dest='date_from', type=datetime.date.fromisoformat,
+                        help="first day to rebuild (YYYY-MM-DD), default: the oldest order")
+    parser.add_argument('--to', dest='date_to', type=datetime.date.fromisoformat,
+                        help="last day to rebuild (YYYY-MM-DD), default: no limit")
+    args = parser.parse_args()
+    rebuild_rollups(args.date_from, args.date_to)
@@ -1,20 +1,68 @@
-import webview
-import threading
-import sys
+"""
+Desktop POS: the app served on localhost inside a native window.
+
+The window opens straight away on a splash page. Creating the server
+(which imports the app), starting it and warming the database pools and
+catalog cache all happen on background threads, and the window navigates
+to the app only once GET /healthz answers, so it never shows a connection
+error while the server is still coming up. Measure with
+benchmarks/bench_startup.py.
+"""
+import html
 import os
+import sys
+import threading
+import time
+import urllib.request
+
+import webview
 
 # Add current directory to path so imports work
 sys.path.append(os.path.dirname(os.path.abspath(__file__)))
 
-from app import app
+# An IP rather than localhost, which may try ::1 first
+HOST = '127.0.0.1'
+PORT = int(os.environ.get('WEB_PORT', 5000))
+READY_TIMEOUT = 30
 
-def start_server():
-    app.run(port=5000, debug=False)
+PAGE_HTML = """<!DOCTYPE html>
+<html><body style="margin:0;height:100vh;display:flex;align-items:center;justify-content:center;
+font-family:sans-serif;background:#f1f5f9;color:#334155"><p>{}</p></body></html>"""
 
-if __name__ == '__main__':
-    t = threading.Thread(target=start_server)
-    t.daemon = True
-    t.start()
+def wait_until_ready(url, timeout=READY_TIMEOUT):
+    """Polls `url` until it answers 200. Returns False after `timeout` seconds."""
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            with urllib.request.urlopen(url, timeout=1) as res:
+                if res.status == 200:
+                    return True
+        except OSError:
+            pass
+        if time.monotonic() >= deadline:
+            return False
+        time.sleep(0.05)
+
+def boot(window):
+    """Runs on pywebview's worker thread once the window is up."""
+    try:
+        # Imported here so the window shows before the app is loaded
+        import serve
 
-    webview.create_window('POS System', 'http://localhost:5000', width=1200, height=800)
-    webview.start()
+        # Same production server as serve.py, bound to localhost only
+        server = serve.create_server(host=HOST, port=PORT)
+        threading.Thread(target=server.run, name='server', daemon=True).start()
+        threading.Thread(target=serve.warm_up, name='warm-up', daemon=True).start()
+    except Exception as e:
+        window.load_html(PAGE_HTML.format(html.escape(f"Could not start the server: {e}")))
+        return
+
+    url = f'http://{HOST}:{PORT}'
+    if wait_until_ready(url + '/healthz'):
+        window.load_url(url)
+    else:
+        window.load_html(PAGE_HTML.format("The server did not start. Restart the application."))
+
+if __name__ == '__main__':
+    window = webview.create_window('POS System', html=PAGE_HTML.format("Starting&hellip;"), width=1200, height=800)
+    webview.start(boot, window)
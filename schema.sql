@@ -1,5 +1,16 @@
+DROP TABLE IF EXISTS audit_log;
+DROP TABLE IF EXISTS shift_totals;
+DROP TABLE IF EXISTS tax_rules;
+DROP TABLE IF EXISTS product_tombstones;
+DROP TABLE IF EXISTS catalog_state;
+DROP TABLE IF EXISTS daily_product_sales;
+DROP TABLE IF EXISTS hourly_sales_summary;
+DROP TABLE IF EXISTS daily_sales_summary;
+DROP TABLE IF EXISTS transaction_counters;
+DROP TABLE IF EXISTS order_idempotency_keys;
 DROP TABLE IF EXISTS order_items;
 DROP TABLE IF EXISTS orders;
+DROP TABLE IF EXISTS shifts;
 DROP TABLE IF EXISTS products;
 DROP TABLE IF EXISTS users;
 
@@ -17,24 +28,224 @@ CREATE TABLE products (
     category VARCHAR(50),
     image_url VARCHAR(255),
     is_inventory_managed BOOLEAN DEFAULT FALSE,
-    stock INT DEFAULT 0
+    stock INT DEFAULT 0,
+    barcode VARCHAR(64),
+    version BIGINT NOT NULL DEFAULT 0
 );
 
-CREATE TABLE orders (
+CREATE INDEX idx_products_version ON products (version);
+CREATE INDEX idx_products_name ON products (name);
+
+-- Product search (services.search_products): barcode/SKU lookups, name
+-- prefixes for short queries, trigram substring and fuzzy matching otherwise
+CREATE EXTENSION IF NOT EXISTS pg_trgm;
+CREATE UNIQUE INDEX idx_products_barcode ON products (barcode) WHERE barcode IS NOT NULL;
+CREATE INDEX idx_products_name_prefix ON products (lower(name) text_pattern_ops);
+CREATE INDEX idx_products_name_trgm ON products USING gin (lower(name) gin_trgm_ops);
+
+-- Catalog version for /api/products ETags and ?since= deltas. Bumped by
+-- every transaction that changes a product row.
+CREATE TABLE catalog_state (
+    id BOOLEAN PRIMARY KEY DEFAULT TRUE CHECK (id),
+    version BIGINT NOT NULL
+);
+
+INSERT INTO catalog_state (version) VALUES (0);
+
+CREATE TABLE product_tombstones (
+    product_id INT PRIMARY KEY,
+    version BIGINT NOT NULL
+);
+
+-- Per-category tax; categories without a row use the default 10%,
+-- added on top of the price. Changes bump the catalog version.
+CREATE TABLE tax_rules (
+    category VARCHAR(50) PRIMARY KEY,
+    rate DECIMAL(6, 4) NOT NULL CHECK (rate >= 0 AND rate < 1),
+    inclusive BOOLEAN NOT NULL DEFAULT FALSE
+);
+
+-- Cashier shifts (see shifts.py). At most one open shift per cashier;
+-- z_report is the report as printed at close.
+CREATE TABLE shifts (
     id SERIAL PRIMARY KEY,
-    transaction_code VARCHAR(50) UNIQUE NOT NULL,
+    cashier_id INT NOT NULL REFERENCES users(id),
+    opened_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    closed_at TIMESTAMP,
+    opening_float DECIMAL(15, 0) NOT NULL DEFAULT 0,
+    counted_cash DECIMAL(15, 0),
+    z_report JSONB
+);
+
+CREATE UNIQUE INDEX idx_shifts_open_cashier ON shifts (cashier_id) WHERE closed_at IS NULL;
+CREATE INDEX idx_shifts_opened_at ON shifts (opened_at);
+
+-- orders and order_items are range partitioned by month on the order's
+-- created_at (order_items carries a copy as order_created_at), so old
+-- months can be detached and archived with archive_orders.py. Partitions
+-- are named orders_pYYYYMM / order_items_pYYYYMM and created ahead of time
+-- by ensure_order_partitions(). Keys include the partition column, so
+-- global uniqueness of idempotency keys lives in order_idempotency_keys;
+-- transaction codes are unique by construction (transaction_counters).
+CREATE TABLE orders (
+    id SERIAL,
+    transaction_code VARCHAR(50) NOT NULL,
     total_amount DECIMAL(15, 0) NOT NULL,
     tax_amount DECIMAL(15, 0) NOT NULL,
+    discount_amount DECIMAL(15, 0) NOT NULL DEFAULT 0,
     payment_method VARCHAR(20) NOT NULL,
-    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-    status VARCHAR(20) DEFAULT 'paid' CHECK (status IN ('paid', 'void'))
+    created_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    status VARCHAR(20) DEFAULT 'paid' CHECK (status IN ('paid', 'void')),
+    cashier_id INT REFERENCES users(id) ON DELETE SET NULL,
+    shift_id INT REFERENCES shifts(id),
+    PRIMARY KEY (id, created_at)
+) PARTITION BY RANGE (created_at);
+
+-- Keyset pagination of the sales listing, newest first, optionally narrowed
+-- by status / payment method, plus transaction code prefix search.
+CREATE INDEX idx_orders_created_at_id ON orders (created_at DESC, id DESC);
+CREATE INDEX idx_orders_status_created_at_id ON orders (status, created_at DESC, id DESC);
+CREATE INDEX idx_orders_payment_created_at_id ON orders (payment_method, created_at DESC, id DESC);
+CREATE INDEX idx_orders_transaction_code_prefix ON orders (transaction_code text_pattern_ops);
+
+-- Client-generated key so retried/queued submissions are charged once
+CREATE TABLE order_idempotency_keys (
+    idempotency_key VARCHAR(64) NOT NULL,
+    order_id INT NOT NULL,
+    order_created_at TIMESTAMP NOT NULL,
+    CONSTRAINT orders_idempotency_key_key PRIMARY KEY (idempotency_key)
 );
 
 CREATE TABLE order_items (
-    id SERIAL PRIMARY KEY,
-    order_id INT REFERENCES orders(id),
+    id SERIAL,
+    order_id INT NOT NULL,
+    order_created_at TIMESTAMP NOT NULL,
+    product_id INT REFERENCES products(id) ON DELETE SET NULL,
     product_name_snapshot VARCHAR(100) NOT NULL,
     price_snapshot DECIMAL(15, 0) NOT NULL,
     quantity INT NOT NULL,
-    subtotal DECIMAL(15, 0) NOT NULL
+    subtotal DECIMAL(15, 0) NOT NULL,
+    -- Share of line and order discounts taken off this line
+    discount_amount DECIMAL(15, 0) NOT NULL DEFAULT 0,
+    PRIMARY KEY (id, order_created_at),
+    FOREIGN KEY (order_id, order_created_at) REFERENCES orders (id, created_at)
+) PARTITION BY RANGE (order_created_at);
+
+-- Covers the stock restore of a void without touching the heap
+CREATE INDEX idx_order_items_order_id ON order_items (order_id) INCLUDE (product_id, quantity);
+CREATE INDEX idx_order_items_product_id ON order_items (product_id);
+
+-- Creates the missing monthly partitions of orders and order_items for
+-- every month from first_month to last_month. Returns how many months
+-- were added, or NULL if another session is doing it right now. Existing
+-- partitions are skipped without taking any lock.
+CREATE OR REPLACE FUNCTION ensure_order_partitions(first_month DATE, last_month DATE) RETURNS INT AS $$
+DECLARE
+    month DATE := date_trunc('month', first_month);
+    suffix TEXT;
+    created INT := 0;
+BEGIN
+    -- Concurrent callers would race to create the same tables: one does
+    -- the work, the others return NULL at once instead of waiting
+    IF NOT pg_try_advisory_xact_lock(hashtext('ensure_order_partitions')) THEN
+        RETURN NULL;
+    END IF;
+    WHILE month <= last_month LOOP
+        suffix := to_char(month, 'YYYYMM');
+        IF to_regclass('orders_p' || suffix) IS NULL THEN
+            BEGIN
+                EXECUTE format('CREATE TABLE %I PARTITION OF orders FOR VALUES FROM (%L) TO (%L)',
+                               'orders_p' || suffix, month, (month + interval '1 month')::date);
+                created := created + 1;
+            EXCEPTION WHEN duplicate_table THEN
+                NULL;
+            END;
+        END IF;
+        IF to_regclass('order_items_p' || suffix) IS NULL THEN
+            BEGIN
+                EXECUTE format('CREATE TABLE %I PARTITION OF order_items FOR VALUES FROM (%L) TO (%L)',
+                               'order_items_p' || suffix, month, (month + interval '1 month')::date);
+            EXCEPTION WHEN duplicate_table THEN
+                NULL;
+            END;
+        END IF;
+        month := (month + interval '1 month')::date;
+    END LOOP;
+    RETURN created;
+END;
+$$ LANGUAGE plpgsql;
+
+SELECT ensure_order_partitions(CURRENT_DATE, (CURRENT_DATE + interval '3 months')::date);
+
+-- One row per business day; upserted inside each order transaction to
+-- allocate the sequence part of transaction_code.
+CREATE TABLE transaction_counters (
+    day DATE PRIMARY KEY,
+    last_seq INT NOT NULL
+);
+
+-- Dashboard rollup, maintained by create_order/void_order in the same
+-- transaction. Rebuild with rebuild_rollups.py.
+CREATE TABLE daily_sales_summary (
+    day DATE NOT NULL,
+    payment_method VARCHAR(20) NOT NULL,
+    paid_count INT NOT NULL DEFAULT 0,
+    paid_total DECIMAL(15, 0) NOT NULL DEFAULT 0,
+    paid_tax DECIMAL(15, 0) NOT NULL DEFAULT 0,
+    void_count INT NOT NULL DEFAULT 0,
+    void_total DECIMAL(15, 0) NOT NULL DEFAULT 0,
+    void_tax DECIMAL(15, 0) NOT NULL DEFAULT 0,
+    PRIMARY KEY (day, payment_method)
+);
+
+-- Analytics aggregates (see analytics.py), maintained alongside
+-- daily_sales_summary. product_id 0 pools lines without a product id.
+CREATE TABLE hourly_sales_summary (
+    day DATE NOT NULL,
+    hour SMALLINT NOT NULL,
+    order_count INT NOT NULL DEFAULT 0,
+    total DECIMAL(15, 0) NOT NULL DEFAULT 0,
+    PRIMARY KEY (day, hour)
 );
+
+CREATE TABLE daily_product_sales (
+    day DATE NOT NULL,
+    product_id INT NOT NULL,
+    product_name VARCHAR(100) NOT NULL,
+    quantity INT NOT NULL DEFAULT 0,
+    revenue DECIMAL(15, 0) NOT NULL DEFAULT 0,
+    PRIMARY KEY (day, product_id)
+);
+
+-- Running totals per shift and payment method, maintained by
+-- create_order/void_order in the same transaction like
+-- daily_sales_summary. Rebuild with rebuild_rollups.py.
+CREATE TABLE shift_totals (
+    shift_id INT NOT NULL REFERENCES shifts(id),
+    payment_method VARCHAR(20) NOT NULL,
+    paid_count INT NOT NULL DEFAULT 0,
+    paid_total DECIMAL(15, 0) NOT NULL DEFAULT 0,
+    paid_tax DECIMAL(15, 0) NOT NULL DEFAULT 0,
+    void_count INT NOT NULL DEFAULT 0,
+    void_total DECIMAL(15, 0) NOT NULL DEFAULT 0,
+    void_tax DECIMAL(15, 0) NOT NULL DEFAULT 0,
+    PRIMARY KEY (shift_id, payment_method)
+);
+
+-- Append-only audit trail, written in batches by audit.py. Rows arrive
+-- roughly in occurred_at order, so a BRIN index covers time ranges.
+CREATE TABLE audit_log (
+    id BIGSERIAL PRIMARY KEY,
+    occurred_at TIMESTAMP NOT NULL,
+    event VARCHAR(40) NOT NULL,
+    entity_id BIGINT,
+    user_id INT,
+    username VARCHAR(50),
+    remote_addr VARCHAR(45),
+    payload JSONB
+);
+
+CREATE INDEX idx_audit_log_event_id ON audit_log (event, id DESC);
+CREATE INDEX idx_audit_log_user_id ON audit_log (user_id, id DESC);
+CREATE INDEX idx_audit_log_entity_id ON audit_log (entity_id, id DESC);
+CREATE INDEX idx_audit_log_occurred_at ON audit_log USING brin (occurred_at);
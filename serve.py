@@ -0,0 +1,147 @@
+"""
+Production entry point.
+
+Runs the app under gunicorn (multi-process, threaded workers) where it is
+available, otherwise under waitress (single process, thread pool), e.g. on
+Windows. Configured through the environment:
+
+    WEB_HOST        bind address (default 0.0.0.0)
+    WEB_PORT        port (default 5000)
+    WEB_WORKERS     gunicorn worker processes (default 2 x CPUs + 1)
+    WEB_THREADS     threads per worker (default 32)
+    WEB_TIMEOUT     seconds before a stuck worker is restarted (default 30)
+    WEB_PRELOAD     1 to import the app once in the master before forking
+    METRICS_TOKEN   bearer token scrapers send to /metrics; under gunicorn,
+                    which usually sits behind a reverse proxy, /metrics is
+                    refused without one (METRICS_LOCAL=1 to allow localhost)
+
+Send SIGHUP to the gunicorn master to reload gracefully: new workers are
+started with fresh code and old ones finish their in-flight requests.
+With WEB_PRELOAD=1 startup is faster but a reload keeps the master's code.
+
+Each worker opens its own database pool on first use, after the fork, so
+DB_POOL_MAX applies per worker; keep WEB_WORKERS x DB_POOL_MAX below the
+server's max_connections.
+
+Every POS terminal keeps a /api/events stream open, which occupies one
+thread (but no database connection) for as long as it is connected; up to
+EVENTS_MAX_CLIENTS (default 16) per worker, leaving the other threads for
+ordinary requests. Keep WEB_THREADS well above it.
+"""
+import logging
+import multiprocessing
+import os
+import sys
+import time
+
+import audit
+import db
+
+HOST = os.environ.get('WEB_HOST', '0.0.0.0')
+PORT = int(os.environ.get('WEB_PORT', 5000))
+WORKERS = int(os.environ.get('WEB_WORKERS', multiprocessing.cpu_count() * 2 + 1))
+THREADS = int(os.environ.get('WEB_THREADS', 32))
+TIMEOUT = int(os.environ.get('WEB_TIMEOUT', 30))
+PRELOAD = os.environ.get('WEB_PRELOAD') == '1'
+
+log = logging.getLogger('pos.serve')
+
+try:
+    import gunicorn.app.base
+except ImportError:  # not installable on Windows
+    gunicorn = None
+
+
+def post_fork(server, worker):
+    db.reset_pool_after_fork()
+
+def post_worker_init(worker):
+    # Partitions, pools and catalog before the first request, not during it
+    warm_up()
+
+def worker_exit(server, worker):
+    # Write out buffered audit records while the pool is still open
+    audit.flush()
+    db.close_pool()
+
+def gunicorn_options(host=HOST, port=PORT, workers=WORKERS, threads=THREADS):
+    return {
+        'bind': f'{host}:{port}',
+        'workers': workers,
+        'threads': threads,
+        'worker_class': 'gthread',
+        'timeout': TIMEOUT,
+        'graceful_timeout': TIMEOUT,
+        'preload_app': PRELOAD,
+        'post_fork': post_fork,
+        'post_worker_init': post_worker_init,
+        'worker_exit': worker_exit,
+        'accesslog': '-',
+    }
+
+if gunicorn is not None:
+    class GunicornApplication(gunicorn.app.base.BaseApplication):
+        """Runs app:app with options from gunicorn_options(), no config file needed."""
+
+        def __init__(self, options):
+            self.options = options
+            super().__init__()
+
+        def load_config(self):
+            for key, value in self.options.items():
+                self.cfg.set(key, value)
+
+        def load(self):
+            # Imported here so each worker loads the app after the fork
+            # (and again on HUP) unless preload_app is set
+            from app import app
+            return app
+
+def create_server(host=HOST, port=PORT, threads=THREADS):
+    """
+    Returns a waitress server for the app without starting it; call
+    .run() to serve and .close() to stop. Used when gunicorn is not
+    available and by run_gui.py, which embeds it in a thread.
+    """
+    from waitress.server import create_server as create_waitress_server
+    from app import app
+    return create_waitress_server(app, host=host, port=port, threads=threads)
+
+def warm_up():
+    """
+    Opens this process's database pools, loads the catalog cache and runs
+    the daily order partition check, so the first terminal requests do not
+    pay for them. Meant for a background thread; failures are logged
+    and left for the first request to report. Returns the seconds taken.
+    """
+    import services
+    started = time.perf_counter()
+    try:
+        for target in db.TARGETS:
+            db.get_pool(target)
+        services.get_catalog()
+        services.ensure_order_partitions()
+    except Exception as e:
+        log.warning("Warm-up failed: %s", e)
+    return time.perf_counter() - started
+
+def main():
+    if gunicorn is not None:
+        # Behind a proxy every request looks local; see metrics.METRICS_LOCAL
+        os.environ.setdefault('METRICS_LOCAL', '0')
+        GunicornApplication(gunicorn_options()).run()
+        return
+
+    server = create_server()
+    print(f"Serving on http://{HOST}:{PORT} with {THREADS} threads (waitress)")
+    try:
+        server.run()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.close()
+        audit.flush()
+        db.close_pool()
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,161 +1,1033 @@
+import csv
 import datetime
+import io
+import json
+import logging
+import os
+import threading
+import time
+from decimal import Decimal
+import psycopg2
+import psycopg2.errors
+from psycopg2.extras import execute_values
 from db import get_db_cursor
+import analytics
+import audit
+import images
+import pricing
+import shifts
 import uuid
 
-def generate_transaction_code():
-    """Generates a transaction code in format TRX-YYYYMMDD-XXXX"""
-    today_str = datetime.datetime.now().strftime("%Y%m%d")
-    prefix = f"TRX-{today_str}-"
+TAX_RATE = pricing.DEFAULT_TAX_RATE
+ORDER_PARTITION_MONTHS_AHEAD = int(os.environ.get('ORDER_PARTITION_MONTHS_AHEAD', 3))
+ORDER_PARTITION_LOCK_TIMEOUT_MS = int(os.environ.get('ORDER_PARTITION_LOCK_TIMEOUT_MS', 500))
+PAYMENT_METHODS = ('cash', 'qris')
+# Of one product in one order; keeps quantities and stock within INT
+MAX_QUANTITY = 10000
 
-    with get_db_cursor() as cur:
-        # Find the last transaction code for today
+log = logging.getLogger('pos.services')
+
+def _next_transaction_code(cur):
+    # The upsert row-locks today's counter until the surrounding transaction
+    # commits, so two checkouts can never be handed the same number and a
+    # rolled-back checkout gives its number back.
+    cur.execute(
+        """
+        INSERT INTO transaction_counters (day, last_seq)
+        VALUES (CURRENT_DATE, 1)
+        ON CONFLICT (day) DO UPDATE SET last_seq = transaction_counters.last_seq + 1
+        RETURNING day, last_seq
+        """
+    )
+    result = cur.fetchone()
+    return f"TRX-{result['day'].strftime('%Y%m%d')}-{result['last_seq']:04d}"
+
+def generate_transaction_code(cur=None):
+    """
+    Generates a transaction code in format TRX-YYYYMMDD-XXXX.
+
+    Pass the order's cursor so the number is allocated inside the order
+    transaction; without one the number is allocated and committed on its own.
+    """
+    if cur is not None:
+        return _next_transaction_code(cur)
+    with get_db_cursor(commit=True) as own_cur:
+        return _next_transaction_code(own_cur)
+
+_partitions_checked_on = None
+
+def ensure_order_partitions(months_ahead=ORDER_PARTITION_MONTHS_AHEAD):
+    """
+    Makes sure the monthly orders/order_items partitions exist from this
+    month to `months_ahead` months ahead; a catalog lookup unless one is
+    missing. Runs at startup (serve.warm_up) and then at most once a day
+    per process from checkouts, which never fail because of it (see
+    _check_order_partitions), so a long-running server never reaches a
+    month that has no partition.
+
+    Creating a partition locks orders exclusively, so it gives up after
+    ORDER_PARTITION_LOCK_TIMEOUT_MS rather than stall checkouts behind a
+    long read. Returns the months created, or None if another process was
+    creating them (the check is then repeated next time).
+    """
+    global _partitions_checked_on
+    today = datetime.date.today()
+    if _partitions_checked_on == today:
+        return 0
+    with get_db_cursor(commit=True) as cur:
+        cur.execute("SET LOCAL lock_timeout = %s", (f"{ORDER_PARTITION_LOCK_TIMEOUT_MS}ms",))
         cur.execute(
-            "SELECT transaction_code FROM orders WHERE transaction_code LIKE %s ORDER BY id DESC LIMIT 1",
-            (prefix + '%',)
+            "SELECT ensure_order_partitions(CURRENT_DATE, (CURRENT_DATE + %s * interval '1 month')::date) AS created",
+            (months_ahead,)
         )
-        result = cur.fetchone()
+        created = cur.fetchone()['created']
+    if created is not None:
+        _partitions_checked_on = today
+    return created
 
-        if result:
-            last_code = result['transaction_code']
-            try:
-                # Extract the last 4 digits
-                last_seq = int(last_code.split('-')[-1])
-                new_seq = last_seq + 1
-            except ValueError:
-                new_seq = 1
-        else:
-            new_seq = 1
-
-        return f"{prefix}{new_seq:04d}"
+def _check_order_partitions():
+    """ensure_order_partitions for the checkout path: a failure is logged, not the checkout's."""
+    try:
+        ensure_order_partitions()
+    except Exception as e:
+        log.warning("Order partition check failed, retrying on a later checkout: %s", e)
 
 def calculate_tax(subtotal):
-    """Calculates 10% tax on subtotal."""
-    # Assuming subtotal is integer or decimal. Return integer for consistency if needed,
-    # but requirement says DECIMAL in DB.
-    # Python float math might introduce errors, but for simple 10% it's usually fine.
-    # Ideally use Decimal type.
-    return int(subtotal * 0.10)
+    """Calculates the default 10% tax on subtotal; see pricing for per-category rules."""
+    return int(pricing.tax_for(subtotal, TAX_RATE))
 
-def create_order(items, payment_method):
+def _add_sales_delta(deltas, order, voided=False):
     """
-    Creates an order atomically.
-    items: list of dicts {'id': product_id, 'quantity': int}
+    Accumulates the daily_sales_summary change caused by creating (or, with
+    voided=True, voiding) `order` into `deltas`, keyed by (day, payment_method).
     """
-    transaction_code = generate_transaction_code()
+    key = (order['created_at'].date(), order['payment_method'])
+    delta = deltas.setdefault(key, [0, 0, 0, 0, 0, 0])
+    sign = -1 if voided else 1
+    delta[0] += sign
+    delta[1] += sign * order['total_amount']
+    delta[2] += sign * order['tax_amount']
+    if voided:
+        delta[3] += 1
+        delta[4] += order['total_amount']
+        delta[5] += order['tax_amount']
 
-    # We need to calculate totals and verify stock first
-    subtotal = 0
-    order_item_data = [] # To store snapshots
+def _apply_sales_deltas(cur, deltas):
+    """Upserts accumulated deltas into daily_sales_summary in one statement."""
+    if not deltas:
+        return
+    execute_values(
+        cur,
+        """
+        INSERT INTO daily_sales_summary
+            (day, payment_method, paid_count, paid_total, paid_tax, void_count, void_total, void_tax)
+        VALUES %s
+        ON CONFLICT (day, payment_method) DO UPDATE SET
+            paid_count = daily_sales_summary.paid_count + EXCLUDED.paid_count,
+            paid_total = daily_sales_summary.paid_total + EXCLUDED.paid_total,
+            paid_tax = daily_sales_summary.paid_tax + EXCLUDED.paid_tax,
+            void_count = daily_sales_summary.void_count + EXCLUDED.void_count,
+            void_total = daily_sales_summary.void_total + EXCLUDED.void_total,
+            void_tax = daily_sales_summary.void_tax + EXCLUDED.void_tax
+        """,
+        [key + tuple(delta) for key, delta in sorted(deltas.items())],
+        page_size=len(deltas)
+    )
 
-    # We use a single commit=True block to ensure atomicity
-    # However, generate_transaction_code uses a separate cursor read.
-    # To be strictly atomic and safe from race conditions in high concurrency,
-    # we should do generation inside the lock or catch unique constraint violation.
-    # Given the requirements, we'll try to do it all in one connection context if possible,
-    # or just trust the simplified logic for this scope.
+def _aggregate_cart(items):
+    """Collapses cart lines into {product_id: quantity}, keeping first-seen order."""
+    quantities = {}
+    for item in items:
+        product_id = int(item['id'])
+        qty = int(item['quantity'])
+        if qty <= 0:
+            raise ValueError(f"Invalid quantity for product ID {product_id}.")
+        quantities[product_id] = quantities.get(product_id, 0) + qty
+        if quantities[product_id] > MAX_QUANTITY:
+            raise ValueError(f"At most {MAX_QUANTITY} of product ID {product_id} per order.")
+    return quantities
 
-    # Refactoring generate_transaction_code to be called inside the main transaction would be better
-    # but 'get_db_cursor' creates a new connection each time.
-    # For this scale, it's acceptable.
+def _line_discounts(items):
+    """{product_id: parsed discount} from cart lines carrying a 'discount'; the first one per product wins."""
+    discounts = {}
+    for item in items:
+        if item.get('discount'):
+            discounts.setdefault(int(item['id']), pricing.parse_discount(item['discount']))
+    return discounts
 
-    with get_db_cursor(commit=True) as cur:
-        # 1. Validate Stock and Calculate Totals
-        for item in items:
-            product_id = item['id']
-            qty = item['quantity']
+def _create_order(cur, items, payment_method, idempotency_key=None, discount=None, cashier_id=None,
+                  max_discount_percent=None):
+    if not items:
+        raise ValueError("Cart is empty")
+    if payment_method not in PAYMENT_METHODS:
+        raise ValueError("Invalid payment method.")
+    quantities = _aggregate_cart(items)
+    product_ids = list(quantities)
+    line_discounts = _line_discounts(items)
+    discount = pricing.parse_discount(discount)
 
-            cur.execute("SELECT * FROM products WHERE id = %s FOR UPDATE", (product_id,))
-            product = cur.fetchone()
+    # 1. Lock and load every product in the cart, with its tax rule
+    cur.execute(
+        """
+        SELECT p.id, p.name, p.price, p.category, p.is_inventory_managed, p.stock,
+               t.rate AS tax_rate, t.inclusive AS tax_inclusive
+        FROM products p
+        LEFT JOIN tax_rules t ON t.category = p.category
+        WHERE p.id = ANY(%s)
+        ORDER BY p.id
+        FOR UPDATE OF p
+        """,
+        (product_ids,)
+    )
+    products = {p['id']: p for p in cur.fetchall()}
 
-            if not product:
-                raise ValueError(f"Product ID {product_id} not found.")
+    # 2. Validate Stock
+    stock_updates = []
+    for product_id in product_ids:
+        product = products.get(product_id)
+        if not product:
+            raise ValueError(f"Product ID {product_id} not found.")
 
-            if product['is_inventory_managed']:
-                if product['stock'] < qty:
-                    raise ValueError(f"Insufficient stock for {product['name']}. Available: {product['stock']}")
+        qty = quantities[product_id]
+        if product['is_inventory_managed']:
+            if product['stock'] < qty:
+                raise ValueError(f"Insufficient stock for {product['name']}. Available: {product['stock']}")
+            stock_updates.append((product_id, qty))
 
-                # Deduct stock
-                new_stock = product['stock'] - qty
-                cur.execute("UPDATE products SET stock = %s WHERE id = %s", (new_stock, product_id))
+    # 3. Price the cart from the locked rows
+    rules = {p['category']: (p['tax_rate'], p['tax_inclusive'])
+             for p in products.values() if p['tax_rate'] is not None}
+    priced = pricing.price_cart(
+        pricing.build_price_book(products.values(), rules), quantities, line_discounts, discount,
+        max_discount_percent=max_discount_percent
+    )
+    order_item_data = [
+        (line['id'], products[line['id']]['name'], line['unit_price'], line['quantity'], line['subtotal'],
+         line['discount'])
+        for line in priced['lines']
+    ]
+    tax_amount = priced['tax']
+    discount_amount = priced['discount']
+    total_amount = priced['total']
 
-            item_subtotal = product['price'] * qty
-            subtotal += item_subtotal
+    # 4. Create Order. The code is allocated late so today's counter row
+    # stays locked only for the remainder of this transaction. The
+    # cashier's open shift is share-locked so it cannot close under us.
+    transaction_code = generate_transaction_code(cur)
+    cur.execute(
+        """
+        INSERT INTO orders
+            (transaction_code, total_amount, tax_amount, discount_amount, payment_method, status, cashier_id, shift_id)
+        VALUES (%s, %s, %s, %s, %s, 'paid', %s,
+                (SELECT id FROM shifts WHERE cashier_id = %s AND closed_at IS NULL FOR SHARE))
+        RETURNING id, created_at, shift_id
+        """,
+        (transaction_code, total_amount, tax_amount, discount_amount, payment_method, cashier_id, cashier_id)
+    )
+    order = cur.fetchone()
+    order_id = order['id']
+
+    if idempotency_key:
+        # Fails with a unique violation if a concurrent retry got here first
+        cur.execute(
+            "INSERT INTO order_idempotency_keys (idempotency_key, order_id, order_created_at) VALUES (%s, %s, %s)",
+            (idempotency_key, order_id, order['created_at'])
+        )
 
-            order_item_data.append({
-                'product_name_snapshot': product['name'],
-                'price_snapshot': product['price'],
-                'quantity': qty,
-                'subtotal': item_subtotal
-            })
+    # 5. Create Order Items
+    execute_values(
+        cur,
+        """
+        INSERT INTO order_items
+            (order_id, order_created_at, product_id, product_name_snapshot, price_snapshot, quantity, subtotal,
+             discount_amount)
+        VALUES %s
+        """,
+        [(order_id, order['created_at']) + data for data in order_item_data],
+        page_size=max(len(order_item_data), 1)
+    )
 
-        # 2. Calculate Final Totals
-        tax_amount = calculate_tax(subtotal)
-        total_amount = subtotal + tax_amount
+    # 6. Roll the order into the daily summary read by the dashboard, the
+    # running totals of its shift and the analytics aggregates
+    summary = {
+        'created_at': order['created_at'],
+        'shift_id': order['shift_id'],
+        'payment_method': payment_method,
+        'total_amount': total_amount,
+        'tax_amount': tax_amount
+    }
+    deltas = {}
+    _add_sales_delta(deltas, summary)
+    _apply_sales_deltas(cur, deltas)
 
-        # 3. Create Order
+    shift_deltas = {}
+    shifts.add_order_delta(shift_deltas, summary)
+    shifts.apply_deltas(cur, shift_deltas)
+
+    analytics_deltas = analytics.new_deltas()
+    analytics.add_order_delta(analytics_deltas, summary, [
+        {'product_id': data[0], 'product_name': data[1], 'quantity': data[3], 'revenue': data[4] - data[5]}
+        for data in order_item_data
+    ])
+    analytics.apply_deltas(cur, analytics_deltas)
+
+    # 7. Deduct stock for all managed products at once. The rows are
+    # already locked, so this can wait until the end and share the
+    # catalog version bump (whose single row is a hot spot).
+    if stock_updates:
+        version = bump_catalog_version(cur, notify=False, stock_only=True)
         cur.execute(
             """
-            INSERT INTO orders (transaction_code, total_amount, tax_amount, payment_method, status)
-            VALUES (%s, %s, %s, %s, 'paid')
-            RETURNING id
+            UPDATE products AS p
+            SET stock = p.stock - v.qty, version = %s
+            FROM unnest(%s::int[], %s::int[]) AS v(id, qty)
+            WHERE p.id = v.id AND p.stock >= v.qty
             """,
-            (transaction_code, total_amount, tax_amount, payment_method)
-        )
-        order_id = cur.fetchone()['id']
-
-        # 4. Create Order Items
-        for data in order_item_data:
-            cur.execute(
-                """
-                INSERT INTO order_items (order_id, product_name_snapshot, price_snapshot, quantity, subtotal)
-                VALUES (%s, %s, %s, %s, %s)
-                """,
-                (order_id, data['product_name_snapshot'], data['price_snapshot'], data['quantity'], data['subtotal'])
-            )
+            (version, [u[0] for u in stock_updates], [u[1] for u in stock_updates])
+        )
+        if cur.rowcount != len(stock_updates):
+            raise ValueError("Stock changed during checkout, please retry.")
+        notify_catalog_change(cur, version, stock_only=True)
+
+    return {'order_id': order_id, 'transaction_code': transaction_code, 'total': int(total_amount)}
+
+def _find_order_by_key(cur, idempotency_key):
+    cur.execute(
+        """
+        SELECT o.id, o.transaction_code, o.total_amount
+        FROM order_idempotency_keys k
+        JOIN orders o ON o.id = k.order_id AND o.created_at = k.order_created_at
+        WHERE k.idempotency_key = %s
+        """,
+        (idempotency_key,)
+    )
+    order = cur.fetchone()
+    if order is None:
+        return None
+    return {'order_id': order['id'], 'transaction_code': order['transaction_code'],
+            'total': int(order['total_amount']), 'duplicate': True}
+
+def _is_idempotency_conflict(error):
+    return getattr(error.diag, 'constraint_name', None) == 'orders_idempotency_key_key'
+
+def create_order(items, payment_method, idempotency_key=None, discount=None, cashier_id=None,
+                 max_discount_percent=None):
+    """
+    Creates an order atomically.
+    items: list of dicts {'id': product_id, 'quantity': int}, optionally
+    with a line 'discount'; `discount` applies to the whole order. Both
+    take the {'type': 'percent'|'amount', 'value': n} form of pricing.
+    The order is credited to `cashier_id` and to their open shift, if any.
+    `max_discount_percent` caps the total discount (see pricing.discount_limit).
+
+    The number of statements is independent of cart size: all products are
+    locked in one statement (ordered by id so concurrent checkouts always
+    lock in the same order), stock is decremented with one bulk UPDATE and
+    the order lines are written with one multi-row INSERT.
+
+    With an idempotency_key, a retry of an order that was already committed
+    returns the original result (flagged 'duplicate') instead of charging
+    twice.
+    """
+    _check_order_partitions()
+    started = time.perf_counter()
+    try:
+        with get_db_cursor(commit=True) as cur:
+            if idempotency_key:
+                existing = _find_order_by_key(cur, idempotency_key)
+                if existing:
+                    return existing
+            result = _create_order(cur, items, payment_method, idempotency_key, discount, cashier_id=cashier_id,
+                                   max_discount_percent=max_discount_percent)
+    except psycopg2.errors.UniqueViolation as e:
+        # A concurrent retry with the same key committed first
+        if not (idempotency_key and _is_idempotency_conflict(e)):
+            raise
+        with get_db_cursor() as cur:
+            return _find_order_by_key(cur, idempotency_key)
+
+    _audit_order_created(result, items, payment_method, idempotency_key, discount, started)
+    return result
+
+def _audit_order_created(result, items, payment_method, idempotency_key, discount, started):
+    # Only what checkout parsed, never the client's raw JSON
+    audit.record('order.created', result['order_id'], {
+        'transaction_code': result['transaction_code'],
+        'total': result['total'],
+        'payment_method': payment_method,
+        'items': [{'id': product_id, 'quantity': qty} for product_id, qty in _aggregate_cart(items).items()],
+        'discount': pricing.parse_discount(discount),
+        'idempotency_key': idempotency_key,
+        'duration_ms': round((time.perf_counter() - started) * 1000, 1),
+    })
+
+def create_orders_batch(orders, cashier_id=None, max_discount_percent=None):
+    """
+    Commits a batch of queued orders on one connection, each inside its own
+    savepoint so a rejected order does not undo the others. Every order is
+    a dict {'idempotency_key', 'items', 'payment_method', 'discount'}; keys already
+    committed (earlier in this batch or before) are reported as duplicates.
+    Orders are credited to `cashier_id`'s shift open at sync time.
+    Returns one {'idempotency_key', 'status', 'data' | 'error'} per order,
+    status being 'success', 'duplicate' or 'error'.
+    """
+    _check_order_partitions()
+    started = time.perf_counter()
+    results = []
+    with get_db_cursor(commit=True) as cur:
+        keys = [o.get('idempotency_key') for o in orders if o.get('idempotency_key')]
+        cur.execute(
+            """
+            SELECT o.id, o.transaction_code, o.total_amount, k.idempotency_key
+            FROM order_idempotency_keys k
+            JOIN orders o ON o.id = k.order_id AND o.created_at = k.order_created_at
+            WHERE k.idempotency_key = ANY(%s)
+            """,
+            (keys,)
+        )
+        seen = {
+            r['idempotency_key']: {'order_id': r['id'], 'transaction_code': r['transaction_code'],
+                                   'total': int(r['total_amount']), 'duplicate': True}
+            for r in cur.fetchall()
+        }
+
+        for order in orders:
+            key = order.get('idempotency_key')
+            if key in seen:
+                results.append({'idempotency_key': key, 'status': 'duplicate', 'data': seen[key]})
+                continue
+
+            cur.execute("SAVEPOINT queued_order")
+            try:
+                result = _create_order(cur, order.get('items') or [], order.get('payment_method', 'cash'), key,
+                                       order.get('discount'), cashier_id=cashier_id,
+                                       max_discount_percent=max_discount_percent)
+            except (ValueError, KeyError, TypeError) as e:
+                cur.execute("ROLLBACK TO SAVEPOINT queued_order")
+                message = str(e) if isinstance(e, ValueError) else 'Malformed order'
+                results.append({'idempotency_key': key, 'status': 'error', 'error': message})
+                continue
+            except psycopg2.DataError as e:
+                # A value the columns cannot hold: this order's fault, not the batch's
+                cur.execute("ROLLBACK TO SAVEPOINT queued_order")
+                log.warning("Queued order %s rejected: %s", key, e)
+                results.append({'idempotency_key': key, 'status': 'error', 'error': 'Invalid order data'})
+                continue
+            except psycopg2.errors.UniqueViolation as e:
+                if not (key and _is_idempotency_conflict(e)):
+                    raise
+                cur.execute("ROLLBACK TO SAVEPOINT queued_order")
+                result = _find_order_by_key(cur, key)
+                results.append({'idempotency_key': key, 'status': 'duplicate', 'data': result})
+                continue
+
+            cur.execute("RELEASE SAVEPOINT queued_order")
+            if key:
+                seen[key] = dict(result, duplicate=True)
+            results.append({'idempotency_key': key, 'status': 'success', 'data': result})
+
+    # Only now that the batch has committed
+    for order, result in zip(orders, results):
+        if result['status'] == 'success':
+            _audit_order_created(result['data'], order.get('items') or [], order.get('payment_method', 'cash'),
+                                 result['idempotency_key'], order.get('discount'), started)
+    return results
+
+def _restore_stock(cur, order_ids):
+    """
+    Puts the stock of every line of `order_ids` back in one statement. The
+    managed products involved are locked in id order first, the same order
+    checkout uses, so a void can never deadlock against a checkout.
+    Returns the ids of the products whose stock changed.
+    """
+    cur.execute(
+        """
+        WITH restored AS (
+            SELECT product_id, SUM(quantity) AS qty
+            FROM order_items
+            WHERE order_id = ANY(%s) AND product_id IS NOT NULL
+            GROUP BY product_id
+        ), locked AS (
+            SELECT p.id
+            FROM products p
+            JOIN restored r ON r.product_id = p.id
+            WHERE p.is_inventory_managed
+            ORDER BY p.id
+            FOR UPDATE OF p
+        )
+        UPDATE products AS p
+        SET stock = p.stock + r.qty
+        FROM restored r
+        WHERE p.id = r.product_id AND p.id IN (SELECT id FROM locked)
+        RETURNING p.id
+        """,
+        (list(order_ids),)
+    )
+    return [r['id'] for r in cur.fetchall()]
+
+def _void_locked_orders(cur, orders):
+    """
+    Voids `orders` (rows already locked FOR UPDATE and known to be paid):
+    restores their stock, flips their status and takes their totals out of
+    the daily summary, shift totals and analytics aggregates, with a fixed
+    number of statements however many there are.
+    """
+    order_ids = [o['id'] for o in orders]
+
+    # Restore stock by product id, so renamed products are still found.
+    # Lines whose product has since been deleted have no product_id.
+    restored_ids = _restore_stock(cur, order_ids)
+
+    # Update Order Status
+    cur.execute("UPDATE orders SET status = 'void' WHERE id = ANY(%s)", (order_ids,))
+
+    deltas = {}
+    shift_deltas = {}
+    for order in orders:
+        _add_sales_delta(deltas, order, voided=True)
+        shifts.add_order_delta(shift_deltas, order, voided=True)
+    _apply_sales_deltas(cur, deltas)
+    shifts.apply_deltas(cur, shift_deltas)
 
-        return {'order_id': order_id, 'transaction_code': transaction_code, 'total': int(total_amount)}
+    lines = analytics.load_order_lines(cur, order_ids)
+    analytics_deltas = analytics.new_deltas()
+    for order in orders:
+        analytics.add_order_delta(analytics_deltas, order, lines.get(order['id'], []), voided=True)
+    analytics.apply_deltas(cur, analytics_deltas)
+
+    if restored_ids:
+        bump_catalog_version(cur, restored_ids, stock_only=True)
+
+def _audit_orders_voided(orders, bulk=False):
+    for order in orders:
+        audit.record('order.voided', order['id'], {
+            'total': order['total_amount'],
+            'payment_method': order['payment_method'],
+            'created_at': order['created_at'],
+            'bulk': bulk,
+        })
 
 def void_order(order_id):
     """Voids an order and restores stock."""
     with get_db_cursor(commit=True) as cur:
-        # Check order status
-        cur.execute("SELECT status FROM orders WHERE id = %s", (order_id,))
+        # Check order status, locking the order against a concurrent void
+        cur.execute(
+            """
+            SELECT id, status, total_amount, tax_amount, payment_method, created_at, shift_id
+            FROM orders WHERE id = %s FOR UPDATE
+            """,
+            (order_id,)
+        )
         order = cur.fetchone()
         if not order:
             raise ValueError("Order not found")
         if order['status'] == 'void':
             raise ValueError("Order already voided")
 
-        # Get Items to restore stock
-        cur.execute("SELECT * FROM order_items WHERE order_id = %s", (order_id,))
-        items = cur.fetchall()
-
-        # Restore stock logic
-        # We need to match items back to products.
-        # Note: 'product_name_snapshot' is stored, but not 'product_id'.
-        # Requirements said: "order_items: id, order_id, product_name_snapshot, price_snapshot, quantity, subtotal".
-        # It did NOT specify storing product_id in order_items.
-        # This makes restoring stock tricky if names changed.
-        # However, usually we should store product_id.
-        # I will check if I can add product_id to order_items or match by name.
-        # Matching by name is risky but if that's the schema...
-        # Wait, the schema I wrote followed the spec: "product_name_snapshot, price_snapshot...".
-        # I should probably match by name.
-
-        for item in items:
-            name = item['product_name_snapshot']
-            qty = item['quantity']
-
-            # Find product by name
-            cur.execute("SELECT id, is_inventory_managed, stock FROM products WHERE name = %s", (name,))
-            product = cur.fetchone()
-
-            if product and product['is_inventory_managed']:
-                new_stock = product['stock'] + qty
-                cur.execute("UPDATE products SET stock = %s WHERE id = %s", (new_stock, product['id']))
-
-        # Update Order Status
-        cur.execute("UPDATE orders SET status = 'void' WHERE id = %s", (order_id,))
+        _void_locked_orders(cur, [order])
+
+    _audit_orders_voided([order])
+
+def void_orders(order_ids=None, filters=None):
+    """
+    Voids many orders in one transaction, given either a list of ids or
+    order filters (see build_order_filters; at least one is required).
+    Orders that are already void are skipped. Stock is restored in
+    aggregate. Returns {'voided': count, 'order_ids': [...]}.
+    """
+    if order_ids is not None:
+        where_sql, params = "WHERE o.id = ANY(%s)", [[int(i) for i in order_ids]]
+    else:
+        filters = dict(filters or {}, status=None)
+        where_sql, params = build_order_filters(**filters)
+        if not where_sql:
+            raise ValueError("Refusing to void without a filter.")
+
+    with get_db_cursor(commit=True) as cur:
+        cur.execute(
+            f"""
+            SELECT o.id, o.status, o.total_amount, o.tax_amount, o.payment_method, o.created_at, o.shift_id
+            FROM orders o
+            {where_sql} AND o.status = 'paid'
+            ORDER BY o.id
+            FOR UPDATE
+            """,
+            tuple(params)
+        )
+        orders = cur.fetchall()
+        if orders:
+            _void_locked_orders(cur, orders)
+
+    _audit_orders_voided(orders, bulk=True)
+    return {'voided': len(orders), 'order_ids': [o['id'] for o in orders]}
+
+def build_order_filters(date_from=None, date_to=None, status=None, payment_method=None,
+                        code_prefix=None, alias='o'):
+    """
+    Builds a WHERE clause for orders. Dates are inclusive calendar days and
+    are compared as a range on created_at so an index on it can be used.
+    Returns (sql, params); sql is empty when there is nothing to filter.
+    """
+    clauses = []
+    params = []
+    if date_from:
+        clauses.append(f"{alias}.created_at >= %s")
+        params.append(date_from)
+    if date_to:
+        clauses.append(f"{alias}.created_at < %s")
+        params.append(date_to + datetime.timedelta(days=1))
+    if status:
+        clauses.append(f"{alias}.status = %s")
+        params.append(status)
+    if payment_method:
+        clauses.append(f"{alias}.payment_method = %s")
+        params.append(payment_method)
+    if code_prefix:
+        escaped = code_prefix.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+        clauses.append(f"{alias}.transaction_code LIKE %s")
+        params.append(escaped + '%')
+
+    if not clauses:
+        return "", params
+    return "WHERE " + " AND ".join(clauses), params
+
+def encode_order_cursor(order):
+    return f"{order['created_at'].isoformat()}_{order['id']}"
+
+def decode_order_cursor(cursor):
+    try:
+        created_at, order_id = cursor.rsplit('_', 1)
+        return datetime.datetime.fromisoformat(created_at), int(order_id)
+    except (AttributeError, ValueError):
+        raise ValueError("Invalid cursor")
+
+def list_orders(filters=None, cursor=None, limit=50):
+    """
+    Returns one page of orders, newest first, using keyset pagination on
+    (created_at, id): each page is an index range scan no matter how deep
+    into the history it is. Pass the returned next_cursor to get the next
+    page; it is None on the last page.
+    """
+    where_sql, params = build_order_filters(**(filters or {}))
+    if cursor:
+        where_sql += (" AND " if where_sql else "WHERE ") + "(o.created_at, o.id) < (%s, %s)"
+        params.extend(decode_order_cursor(cursor))
+
+    with get_db_cursor(readonly=True) as cur:
+        cur.execute(
+            f"""
+            SELECT o.id, o.transaction_code, o.created_at, o.total_amount, o.tax_amount,
+                   o.discount_amount, o.payment_method, o.status
+            FROM orders o
+            {where_sql}
+            ORDER BY o.created_at DESC, o.id DESC
+            LIMIT %s
+            """,
+            tuple(params) + (limit + 1,)
+        )
+        orders = cur.fetchall()
+
+    next_cursor = None
+    if len(orders) > limit:
+        orders = orders[:limit]
+        next_cursor = encode_order_cursor(orders[-1])
+    return {'orders': orders, 'next_cursor': next_cursor}
+
+def iter_sales_export(filters=None, include_items=False, batch_size=2000):
+    """
+    Yields order rows (one per order line when include_items is set) newest
+    first, streamed from a server-side cursor in batches of batch_size.
+    """
+    where_sql, params = build_order_filters(**(filters or {}))
+
+    if include_items:
+        query = f"""
+            SELECT o.id, o.transaction_code, o.created_at, o.total_amount, o.tax_amount,
+                   o.discount_amount, o.payment_method, o.status,
+                   i.product_name_snapshot, i.price_snapshot, i.quantity, i.subtotal
+            FROM orders o
+            LEFT JOIN order_items i ON i.order_id = o.id AND i.order_created_at = o.created_at
+            {where_sql}
+            ORDER BY o.created_at DESC, o.id DESC, i.id
+        """
+    else:
+        query = f"""
+            SELECT o.id, o.transaction_code, o.created_at, o.total_amount, o.tax_amount,
+                   o.discount_amount, o.payment_method, o.status
+            FROM orders o
+            {where_sql}
+            ORDER BY o.created_at DESC, o.id DESC
+        """
+
+    with get_db_cursor(name='sales_export', itersize=batch_size, readonly=True) as cur:
+        cur.execute(query, tuple(params))
+        while True:
+            rows = cur.fetchmany(batch_size)
+            if not rows:
+                break
+            yield from rows
+
+def bump_catalog_version(cur, product_ids=(), deleted_ids=(), notify=True, stock_only=False):
+    """
+    Allocates a new catalog version inside the caller's transaction, stamps
+    it on `product_ids` and records tombstones for `deleted_ids`. Call it
+    after every change to a product row so /api/products can revalidate.
+    Pass stock_only=True when only stock changed (see notify_catalog_change).
+    With notify=False the caller must call notify_catalog_change itself
+    once the stamped rows are final.
+    """
+    cur.execute("UPDATE catalog_state SET version = version + 1 RETURNING version")
+    version = cur.fetchone()['version']
+    if product_ids:
+        cur.execute("UPDATE products SET version = %s WHERE id = ANY(%s)", (version, list(product_ids)))
+    if deleted_ids:
+        execute_values(
+            cur,
+            """
+            INSERT INTO product_tombstones (product_id, version) VALUES %s
+            ON CONFLICT (product_id) DO UPDATE SET version = EXCLUDED.version
+            """,
+            [(product_id, version) for product_id in deleted_ids]
+        )
+    if notify:
+        notify_catalog_change(cur, version, stock_only)
+    return version
+
+CATALOG_CHANNEL = 'catalog_changes'
+NOTIFY_MAX_PRODUCTS = 50
+
+def notify_catalog_change(cur, version, stock_only=False):
+    """
+    Queues a NOTIFY on CATALOG_CHANNEL, delivered when the transaction
+    commits. For stock_only changes (checkout, void) it carries the price
+    and stock of the products stamped with `version` and the ids deleted
+    in it, which is then the whole change:
+
+        {"version": 12, "products": [{"id", "price", "stock", "is_inventory_managed"}], "removed": [3]}
+
+    Any other change, and stock changes to more than NOTIFY_MAX_PRODUCTS
+    products, send only the version, and listeners fetch
+    /api/products?since= instead; this also keeps well under the 8000 byte
+    payload limit.
+    """
+    if not stock_only:
+        cur.execute("SELECT pg_notify(%s, %s)", (CATALOG_CHANNEL, json.dumps({'version': version})))
+        return
+    cur.execute(
+        """
+        WITH changed AS (
+            SELECT id, price, stock, is_inventory_managed FROM products WHERE version = %(version)s
+            LIMIT %(limit)s + 1
+        ), removed AS (
+            SELECT product_id FROM product_tombstones WHERE version = %(version)s LIMIT %(limit)s + 1
+        )
+        SELECT pg_notify(%(channel)s, CASE
+            WHEN (SELECT count(*) FROM changed) > %(limit)s OR (SELECT count(*) FROM removed) > %(limit)s
+            THEN json_build_object('version', %(version)s)
+            ELSE json_build_object(
+                'version', %(version)s,
+                'products', COALESCE((SELECT json_agg(changed ORDER BY id) FROM changed), '[]'),
+                'removed', COALESCE((SELECT json_agg(product_id) FROM removed), '[]')
+            )
+        END::text)
+        """,
+        {'version': version, 'limit': NOTIFY_MAX_PRODUCTS, 'channel': CATALOG_CHANNEL}
+    )
+
+def get_catalog_version():
+    with get_db_cursor() as cur:
+        cur.execute("SELECT version FROM catalog_state")
+        return cur.fetchone()['version']
+
+_catalog_cache = {'version': None, 'products': None}
+_catalog_lock = threading.Lock()
+
+def get_catalog(version=None):
+    """
+    Returns (version, products) for the full catalog, served from an
+    in-process cache that is reloaded only when the catalog version in the
+    database has moved. Pass a version already read in this request to
+    skip re-reading it.
+    """
+    global _catalog_cache
+    if version is None:
+        version = get_catalog_version()
+
+    cached = _catalog_cache
+    if cached['version'] == version:
+        return version, cached['products']
+
+    with _catalog_lock:
+        cached = _catalog_cache
+        if cached['version'] == version:
+            return version, cached['products']
+
+        with get_db_cursor() as cur:
+            # Version first: the products read afterwards are at least as new,
+            # so a client holding this version never misses a later change.
+            cur.execute("SELECT version FROM catalog_state")
+            version = cur.fetchone()['version']
+            cur.execute("SELECT * FROM products ORDER BY name")
+            products = cur.fetchall()
+        for p in products:
+            p['price'] = int(p['price'])
+            p.update(images.thumbnail_urls(p['image_url']))
+
+        _catalog_cache = {'version': version, 'products': products}
+        return version, products
+
+def get_catalog_changes(since):
+    """
+    Returns the products changed and the ids deleted after catalog version
+    `since`. A `since` from the future (e.g. after a database reset) yields
+    the whole catalog with reset=True.
+    """
+    with get_db_cursor() as cur:
+        cur.execute("SELECT version FROM catalog_state")
+        version = cur.fetchone()['version']
+        reset = since > version
+        if reset:
+            since = -1
+
+        cur.execute(
+            """
+            SELECT id, name, price, category, image_url, is_inventory_managed, stock, version
+            FROM products WHERE version > %s ORDER BY id
+            """,
+            (since,)
+        )
+        changed = cur.fetchall()
+        cur.execute("SELECT product_id FROM product_tombstones WHERE version > %s", (since,))
+        removed = [r['product_id'] for r in cur.fetchall()]
+
+    for p in changed:
+        p['price'] = int(p['price'])
+        p.update(images.thumbnail_urls(p['image_url']))
+    return {'version': version, 'reset': reset, 'changed': changed, 'removed': removed}
+
+def get_tax_rules(cur):
+    """{category: (rate, inclusive)} for every category with its own tax rule."""
+    cur.execute("SELECT category, rate, inclusive FROM tax_rules")
+    return {r['category']: (r['rate'], r['inclusive']) for r in cur.fetchall()}
+
+def set_tax_rule(category, rate, inclusive=False):
+    """
+    Sets the tax rate (e.g. Decimal('0.11')) of a category; inclusive means
+    its prices already contain the tax. Bumps the catalog version so cached
+    price books are rebuilt.
+    """
+    rate = Decimal(str(rate))
+    if not rate.is_finite() or rate < 0 or rate >= 1:
+        raise ValueError("Tax rate must be between 0 and 1.")
+    with get_db_cursor(commit=True) as cur:
+        cur.execute(
+            """
+            INSERT INTO tax_rules (category, rate, inclusive) VALUES (%s, %s, %s)
+            ON CONFLICT (category) DO UPDATE SET rate = EXCLUDED.rate, inclusive = EXCLUDED.inclusive
+            """,
+            (category, rate, bool(inclusive))
+        )
+        bump_catalog_version(cur)
+
+def delete_tax_rule(category):
+    """Returns a category to the default tax rate."""
+    with get_db_cursor(commit=True) as cur:
+        cur.execute("DELETE FROM tax_rules WHERE category = %s", (category,))
+        if cur.rowcount:
+            bump_catalog_version(cur)
+
+_price_book_cache = {'version': None, 'book': None}
+
+def get_price_book(version=None):
+    """PriceBook for the current catalog, rebuilt only when the catalog version moves."""
+    global _price_book_cache
+    version, products = get_catalog(version)
+    cached = _price_book_cache
+    if cached['version'] == version:
+        return cached['book']
+
+    with get_db_cursor() as cur:
+        rules = get_tax_rules(cur)
+    book = pricing.build_price_book(products, rules)
+    _price_book_cache = {'version': version, 'book': book}
+    return book
+
+def quote_order(items, discount=None, max_discount_percent=None):
+    """
+    Prices a cart exactly as create_order would, without locking or writing
+    anything; for the POS preview. Amounts are returned as ints.
+    """
+    priced = pricing.price_cart(
+        get_price_book(), _aggregate_cart(items), _line_discounts(items), pricing.parse_discount(discount),
+        max_discount_percent=max_discount_percent
+    )
+    for line in priced['lines']:
+        for key in ('unit_price', 'subtotal', 'discount'):
+            line[key] = int(line[key])
+    for key in ('subtotal', 'discount', 'tax', 'total'):
+        priced[key] = int(priced[key])
+    return priced
+
+PRODUCT_IMPORT_COLUMNS = ['name', 'price', 'category', 'image_url', 'is_inventory_managed', 'stock', 'barcode']
+DEFAULT_IMAGE_URL = 'https://placehold.co/400x300?text=No+Image'
+# products.image_url VARCHAR(255) and products.stock INT
+MAX_IMAGE_URL_LENGTH = 255
+MAX_STOCK = 2 ** 31 - 1
+
+def _parse_bool(value):
+    if isinstance(value, bool):
+        return value
+    return str(value or '').strip().lower() in ('1', 'true', 'yes', 'y', 'x')
+
+def parse_product_rows(filename, stream):
+    """
+    Reads products from an uploaded .xlsx or .csv file whose first row holds
+    the column names (name and price required; category, image_url,
+    is_inventory_managed, stock and barcode optional). Returns a list of dicts.
+    Optional columns the file does not have, and empty cells, come back as
+    None, which import_products leaves unchanged on existing products.
+    """
+    if filename.lower().endswith('.xlsx'):
+        import openpyxl  # only needed for uploads
+
+        wb = openpyxl.load_workbook(stream, read_only=True, data_only=True)
+        raw_rows = wb.active.iter_rows(values_only=True)
+    elif filename.lower().endswith('.csv'):
+        raw_rows = csv.reader(io.TextIOWrapper(stream, encoding='utf-8-sig'))
+    else:
+        raise ValueError("Upload an .xlsx or .csv file.")
+
+    header = next(raw_rows, None)
+    if not header:
+        raise ValueError("The file is empty.")
+    header = [str(h or '').strip().lower() for h in header]
+    for required in ('name', 'price'):
+        if required not in header:
+            raise ValueError(f"Missing '{required}' column.")
+
+    rows = []
+    for line, values in enumerate(raw_rows, start=2):
+        record = dict(zip(header, values))
+        name = str(record.get('name') or '').strip()
+        if not name:
+            continue
+        try:
+            price = Decimal(str(record.get('price')).strip())
+            managed = _parse_bool(record['is_inventory_managed']) if 'is_inventory_managed' in header else None
+            if managed is False:
+                stock = 0
+            else:
+                stock = int(record.get('stock') or 0) if 'stock' in header else None
+            if not price.is_finite():
+                raise ValueError
+        except (ArithmeticError, ValueError):
+            raise ValueError(f"Row {line}: invalid price or stock.")
+        if price < 0 or (stock or 0) < 0:
+            raise ValueError(f"Row {line}: price and stock must not be negative.")
+        if price > pricing.MAX_MONEY or (stock or 0) > MAX_STOCK:
+            raise ValueError(f"Row {line}: price or stock is too large.")
+        # A cut-off URL would only point somewhere else, so it is refused, not truncated
+        image_url = str(record.get('image_url') or '').strip()
+        if len(image_url) > MAX_IMAGE_URL_LENGTH:
+            raise ValueError(f"Row {line}: image_url is longer than {MAX_IMAGE_URL_LENGTH} characters.")
+        rows.append({
+            'name': name[:100],
+            'price': price,
+            'category': (str(record.get('category') or '').strip()[:50] or None),
+            'image_url': image_url or None,
+            'is_inventory_managed': managed,
+            'stock': stock,
+            'barcode': (str(record.get('barcode') or '').strip()[:64] or None),
+        })
+    return rows
+
+def import_products(rows):
+    """
+    Upserts products by name in one transaction: rows are COPYed into a
+    temporary table, then existing names are updated and new names inserted
+    with one statement each. When a name repeats in the file the last row
+    wins; None values keep what an existing product has. Returns
+    {'created': n, 'updated': n}.
+    """
+    if not rows:
+        return {'created': 0, 'updated': 0}
+
+    buf = io.StringIO()
+    writer = csv.writer(buf)
+    for line, row in enumerate(rows):
+        writer.writerow([line] + [
+            '' if row[col] is None else row[col] for col in PRODUCT_IMPORT_COLUMNS
+        ])
+    buf.seek(0)
+
+    try:
+        return _import_products(buf)
+    except psycopg2.errors.UniqueViolation:
+        raise ValueError("A barcode in the file is already used by another product.")
+
+def _import_products(buf):
+    with get_db_cursor(commit=True) as cur:
+        cur.execute(
+            """
+            CREATE TEMP TABLE product_import (
+                line INT,
+                name VARCHAR(100),
+                price DECIMAL(15, 0),
+                category VARCHAR(50),
+                image_url VARCHAR(255),
+                is_inventory_managed BOOLEAN,
+                stock INT,
+                barcode VARCHAR(64)
+            ) ON COMMIT DROP
+            """
+        )
+        cur.copy_expert(
+            "COPY product_import FROM STDIN WITH (FORMAT csv)",
+            buf
+        )
+
+        # products.name is not unique, so block concurrent product writes
+        # (not reads) while matching on it
+        cur.execute("LOCK TABLE products IN SHARE ROW EXCLUSIVE MODE")
+        cur.execute(
+            """
+            WITH src AS (
+                SELECT DISTINCT ON (name) * FROM product_import ORDER BY name, line DESC
+            )
+            UPDATE products AS p
+            SET price = src.price,
+                category = COALESCE(src.category, p.category),
+                image_url = COALESCE(src.image_url, p.image_url),
+                is_inventory_managed = COALESCE(src.is_inventory_managed, p.is_inventory_managed),
+                stock = COALESCE(src.stock, p.stock),
+                barcode = COALESCE(src.barcode, p.barcode)
+            FROM src
+            WHERE p.name = src.name
+            RETURNING p.id
+            """
+        )
+        updated_ids = [r['id'] for r in cur.fetchall()]
+        cur.execute(
+            """
+            WITH src AS (
+                SELECT DISTINCT ON (name) * FROM product_import ORDER BY name, line DESC
+            )
+            INSERT INTO products (name, price, category, image_url, is_inventory_managed, stock, barcode)
+            SELECT name, price, category, COALESCE(image_url, %s),
+                   COALESCE(is_inventory_managed, FALSE), COALESCE(stock, 0), barcode
+            FROM src
+            WHERE NOT EXISTS (SELECT 1 FROM products p WHERE p.name = src.name)
+            ORDER BY line
+            RETURNING id
+            """,
+            (DEFAULT_IMAGE_URL,)
+        )
+        created_ids = [r['id'] for r in cur.fetchall()]
+
+        if updated_ids or created_ids:
+            bump_catalog_version(cur, updated_ids + created_ids)
+
+    return {'created': len(created_ids), 'updated': len(updated_ids)}
 
 def get_products(category=None):
     query = "SELECT * FROM products"
@@ -165,7 +1037,7 @@ def get_products(category=None):
         params.append(category)
     query += " ORDER BY name"
 
-    with get_db_cursor() as cur:
+    with get_db_cursor(readonly=True) as cur:
         cur.execute(query, tuple(params))
         products = cur.fetchall()
         # Convert Decimal price to int for JSON serialization
@@ -173,26 +1045,156 @@ def get_products(category=None):
             p['price'] = int(p['price'])
         return products
 
+SEARCH_FIELDS = ('id', 'name', 'price', 'category', 'image_url', 'is_inventory_managed', 'stock', 'barcode',
+                 'version', 'thumbnail_url', 'thumbnail_jpeg_url')
+SEARCH_DEFAULT_FIELDS = ('id', 'name', 'price', 'category', 'is_inventory_managed', 'stock',
+                         'thumbnail_url', 'thumbnail_jpeg_url')
+SEARCH_MAX_LIMIT = 100
+# Below this many characters trigrams cannot narrow anything down, so only
+# name prefixes (and barcodes) are matched
+SEARCH_MIN_FUZZY_LENGTH = 3
+
+def search_products(query='', category=None, fields=None, limit=20, offset=0):
+    """
+    Searches products by barcode/SKU, name prefix, name substring and fuzzy
+    name (pg_trgm word similarity, so typos still match), best match first:
+    an exact barcode, then prefixes, then the rest by similarity. An empty
+    query lists the category by name.
+
+    `fields` picks the columns returned (default SEARCH_DEFAULT_FIELDS),
+    thumbnail URLs included. Returns {'items': [...], 'next_offset': n or None}.
+    """
+    fields = list(fields or SEARCH_DEFAULT_FIELDS)
+    unknown = [f for f in fields if f not in SEARCH_FIELDS]
+    if unknown:
+        raise ValueError(f"Unknown fields: {', '.join(unknown)}")
+    limit = min(max(int(limit), 1), SEARCH_MAX_LIMIT)
+    offset = max(int(offset), 0)
+
+    thumbnails = [f for f in fields if f.startswith('thumbnail_')]
+    columns = [f for f in fields if not f.startswith('thumbnail_')]
+    if thumbnails and 'image_url' not in columns:
+        columns.append('image_url')
+
+    term = ' '.join(str(query or '').split()).lower()
+    escaped = term.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+    params = {'raw': str(query or '').strip(), 'term': term, 'prefix': escaped + '%',
+              'contains': '%' + escaped + '%', 'category': category, 'limit': limit + 1, 'offset': offset}
+
+    if not term:
+        match_sql, rank_sql = "TRUE", "0"
+    elif len(term) < SEARCH_MIN_FUZZY_LENGTH:
+        match_sql = "p.barcode = %(raw)s OR lower(p.name) LIKE %(prefix)s"
+        rank_sql = "COALESCE(p.barcode = %(raw)s, FALSE)::int * 4 + (lower(p.name) LIKE %(prefix)s)::int * 2"
+    else:
+        match_sql = ("p.barcode = %(raw)s OR lower(p.name) LIKE %(contains)s "
+                     "OR %(term)s <%% lower(p.name)")
+        rank_sql = ("COALESCE(p.barcode = %(raw)s, FALSE)::int * 4 + (lower(p.name) LIKE %(prefix)s)::int * 2 "
+                    "+ word_similarity(%(term)s, lower(p.name))")
+    category_sql = "AND p.category = %(category)s" if category else ""
+
+    with get_db_cursor(readonly=True) as cur:
+        cur.execute(
+            f"""
+            SELECT {', '.join('p.' + c for c in columns)}
+            FROM products p
+            WHERE ({match_sql}) {category_sql}
+            ORDER BY {rank_sql} DESC, p.name, p.id
+            LIMIT %(limit)s OFFSET %(offset)s
+            """,
+            params
+        )
+        rows = cur.fetchall()
+
+    next_offset = offset + limit if len(rows) > limit else None
+    items = []
+    for row in rows[:limit]:
+        if 'price' in row:
+            row['price'] = int(row['price'])
+        if thumbnails:
+            urls = images.thumbnail_urls(row['image_url'])
+            row.update({f: urls[f] for f in thumbnails})
+            if 'image_url' not in fields:
+                del row['image_url']
+        items.append(row)
+    return {'items': items, 'next_offset': next_offset}
+
 def get_dashboard_stats():
+    """Today's and this month's paid sales, read from daily_sales_summary."""
     today = datetime.date.today()
     month_start = today.replace(day=1)
 
-    with get_db_cursor() as cur:
-        # Daily Sales
+    with get_db_cursor(readonly=True) as cur:
         cur.execute(
-            "SELECT COALESCE(SUM(total_amount), 0) as total FROM orders WHERE DATE(created_at) = %s AND status = 'paid'",
-            (today,)
+            """
+            SELECT COALESCE(SUM(paid_total) FILTER (WHERE day = %s), 0) as daily,
+                   COALESCE(SUM(paid_total), 0) as monthly
+            FROM daily_sales_summary
+            WHERE day >= %s
+            """,
+            (today, month_start)
         )
-        daily_sales = cur.fetchone()['total']
+        result = cur.fetchone()
+
+        return {
+            'daily_sales': result['daily'],
+            'monthly_sales': result['monthly']
+        }
 
-        # Monthly Sales
+def get_sales_chart(days=7):
+    """Paid sales totals for the last `days` days that had sales, oldest first."""
+    with get_db_cursor(readonly=True) as cur:
         cur.execute(
-            "SELECT COALESCE(SUM(total_amount), 0) as total FROM orders WHERE DATE(created_at) >= %s AND status = 'paid'",
-            (month_start,)
+            """
+            SELECT day as date, SUM(paid_total) as total
+            FROM daily_sales_summary
+            GROUP BY day
+            HAVING SUM(paid_count) > 0
+            ORDER BY day DESC
+            LIMIT %s
+            """,
+            (days,)
         )
-        monthly_sales = cur.fetchone()['total']
+        results = cur.fetchall()
 
-        return {
-            'daily_sales': daily_sales,
-            'monthly_sales': monthly_sales
-        }
+    results.reverse()
+    return results
+
+def rebuild_daily_sales_summary(cur, date_from=None, date_to=None):
+    """
+    Recomputes daily_sales_summary from orders, for all days or for the
+    inclusive [date_from, date_to] range. Writers are blocked on the orders
+    table while this runs so no checkout can slip between delete and insert.
+    """
+    cur.execute("LOCK TABLE orders IN SHARE MODE")
+
+    where_sql, params = build_order_filters(date_from=date_from, date_to=date_to)
+    day_clauses = []
+    day_params = []
+    if date_from:
+        day_clauses.append("day >= %s")
+        day_params.append(date_from)
+    if date_to:
+        day_clauses.append("day <= %s")
+        day_params.append(date_to)
+    day_where = ("WHERE " + " AND ".join(day_clauses)) if day_clauses else ""
+
+    cur.execute(f"DELETE FROM daily_sales_summary {day_where}", tuple(day_params))
+    cur.execute(
+        f"""
+        INSERT INTO daily_sales_summary
+            (day, payment_method, paid_count, paid_total, paid_tax, void_count, void_total, void_tax)
+        SELECT o.created_at::date, o.payment_method,
+               COUNT(*) FILTER (WHERE o.status = 'paid'),
+               COALESCE(SUM(o.total_amount) FILTER (WHERE o.status = 'paid'), 0),
+               COALESCE(SUM(o.tax_amount) FILTER (WHERE o.status = 'paid'), 0),
+               COUNT(*) FILTER (WHERE o.status = 'void'),
+               COALESCE(SUM(o.total_amount) FILTER (WHERE o.status = 'void'), 0),
+               COALESCE(SUM(o.tax_amount) FILTER (WHERE o.status = 'void'), 0)
+        FROM orders o
+        {where_sql}
+        GROUP BY 1, 2
+        """,
+        tuple(params)
+    )
+    return cur.rowcount
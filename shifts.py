@@ -0,0 +1,292 @@
+"""
+Cashier shifts and their end-of-day (Z) reports.
+
+A cashier opens a shift before selling and closes it at the end of the
+day. Every order records its cashier and the shift that was open for them
+when it committed. Running totals live in shift_totals, one row per
+(shift, payment method):
+
+    paid_count, paid_total, paid_tax    orders still paid
+    void_count, void_total, void_tax    orders voided since
+
+They are kept current inside the checkout and void transactions (see
+add_order_delta/apply_deltas), so the current totals and the Z-report are
+a read of a handful of rows however many orders the shift took; each
+cashier writes only their own rows, so shifts never contend with each
+other. rebuild() recomputes them from orders.
+
+Checkout takes a share lock on the open shift row and closing takes an
+exclusive one, so an order commits either before the close (and is in the
+report) or after it (and belongs to no shift). The report is stored on the
+shift when it is closed; voiding one of its orders later still moves the
+totals, like the daily summary, but not the printed report.
+"""
+import datetime
+import json
+import psycopg2.errors
+from psycopg2.extras import execute_values
+from db import get_db_cursor
+from pricing import MAX_MONEY
+
+# --- INCREMENTAL MAINTENANCE ---
+
+def add_order_delta(deltas, order, voided=False):
+    """
+    Accumulates the shift_totals change caused by creating (or voiding)
+    `order` into `deltas`, keyed by (shift_id, payment_method). Orders
+    taken outside a shift (no shift_id) are skipped.
+    """
+    if order.get('shift_id') is None:
+        return
+    key = (order['shift_id'], order['payment_method'])
+    delta = deltas.setdefault(key, [0, 0, 0, 0, 0, 0])
+    sign = -1 if voided else 1
+    delta[0] += sign
+    delta[1] += sign * order['total_amount']
+    delta[2] += sign * order['tax_amount']
+    if voided:
+        delta[3] += 1
+        delta[4] += order['total_amount']
+        delta[5] += order['tax_amount']
+
+def apply_deltas(cur, deltas):
+    """Upserts accumulated deltas into shift_totals in one statement, rows in key order."""
+    if not deltas:
+        return
+    execute_values(
+        cur,
+        """
+        INSERT INTO shift_totals
+            (shift_id, payment_method, paid_count, paid_total, paid_tax, void_count, void_total, void_tax)
+        VALUES %s
+        ON CONFLICT (shift_id, payment_method) DO UPDATE SET
+            paid_count = shift_totals.paid_count + EXCLUDED.paid_count,
+            paid_total = shift_totals.paid_total + EXCLUDED.paid_total,
+            paid_tax = shift_totals.paid_tax + EXCLUDED.paid_tax,
+            void_count = shift_totals.void_count + EXCLUDED.void_count,
+            void_total = shift_totals.void_total + EXCLUDED.void_total,
+            void_tax = shift_totals.void_tax + EXCLUDED.void_tax
+        """,
+        [key + tuple(delta) for key, delta in sorted(deltas.items())],
+        page_size=len(deltas)
+    )
+
+def rebuild(cur, date_from=None, date_to=None):
+    """
+    Recomputes shift_totals from orders for the shifts opened in the
+    inclusive [date_from, date_to] range (all shifts by default). Expects
+    orders to be locked against writers already (see
+    services.rebuild_daily_sales_summary). Stored Z-reports are left as
+    printed. Returns the number of rows inserted.
+    """
+    clauses, params = [], []
+    if date_from:
+        clauses.append("opened_at >= %s")
+        params.append(date_from)
+    if date_to:
+        clauses.append("opened_at < %s")
+        params.append(date_to + datetime.timedelta(days=1))
+    shift_where = ("WHERE " + " AND ".join(clauses)) if clauses else ""
+    # Orders are never older than their shift, which lets the scan skip
+    # partitions before date_from
+    order_where = "AND o.created_at >= %s" if date_from else ""
+    order_params = [date_from] if date_from else []
+
+    cur.execute(
+        f"DELETE FROM shift_totals WHERE shift_id IN (SELECT id FROM shifts {shift_where})",
+        tuple(params)
+    )
+    cur.execute(
+        f"""
+        INSERT INTO shift_totals
+            (shift_id, payment_method, paid_count, paid_total, paid_tax, void_count, void_total, void_tax)
+        SELECT o.shift_id, o.payment_method,
+               COUNT(*) FILTER (WHERE o.status = 'paid'),
+               COALESCE(SUM(o.total_amount) FILTER (WHERE o.status = 'paid'), 0),
+               COALESCE(SUM(o.tax_amount) FILTER (WHERE o.status = 'paid'), 0),
+               COUNT(*) FILTER (WHERE o.status = 'void'),
+               COALESCE(SUM(o.total_amount) FILTER (WHERE o.status = 'void'), 0),
+               COALESCE(SUM(o.tax_amount) FILTER (WHERE o.status = 'void'), 0)
+        FROM orders o
+        WHERE o.shift_id IN (SELECT id FROM shifts {shift_where}) {order_where}
+        GROUP BY 1, 2
+        """,
+        tuple(params + order_params)
+    )
+    return cur.rowcount
+
+# --- SHIFTS ---
+
+SHIFT_COLUMNS = """
+    s.id, s.cashier_id, u.username AS cashier, s.opened_at, s.closed_at, s.opening_float, s.counted_cash
+"""
+
+def _load_totals(cur, shift_id):
+    cur.execute(
+        """
+        SELECT payment_method, paid_count, paid_total, paid_tax, void_count, void_total, void_tax
+        FROM shift_totals
+        WHERE shift_id = %s
+        ORDER BY payment_method
+        """,
+        (shift_id,)
+    )
+    return cur.fetchall()
+
+def build_report(shift, totals):
+    """
+    The Z-report of `shift` from its shift_totals rows, JSON-ready.
+    Gross is everything rung up, net what is left after voids; expected
+    cash is the opening float plus net cash sales.
+    """
+    payments = [
+        {
+            'payment_method': t['payment_method'],
+            'count': int(t['paid_count']),
+            'total': int(t['paid_total']),
+            'tax': int(t['paid_tax']),
+            'void_count': int(t['void_count']),
+            'void_total': int(t['void_total']),
+        }
+        for t in totals
+    ]
+    net = sum(p['total'] for p in payments)
+    void_total = sum(p['void_total'] for p in payments)
+    cash = sum(p['total'] for p in payments if p['payment_method'] == 'cash')
+    expected_cash = int(shift['opening_float']) + cash
+    counted_cash = int(shift['counted_cash']) if shift['counted_cash'] is not None else None
+
+    return {
+        'shift_id': shift['id'],
+        'cashier_id': shift['cashier_id'],
+        'cashier': shift['cashier'],
+        'opened_at': shift['opened_at'].isoformat(),
+        'closed_at': shift['closed_at'].isoformat() if shift['closed_at'] else None,
+        'order_count': sum(p['count'] + p['void_count'] for p in payments),
+        'gross': net + void_total,
+        'net': net,
+        'tax': sum(p['tax'] for p in payments),
+        'void_count': sum(p['void_count'] for p in payments),
+        'void_total': void_total,
+        'payments': payments,
+        'opening_float': int(shift['opening_float']),
+        'expected_cash': expected_cash,
+        'counted_cash': counted_cash,
+        'cash_variance': counted_cash - expected_cash if counted_cash is not None else None,
+    }
+
+def _parse_cash(value, label):
+    """`value` as whole rupiah; ValueError unless it is an int that fits the DECIMAL(15, 0) columns."""
+    # bool is an int too; floats (JSON 1e999 is inf) and strings are refused
+    if isinstance(value, bool) or not isinstance(value, int):
+        raise ValueError(f"{label} must be a whole number.")
+    if value < 0:
+        raise ValueError(f"{label} cannot be negative.")
+    if value > MAX_MONEY:
+        raise ValueError(f"{label} is too large.")
+    return value
+
+def open_shift(cashier_id, opening_float=0):
+    """Opens a shift for the cashier. ValueError if they already have one open."""
+    opening_float = _parse_cash(0 if opening_float is None else opening_float, "Opening float")
+    try:
+        with get_db_cursor(commit=True) as cur:
+            cur.execute(
+                """
+                INSERT INTO shifts (cashier_id, opening_float)
+                VALUES (%s, %s)
+                RETURNING id, opened_at
+                """,
+                (cashier_id, opening_float)
+            )
+            shift = cur.fetchone()
+    except psycopg2.errors.UniqueViolation:
+        # idx_shifts_open_cashier: one open shift per cashier
+        raise ValueError("A shift is already open.")
+    return {'shift_id': shift['id'], 'opened_at': shift['opened_at'].isoformat(), 'opening_float': opening_float}
+
+def current_shift(cashier_id):
+    """The cashier's open shift with its running totals, or None."""
+    with get_db_cursor() as cur:
+        cur.execute(
+            f"""
+            SELECT {SHIFT_COLUMNS}
+            FROM shifts s
+            JOIN users u ON u.id = s.cashier_id
+            WHERE s.cashier_id = %s AND s.closed_at IS NULL
+            """,
+            (cashier_id,)
+        )
+        shift = cur.fetchone()
+        if shift is None:
+            return None
+        return build_report(shift, _load_totals(cur, shift['id']))
+
+def close_shift(cashier_id, counted_cash=None):
+    """
+    Closes the cashier's open shift and returns its Z-report, which is
+    stored on the shift. ValueError if no shift is open.
+    """
+    if counted_cash is not None:
+        counted_cash = _parse_cash(counted_cash, "Counted cash")
+
+    with get_db_cursor(commit=True) as cur:
+        # Waits for checkouts already holding the shift, so their totals are in
+        cur.execute(
+            f"""
+            UPDATE shifts s
+            SET closed_at = CURRENT_TIMESTAMP, counted_cash = %s
+            FROM users u
+            WHERE u.id = s.cashier_id AND s.cashier_id = %s AND s.closed_at IS NULL
+            RETURNING {SHIFT_COLUMNS}
+            """,
+            (counted_cash, cashier_id)
+        )
+        shift = cur.fetchone()
+        if shift is None:
+            raise ValueError("No open shift.")
+        report = build_report(shift, _load_totals(cur, shift['id']))
+        cur.execute("UPDATE shifts SET z_report = %s WHERE id = %s", (json.dumps(report), shift['id']))
+    return report
+
+def get_report(shift_id):
+    """
+    The stored Z-report of a closed shift, or the running one of an open
+    shift. None if there is no such shift.
+    """
+    with get_db_cursor(readonly=True) as cur:
+        cur.execute(
+            f"""
+            SELECT {SHIFT_COLUMNS}, s.z_report
+            FROM shifts s
+            JOIN users u ON u.id = s.cashier_id
+            WHERE s.id = %s
+            """,
+            (shift_id,)
+        )
+        shift = cur.fetchone()
+        if shift is None:
+            return None
+        if shift['z_report'] is not None:
+            return shift['z_report']
+        return build_report(shift, _load_totals(cur, shift_id))
+
+def list_shifts(day):
+    """Shifts opened on `day`, with their net totals, newest first."""
+    with get_db_cursor(readonly=True) as cur:
+        cur.execute(
+            f"""
+            SELECT {SHIFT_COLUMNS},
+                   COALESCE(SUM(t.paid_count), 0) AS paid_count,
+                   COALESCE(SUM(t.paid_total), 0) AS paid_total,
+                   COALESCE(SUM(t.void_count), 0) AS void_count
+            FROM shifts s
+            JOIN users u ON u.id = s.cashier_id
+            LEFT JOIN shift_totals t ON t.shift_id = s.id
+            WHERE s.opened_at >= %s AND s.opened_at < %s
+            GROUP BY s.id, u.username
+            ORDER BY s.opened_at DESC, s.id DESC
+            """,
+            (day, day + datetime.timedelta(days=1))
+        )
+        return cur.fetchall()
@@ -1,31 +1,193 @@
 // State
 let cart = {}; // {productId: {product: obj, qty: int}}
 let products = [];
+let catalogVersion = null;
+
+// Offline queue: orders are persisted locally and synced in batches, so
+// checkout never waits on the network and a retry can never double charge.
+// An order the server refuses (4xx) is moved aside to REJECTED_KEY and
+// shown to the cashier instead of blocking every sale queued behind it.
+const QUEUE_KEY = 'pos.pendingOrders';
+const REJECTED_KEY = 'pos.rejectedOrders';
+const SYNC_INTERVAL_MS = 5000;
+const SYNC_BATCH_SIZE = 50;
+let syncing = false;
+let isolating = false; // a batch was refused as a whole: send one order at a time to find the culprit
 let currentPaymentMethod = 'cash';
 let currentTotal = 0;
 
+// Cart totals are estimated locally at the default tax rate, then replaced
+// by the server's exact pricing (tax rules, rounding) once the cart settles.
+const PRICE_DEBOUNCE_MS = 150;
+let priceTimer = null;
+let priceSeq = 0;
+
+// Search runs on the server (ranked, fuzzy, barcodes) and returns only the
+// columns the grid renders; stock shown is still the live catalog's.
+const SEARCH_DEBOUNCE_MS = 200;
+const SEARCH_LIMIT = 48;
+const SEARCH_FIELDS = 'id,name,price,category,is_inventory_managed,stock,image_url,thumbnail_url,thumbnail_jpeg_url';
+let searchTimer = null;
+let searchSeq = 0;
+let searchResults = null; // null while not searching
+
+// Stock and price changes are pushed over /api/events; while the stream is
+// up there is no need to refetch the catalog after checkout.
+let eventsConnected = false;
+
+// The cashier's open shift (null when none); orders are credited to it
+let currentShift = null;
+
 // Init
 document.addEventListener('DOMContentLoaded', () => {
     fetchProducts();
+    connectEvents();
+    loadShift();
+    updateQueueStatus();
+    syncOrders();
+    setInterval(syncOrders, SYNC_INTERVAL_MS);
+    window.addEventListener('online', syncOrders);
 });
 
 // Fetch Products
+// The browser revalidates with If-None-Match, so an unchanged catalog costs a 304.
 async function fetchProducts() {
     try {
         const res = await fetch('/api/products');
         products = await res.json();
+        catalogVersion = parseInt(res.headers.get('X-Catalog-Version'));
         renderProducts();
     } catch (err) {
         showToast('Error loading products', 'error');
     }
 }
 
+// Pull only the products changed since the version we hold
+async function refreshProducts() {
+    if (catalogVersion === null || isNaN(catalogVersion)) return fetchProducts();
+    try {
+        const res = await fetch(`/api/products?since=${catalogVersion}`);
+        const delta = await res.json();
+        applyCatalogDelta(delta);
+    } catch (err) {
+        showToast('Error loading products', 'error');
+    }
+}
+
+function applyCatalogDelta(delta) {
+    if (delta.reset) {
+        products = delta.changed;
+    } else {
+        const byId = new Map(products.map(p => [p.id, p]));
+        delta.changed.forEach(p => byId.set(p.id, p));
+        delta.removed.forEach(id => byId.delete(id));
+        products = Array.from(byId.values()).sort((a, b) => a.name.localeCompare(b.name));
+    }
+    catalogVersion = delta.version;
+    renderProducts();
+}
+
+function connectEvents() {
+    if (!window.EventSource) return;
+    const source = new EventSource('/api/events');
+    source.onopen = () => {
+        eventsConnected = true;
+        refreshProducts(); // Catch up on anything missed while disconnected
+    };
+    source.onerror = () => {
+        // The browser reconnects on its own unless the server refused (e.g. 503)
+        eventsConnected = false;
+    };
+    source.onmessage = e => applyCatalogEvent(JSON.parse(e.data));
+}
+
+// Events carry the new catalog version, and for stock-only changes
+// (checkout, void) the price and stock of the products touched. Anything
+// else (other edits, a gap in versions, a new product, an oversized
+// change) comes without products and falls back to a ?since= fetch.
+function applyCatalogEvent(event) {
+    if (catalogVersion === null || isNaN(catalogVersion)) return;
+    if (event.resync) return refreshProducts();
+    if (event.version <= catalogVersion) return;
+
+    const byId = new Map(products.map(p => [p.id, p]));
+    const complete = event.version === catalogVersion + 1 && event.products
+        && event.products.every(p => byId.has(p.id));
+    if (!complete) return refreshProducts();
+
+    event.products.forEach(change => Object.assign(byId.get(change.id), change));
+    if (event.removed.length) {
+        const removed = new Set(event.removed);
+        products = products.filter(p => !removed.has(p.id));
+    }
+    catalogVersion = event.version;
+    renderProducts();
+}
+
+// Search
+function scheduleSearch() {
+    clearTimeout(searchTimer);
+    searchTimer = setTimeout(runSearch, SEARCH_DEBOUNCE_MS);
+}
+
+async function runSearch() {
+    const q = document.getElementById('product-search').value.trim();
+    const seq = ++searchSeq;
+    if (!q) {
+        searchResults = null;
+        renderProducts();
+        return null;
+    }
+
+    let results;
+    try {
+        const params = new URLSearchParams({ q: q, limit: SEARCH_LIMIT, fields: SEARCH_FIELDS });
+        const res = await fetch(`/api/products/search?${params}`);
+        if (!res.ok) throw new Error(res.statusText);
+        results = (await res.json()).items;
+    } catch (err) {
+        // Offline: plain substring match over the catalog we hold
+        const term = q.toLowerCase();
+        results = products.filter(p => p.name.toLowerCase().includes(term) || p.barcode === q).slice(0, SEARCH_LIMIT);
+    }
+    if (seq !== searchSeq) return null; // superseded by a newer search
+
+    searchResults = results;
+    renderProducts();
+    return results;
+}
+
+// Barcode scanners type the code and press Enter: a single hit goes straight into the cart
+async function submitSearch() {
+    clearTimeout(searchTimer);
+    const results = await runSearch();
+    if (results && results.length === 1) {
+        const input = document.getElementById('product-search');
+        input.value = '';
+        searchResults = null;
+        addToCart(liveProduct(results[0]));
+        renderProducts();
+        input.focus();
+    }
+}
+
+// The catalog's copy of a product, kept current by pushed stock changes
+function liveProduct(p) {
+    return products.find(c => c.id === p.id) || p;
+}
+
 // Render Grid
 function renderProducts() {
     const grid = document.getElementById('product-grid');
     grid.innerHTML = '';
 
-    products.forEach(p => {
+    let shown = products;
+    if (searchResults) {
+        const byId = new Map(products.map(p => [p.id, p]));
+        shown = searchResults.map(p => byId.get(p.id) || p);
+    }
+
+    shown.forEach(p => {
         const qtyInCart = cart[p.id] ? cart[p.id].qty : 0;
 
         const card = document.createElement('div');
@@ -49,7 +211,10 @@ function renderProducts() {
         card.innerHTML = `
             ${badge}
             <div class="h-32 bg-slate-200 relative">
-                <img src="${p.image_url}" class="w-full h-full object-cover">
+                <picture>
+                    <source srcset="${p.thumbnail_url || p.image_url}" type="image/webp">
+                    <img src="${p.thumbnail_jpeg_url || p.image_url}" loading="lazy" decoding="async" class="w-full h-full object-cover">
+                </picture>
                 ${stockLabel}
             </div>
             <div class="p-3">
@@ -126,12 +291,46 @@ function updateCartUI() {
         });
     }
 
-    const tax = Math.floor(subtotal * 0.10);
-    currentTotal = subtotal + tax;
+    renderSummary(subtotal, Math.floor(subtotal * 0.10), subtotal + Math.floor(subtotal * 0.10));
+    schedulePricing();
+}
 
+function renderSummary(subtotal, tax, total) {
+    currentTotal = total;
     document.getElementById('summary-subtotal').innerText = formatRp(subtotal);
     document.getElementById('summary-tax').innerText = formatRp(tax);
-    document.getElementById('summary-total').innerText = formatRp(currentTotal);
+    document.getElementById('summary-total').innerText = formatRp(total);
+}
+
+function cartItems() {
+    return Object.values(cart).map(i => ({
+        id: i.product.id,
+        quantity: i.qty
+    }));
+}
+
+function schedulePricing() {
+    clearTimeout(priceTimer);
+    const seq = ++priceSeq;
+    if (Object.keys(cart).length === 0) return;
+    priceTimer = setTimeout(() => fetchPricing(seq), PRICE_DEBOUNCE_MS);
+}
+
+async function fetchPricing(seq) {
+    try {
+        const res = await fetch('/api/price', {
+            method: 'POST',
+            headers: { 'Content-Type': 'application/json' },
+            body: JSON.stringify({ items: cartItems() })
+        });
+        if (!res.ok) return;
+        const priced = await res.json();
+        // Ignore answers for a cart that has changed since
+        if (seq !== priceSeq) return;
+        renderSummary(priced.subtotal, priced.tax, priced.total);
+    } catch (err) {
+        // Offline: keep the local estimate
+    }
 }
 
 // Payment Modal
@@ -191,44 +390,209 @@ function calculateChange() {
 }
 
 // Submit Order
-async function submitOrder() {
+function submitOrder() {
     const btnConfirm = document.getElementById('btn-confirm');
     btnConfirm.disabled = true;
-    btnConfirm.innerText = "Processing...";
 
-    const items = Object.values(cart).map(i => ({
-        id: i.product.id,
-        quantity: i.qty
-    }));
+    const order = {
+        idempotency_key: newIdempotencyKey(),
+        items: cartItems(),
+        payment_method: currentPaymentMethod,
+        queued_at: new Date().toISOString()
+    };
+
+    // Reserve stock locally until the server confirms
+    Object.values(cart).forEach(i => {
+        if (i.product.is_inventory_managed) i.product.stock -= i.qty;
+    });
+
+    enqueueOrder(order);
+    showToast('Order saved', 'success');
+    cart = {};
+    updateCartUI();
+    closePaymentModal();
+    syncOrders();
+}
+
+// Order Queue
+function newIdempotencyKey() {
+    if (window.crypto && crypto.randomUUID) return crypto.randomUUID();
+    return 'k-' + Date.now().toString(36) + '-' + Math.random().toString(36).slice(2, 12);
+}
+
+function loadQueue() {
+    try {
+        return JSON.parse(localStorage.getItem(QUEUE_KEY)) || [];
+    } catch (err) {
+        return [];
+    }
+}
+
+function saveQueue(queue) {
+    localStorage.setItem(QUEUE_KEY, JSON.stringify(queue));
+    updateQueueStatus();
+}
+
+function enqueueOrder(order) {
+    const queue = loadQueue();
+    queue.push(order);
+    saveQueue(queue);
+}
 
+function loadRejected() {
     try {
-        const res = await fetch('/api/order', {
+        return JSON.parse(localStorage.getItem(REJECTED_KEY)) || [];
+    } catch (err) {
+        return [];
+    }
+}
+
+function rejectOrders(rejected) {
+    localStorage.setItem(REJECTED_KEY, JSON.stringify(loadRejected().concat(rejected)));
+    rejected.forEach(r => showToast(`Order rejected: ${r.error}`, 'error'));
+    updateQueueStatus();
+}
+
+function showRejectedOrders() {
+    const rejected = loadRejected();
+    if (rejected.length === 0) return;
+    const lines = rejected.map(r =>
+        `${r.order.queued_at || ''} ${r.order.payment_method}, ${r.order.items.length} item(s): ${r.error}`
+    );
+    if (confirm(`Orders the server refused (not charged):\n\n${lines.join('\n')}\n\nClear this list?`)) {
+        localStorage.removeItem(REJECTED_KEY);
+        updateQueueStatus();
+    }
+}
+
+function updateQueueStatus() {
+    const el = document.getElementById('queue-status');
+    if (el) {
+        const pending = loadQueue().length;
+        el.innerText = pending ? `${pending} pending` : '';
+        el.classList.toggle('hidden', pending === 0);
+    }
+    const rejectedEl = document.getElementById('rejected-status');
+    if (rejectedEl) {
+        const rejected = loadRejected().length;
+        rejectedEl.innerText = rejected ? `${rejected} rejected` : '';
+        rejectedEl.classList.toggle('hidden', rejected === 0);
+    }
+}
+
+async function syncOrders() {
+    if (syncing) return;
+    const batch = loadQueue().slice(0, isolating ? 1 : SYNC_BATCH_SIZE);
+    if (batch.length === 0) return;
+
+    syncing = true;
+    let synced = false;
+    try {
+        const res = await fetch('/api/orders/batch', {
             method: 'POST',
             headers: {'Content-Type': 'application/json'},
-            body: JSON.stringify({
-                items: items,
-                payment_method: currentPaymentMethod
-            })
+            body: JSON.stringify({ orders: batch })
         });
-
-        const data = await res.json();
-
-        if (res.ok) {
-            showToast(`Order Success! ${data.data.transaction_code}`, 'success');
-            cart = {};
-            updateCartUI();
-            closePaymentModal();
-            fetchProducts(); // Refresh stock
-        } else {
-            showToast(data.error || 'Transaction failed', 'error');
+        if (res.status >= 400 && res.status < 500) {
+            // Refused as sent, so resending it can never succeed
+            if (batch.length > 1) {
+                isolating = true;
+            } else {
+                const data = await res.json().catch(() => ({}));
+                const keys = new Set(batch.map(o => o.idempotency_key));
+                saveQueue(loadQueue().filter(o => !keys.has(o.idempotency_key)));
+                rejectOrders(batch.map(order => ({ order, error: data.error || `HTTP ${res.status}` })));
+                isolating = false;
+            }
+            synced = true;
+        } else if (res.ok) {
+            const data = await res.json();
+            const done = new Set();
+            const rejected = [];
+            data.results.forEach(r => {
+                done.add(r.idempotency_key);
+                if (r.status === 'error') {
+                    rejected.push({ order: batch.find(o => o.idempotency_key === r.idempotency_key), error: r.error });
+                } else if (r.status === 'success') {
+                    showToast(`Order Success! ${r.data.transaction_code}`, 'success');
+                }
+            });
+
+            // Re-read: orders may have been queued while the request was in flight
+            saveQueue(loadQueue().filter(o => !done.has(o.idempotency_key)));
+            if (rejected.length) rejectOrders(rejected);
+            synced = true;
+            if (!eventsConnected) refreshProducts(); // Otherwise the stock change is pushed
         }
+        // 5xx: server trouble, keep everything queued and retry later
     } catch (err) {
-        showToast('Network error', 'error');
+        // Offline: the queue is persisted, the next tick retries
     } finally {
-        btnConfirm.innerText = "Complete Order";
-        // Do not re-enable if success, modal closes. If error, maybe re-enable.
-        if (Object.keys(cart).length > 0) btnConfirm.disabled = false;
+        syncing = false;
+    }
+
+    // Drain the rest of a backlog right away; failures wait for the next tick
+    if (synced && loadQueue().length > 0) {
+        setTimeout(syncOrders, 0);
+    }
+}
+
+// Shift
+async function loadShift() {
+    try {
+        const res = await fetch('/api/shift');
+        if (res.ok) currentShift = (await res.json()).shift;
+    } catch (err) {
+        // Offline: keep the last known state
+    }
+    renderShift();
+}
+
+function renderShift() {
+    const btn = document.getElementById('btn-shift');
+    if (!btn) return;
+    btn.innerText = currentShift ? `Close Shift #${currentShift.shift_id}` : 'Open Shift';
+}
+
+async function toggleShift() {
+    if (currentShift) return closeShift();
+
+    const openingFloat = prompt('Opening cash float (Rp):', '0');
+    if (openingFloat === null) return;
+    const res = await fetch('/api/shift/open', {
+        method: 'POST',
+        headers: {'Content-Type': 'application/json'},
+        body: JSON.stringify({ opening_float: parseInt(openingFloat, 10) || 0 })
+    });
+    const data = await res.json();
+    if (!res.ok) {
+        showToast(data.error, 'error');
+        return loadShift();
+    }
+    showToast(`Shift #${data.data.shift_id} opened`, 'success');
+    loadShift();
+}
+
+async function closeShift() {
+    // Queued orders belong to this shift only if they reach the server first
+    await syncOrders();
+    if (loadQueue().length > 0) {
+        showToast('Sync pending orders before closing the shift', 'error');
+        return;
+    }
+    const counted = prompt('Counted cash in drawer (Rp), blank to skip:', '');
+    if (counted === null) return;
+    const res = await fetch('/api/shift/close', {
+        method: 'POST',
+        headers: {'Content-Type': 'application/json'},
+        body: JSON.stringify({ counted_cash: counted.trim() === '' ? null : parseInt(counted, 10) })
+    });
+    const data = await res.json();
+    if (!res.ok) {
+        showToast(data.error, 'error');
+        return loadShift();
     }
+    window.location.href = `/pos/shifts/${data.data.shift_id}/report`;
 }
 
 // Helpers
@@ -1,6 +1,34 @@
+import datetime
+import io
+import time
 import unittest
+from contextlib import contextmanager
+from decimal import Decimal
 from unittest.mock import MagicMock, patch
+import os
+import shutil
+import tempfile
+import flask
+import psycopg2.errors
+import psycopg2.extensions
+from werkzeug.datastructures import FileStorage
+import analytics
+import archive_orders
+import audit
+import auth
+import db
+import events
+import images
+import metrics
+import pricing
 import services
+import shifts
+
+def setUpModule():
+    # Audit records queue in memory; no writer thread talking to a real database
+    patcher = patch('audit.ensure_writer')
+    patcher.start()
+    unittest.addModuleCleanup(patcher.stop)
 
 class TestServices(unittest.TestCase):
 
@@ -11,27 +39,1281 @@ class TestServices(unittest.TestCase):
         self.assertEqual(services.calculate_tax(15500), 1550)
 
     @patch('services.get_db_cursor')
-    @patch('services.datetime')
-    def test_generate_transaction_code(self, mock_datetime, mock_get_db_cursor):
-        # Mock Date
-        mock_date = MagicMock()
-        mock_date.strftime.return_value = "20231027"
-        mock_datetime.datetime.now.return_value = mock_date
-
-        # Mock DB Cursor Context
-        mock_conn = MagicMock()
+    def test_generate_transaction_code(self, mock_get_db_cursor):
         mock_cursor = MagicMock()
-        mock_get_db_cursor.return_value.__enter__.return_value = mock_cursor
 
-        # Case 1: No previous transaction
-        mock_cursor.fetchone.return_value = None
-        code = services.generate_transaction_code()
+        # First order of the day
+        mock_cursor.fetchone.return_value = {'day': datetime.date(2023, 10, 27), 'last_seq': 1}
+        code = services.generate_transaction_code(mock_cursor)
         self.assertEqual(code, "TRX-20231027-0001")
+        self.assertIn("ON CONFLICT (day)", mock_cursor.execute.call_args[0][0])
 
-        # Case 2: Previous transaction exists
-        mock_cursor.fetchone.return_value = {'transaction_code': 'TRX-20231027-0042'}
-        code = services.generate_transaction_code()
+        # Counter already advanced
+        mock_cursor.fetchone.return_value = {'day': datetime.date(2023, 10, 27), 'last_seq': 43}
+        code = services.generate_transaction_code(mock_cursor)
         self.assertEqual(code, "TRX-20231027-0043")
 
+        # Allocation shares the order transaction when given a cursor
+        mock_get_db_cursor.assert_not_called()
+
+class TestCreateOrder(unittest.TestCase):
+
+    def setUp(self):
+        patcher = patch('services.get_db_cursor')
+        self.mock_get_db_cursor = patcher.start()
+        self.addCleanup(patcher.stop)
+        self.cursor = MagicMock()
+        self.mock_get_db_cursor.return_value.__enter__.return_value = self.cursor
+
+        patcher = patch('services.execute_values')
+        self.mock_execute_values = patcher.start()
+        self.addCleanup(patcher.stop)
+
+        patcher = patch('analytics.execute_values')
+        self.mock_analytics_values = patcher.start()
+        self.addCleanup(patcher.stop)
+
+        patcher = patch('shifts.execute_values')
+        self.mock_shift_values = patcher.start()
+        self.addCleanup(patcher.stop)
+
+        patcher = patch('services.ensure_order_partitions')
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+        patcher = patch('services.generate_transaction_code', return_value='TRX-20231027-0001')
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def products(self, count, stock=100):
+        return [
+            {'id': i, 'name': f'Product {i}', 'price': Decimal(1000), 'category': 'Coffee',
+             'is_inventory_managed': True, 'stock': stock, 'tax_rate': None, 'tax_inclusive': None}
+            for i in range(1, count + 1)
+        ]
+
+    def test_statement_count_is_independent_of_cart_size(self):
+        for size in (1, 15):
+            self.cursor.reset_mock()
+            self.mock_execute_values.reset_mock()
+            self.mock_analytics_values.reset_mock()
+            self.mock_shift_values.reset_mock()
+            self.cursor.fetchall.return_value = self.products(size)
+            self.cursor.fetchone.return_value = {'id': 7, 'created_at': datetime.datetime(2024, 1, 1, 9),
+                                                 'shift_id': 3, 'version': 5}
+            self.cursor.rowcount = size
+
+            result = services.create_order([{'id': i, 'quantity': 2} for i in range(1, size + 1)], 'cash',
+                                           cashier_id=2)
+
+            # lock/load products, insert order, bump catalog version, deduct stock, notify
+            self.assertEqual(self.cursor.execute.call_count, 5)
+            self.assertEqual(self.mock_execute_values.call_count, 2)
+            items_call, summary_call = self.mock_execute_values.call_args_list
+            self.assertEqual(len(items_call[0][2]), size)
+            self.assertEqual(items_call[0][2][0][:3], (7, datetime.datetime(2024, 1, 1, 9), 1))
+            self.assertEqual(summary_call[0][2], [
+                (datetime.date(2024, 1, 1), 'cash', 1, size * 2000 + services.calculate_tax(size * 2000),
+                 services.calculate_tax(size * 2000), 0, 0, 0)
+            ])
+            self.assertEqual(result['total'], size * 2000 + services.calculate_tax(size * 2000))
+
+            # hourly and per-product analytics aggregates
+            hours_call, products_call = self.mock_analytics_values.call_args_list
+            self.assertEqual(hours_call[0][2], [(datetime.date(2024, 1, 1), 9, 1, result['total'])])
+            self.assertEqual(len(products_call[0][2]), size)
+            self.assertEqual(products_call[0][2][0], (datetime.date(2024, 1, 1), 1, 'Product 1', 2, 2000))
+
+            # the cashier's open shift, and its running totals
+            insert_sql, insert_params = self.cursor.execute.call_args_list[1][0]
+            self.assertIn("FOR SHARE", insert_sql)
+            self.assertEqual(insert_params[-2:], (2, 2))
+            self.assertEqual(self.mock_shift_values.call_args[0][2], [
+                (3, 'cash', 1, result['total'], services.calculate_tax(size * 2000), 0, 0, 0)
+            ])
+
+    def test_duplicate_lines_are_merged(self):
+        self.cursor.fetchall.return_value = self.products(1, stock=3)
+        with self.assertRaises(ValueError):
+            services.create_order([{'id': 1, 'quantity': 2}, {'id': 1, 'quantity': 2}], 'cash')
+
+    def test_missing_product(self):
+        self.cursor.fetchall.return_value = []
+        with self.assertRaisesRegex(ValueError, 'not found'):
+            services.create_order([{'id': 99, 'quantity': 1}], 'cash')
+
+    def test_rejects_what_the_columns_cannot_hold_before_any_sql(self):
+        cases = [
+            ([], 'cash', 'empty'),
+            ([{'id': 1, 'quantity': 1}], 'x' * 30, 'payment method'),
+            ([{'id': 1, 'quantity': services.MAX_QUANTITY}, {'id': 1, 'quantity': 1}], 'cash', 'At most'),
+        ]
+        for items, payment_method, message in cases:
+            with self.assertRaisesRegex(ValueError, message):
+                services._create_order(self.cursor, items, payment_method)
+        self.cursor.execute.assert_not_called()
+
+    def test_prices_with_category_rule_and_discount(self):
+        products = self.products(2)
+        products[1].update(category='Pastry', tax_rate=Decimal('0.11'), tax_inclusive=True)
+        self.cursor.fetchall.return_value = products
+        self.cursor.fetchone.return_value = {'id': 7, 'created_at': datetime.datetime(2024, 1, 1, 9),
+                                             'shift_id': None, 'version': 5}
+        self.cursor.rowcount = 2
+
+        result = services.create_order(
+            [{'id': 1, 'quantity': 2}, {'id': 2, 'quantity': 1}], 'cash',
+            discount={'type': 'amount', 'value': 300}
+        )
+
+        # 3000 - 300 discount split 200/100; 10% on 1800 added, 11% inside 900 not
+        self.assertEqual(result['total'], 2700 + 180)
+        insert_params = self.cursor.execute.call_args_list[1][0][1]
+        self.assertEqual(insert_params[1:4], (Decimal(2880), Decimal(180 + 89), Decimal(300)))
+
+class TestPricing(unittest.TestCase):
+
+    def book(self):
+        return pricing.build_price_book(
+            [{'id': 1, 'price': 10000, 'category': 'Coffee'}, {'id': 2, 'price': 3333, 'category': 'Pastry'}],
+            {'Pastry': (Decimal('0.11'), True)}
+        )
+
+    def test_default_matches_calculate_tax(self):
+        priced = pricing.price_cart(self.book(), {1: 3})
+        self.assertEqual(priced['tax'], services.calculate_tax(30000))
+        self.assertEqual(priced['total'], 33000)
+
+    def test_inclusive_tax_is_not_added(self):
+        priced = pricing.price_cart(self.book(), {2: 3})
+        self.assertEqual(priced['total'], 9999)
+        self.assertEqual(priced['tax'], 990)  # 9999 * 0.11 / 1.11, truncated
+
+    def test_order_discount_is_allocated_exactly(self):
+        priced = pricing.price_cart(self.book(), {1: 1, 2: 1}, discount=pricing.parse_discount(
+            {'type': 'percent', 'value': 12.5}
+        ))
+        self.assertEqual(priced['discount'], sum(line['discount'] for line in priced['lines']))
+        self.assertEqual(priced['discount'], 1666)
+
+    def test_rounding_modes(self):
+        self.assertEqual(pricing.tax_for(15, rounding=pricing.ROUNDING_MODES['down']), 1)
+        self.assertEqual(pricing.tax_for(15, rounding=pricing.ROUNDING_MODES['half_up']), 2)
+        self.assertEqual(pricing.tax_for(25, rounding=pricing.ROUNDING_MODES['half_even']), 2)
+
+    def test_invalid_discount(self):
+        for spec in ({'type': 'percent', 'value': 120}, {'type': 'amount', 'value': -1}, {'type': 'free'},
+                     {'type': 'amount', 'value': '1e999999'}, {'type': 'amount', 'value': float('inf')}):
+            with self.assertRaises(ValueError):
+                pricing.parse_discount(spec)
+        with self.assertRaises(ValueError):
+            pricing.price_cart(self.book(), {1: 10 ** 30})
+
+    def test_cashier_discount_limit(self):
+        discount = pricing.parse_discount({'type': 'percent', 'value': 50})
+        with self.assertRaisesRegex(ValueError, 'exceeds'):
+            pricing.price_cart(self.book(), {1: 1}, discount=discount,
+                               max_discount_percent=pricing.discount_limit('cashier'))
+        priced = pricing.price_cart(self.book(), {1: 1}, discount=discount,
+                                    max_discount_percent=pricing.discount_limit('admin'))
+        self.assertEqual(priced['discount'], 5000)
+
+    @patch('services.get_price_book')
+    @patch('auth.get_db_cursor')
+    def test_price_endpoint(self, mock_auth_cursor, mock_book):
+        import app as app_module
+        mock_auth_cursor.return_value.__enter__.return_value.fetchone.return_value = {
+            'id': 2, 'username': 'cashier', 'role': 'cashier'
+        }
+        mock_book.return_value = self.book()
+
+        client = app_module.app.test_client()
+        with client.session_transaction() as sess:
+            sess['user_id'] = 2
+        res = client.post('/api/price', json={'items': [{'id': 1, 'quantity': 2}]})
+        self.assertEqual(res.get_json()['total'], 22000)
+
+        res = client.post('/api/price', json={'items': [{'id': 9, 'quantity': 1}]})
+        self.assertEqual(res.status_code, 400)
+
+        for discount in ({'type': 'amount', 'value': '1e999999'}, {'type': 'percent', 'value': 100}):
+            res = client.post('/api/price', json={'items': [{'id': 1, 'quantity': 2}], 'discount': discount})
+            self.assertEqual(res.status_code, 400)
+
+class TestOrderPartitions(unittest.TestCase):
+
+    @patch('services._partitions_checked_on', None)
+    @patch('services.get_db_cursor')
+    def test_checked_once_a_day(self, mock_get_db_cursor):
+        cursor = mock_get_db_cursor.return_value.__enter__.return_value
+
+        # Another process holds the creation lock: not done, check again next time
+        cursor.fetchone.return_value = {'created': None}
+        self.assertIsNone(services.ensure_order_partitions())
+        cursor.fetchone.return_value = {'created': 1}
+        self.assertEqual(services.ensure_order_partitions(), 1)
+        self.assertEqual(services.ensure_order_partitions(), 0)
+        self.assertEqual(cursor.execute.call_count, 4)
+        self.assertIn("lock_timeout", cursor.execute.call_args_list[0][0][0])
+        self.assertIn("ensure_order_partitions", cursor.execute.call_args[0][0])
+
+    @patch('services.ensure_order_partitions', side_effect=psycopg2.errors.LockNotAvailable())
+    def test_checkout_survives_a_failed_check(self, mock_ensure):
+        with self.assertLogs('pos.services', 'WARNING'):
+            services._check_order_partitions()
+
+class TestArchiveOrders(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        self.conn = MagicMock()
+        self.cursor = self.conn.cursor.return_value.__enter__.return_value
+
+    def statements(self):
+        return [c[0][0] for c in self.cursor.execute.call_args_list]
+
+    def test_exports_before_detaching_concurrently(self):
+        # Both attached; one more void lands between the export and the detach
+        self.cursor.fetchone.side_effect = [
+            {'inhdetachpending': False}, {'inhdetachpending': False}, {'n': 3}, {'n': 4},
+        ]
+        archive_orders.archive_month(self.conn, '202401', self.directory)
+
+        sql = self.statements()
+        self.assertFalse(any('LOCK TABLE' in s for s in sql))
+        self.assertLess(sql.index("COMMIT"), sql.index(
+            "ALTER TABLE order_items DETACH PARTITION order_items_p202401 CONCURRENTLY"))
+        self.assertLess(sql.index("DROP TABLE IF EXISTS order_items_p202401"), sql.index(
+            "ALTER TABLE orders DETACH PARTITION orders_p202401 CONCURRENTLY"))
+        self.assertIn("DROP TABLE orders_p202401", sql)
+        # Lines and orders, then the orders again with the late void
+        self.assertEqual(self.cursor.copy_expert.call_count, 3)
+
+    def test_resumes_an_interrupted_detach(self):
+        # Lines already gone, orders left pending by a cancelled DETACH ... CONCURRENTLY
+        self.cursor.fetchone.side_effect = [None, {'inhdetachpending': True}, {'n': 0}, {'n': 0}]
+        archive_orders.archive_month(self.conn, '202401', self.directory)
+
+        sql = self.statements()
+        self.assertIn("ALTER TABLE orders DETACH PARTITION orders_p202401 FINALIZE", sql)
+        self.assertFalse(any('order_items DETACH' in s for s in sql))
+        self.assertEqual(self.cursor.copy_expert.call_count, 1)
+
+class TestVoidOrder(unittest.TestCase):
+
+    @patch('analytics.execute_values')
+    @patch('services.execute_values')
+    @patch('services.get_db_cursor')
+    def test_void_restores_stock_in_one_statement(self, mock_get_db_cursor, mock_execute_values, mock_analytics_values):
+        cursor = mock_get_db_cursor.return_value.__enter__.return_value
+        cursor.fetchone.side_effect = [
+            {'id': 10, 'status': 'paid', 'total_amount': Decimal(11000), 'tax_amount': Decimal(1000),
+             'payment_method': 'cash', 'created_at': datetime.datetime(2024, 1, 1, 9)},
+            {'version': 12},
+        ]
+        cursor.fetchall.side_effect = [
+            [{'id': 3}, {'id': 5}],
+            [{'order_id': 10, 'product_id': 3, 'product_name': 'Latte', 'quantity': 2, 'revenue': Decimal(10000)}],
+        ]
+
+        services.void_order(10)
+
+        statements = [c[0][0] for c in cursor.execute.call_args_list]
+        restore_sql, restore_params = cursor.execute.call_args_list[1][0]
+        self.assertIn("FOR UPDATE OF p", restore_sql)
+        self.assertIn("product_id", restore_sql)
+        self.assertEqual(restore_params, ([10],))
+        self.assertFalse(any("WHERE name" in sql for sql in statements))
+        self.assertEqual(cursor.execute.call_args_list[-2][0][1], (12, [3, 5]))
+        self.assertIn("pg_notify", statements[-1])
+
+        hours_call, products_call = mock_analytics_values.call_args_list
+        self.assertEqual(hours_call[0][2], [(datetime.date(2024, 1, 1), 9, -1, -11000)])
+        self.assertEqual(products_call[0][2], [(datetime.date(2024, 1, 1), 3, 'Latte', -2, -10000)])
+
+    @patch('services.get_db_cursor')
+    def test_void_twice(self, mock_get_db_cursor):
+        cursor = mock_get_db_cursor.return_value.__enter__.return_value
+        cursor.fetchone.return_value = {'status': 'void'}
+        with self.assertRaisesRegex(ValueError, 'already voided'):
+            services.void_order(10)
+
+class TestBulkOperations(unittest.TestCase):
+
+    @patch('audit.record')
+    @patch('services._void_locked_orders')
+    @patch('services.get_db_cursor')
+    def test_void_orders_by_ids(self, mock_get_db_cursor, mock_void_locked, mock_audit):
+        cursor = mock_get_db_cursor.return_value.__enter__.return_value
+        orders = [
+            {'id': i, 'status': 'paid', 'total_amount': Decimal(11000), 'tax_amount': Decimal(1000),
+             'payment_method': 'cash', 'created_at': datetime.datetime(2024, 1, 1, 9)}
+            for i in (1, 3)
+        ]
+        cursor.fetchall.return_value = orders
+
+        result = services.void_orders(order_ids=['3', 1, 2])
+
+        self.assertEqual(result, {'voided': 2, 'order_ids': [1, 3]})
+        sql, params = cursor.execute.call_args[0]
+        self.assertIn("o.status = 'paid'", sql)
+        self.assertIn("ORDER BY o.id", sql)
+        self.assertEqual(params, ([3, 1, 2],))
+        mock_void_locked.assert_called_once_with(cursor, orders)
+        self.assertEqual([c[0][:2] for c in mock_audit.call_args_list], [('order.voided', 1), ('order.voided', 3)])
+
+    def test_void_orders_requires_a_filter(self):
+        with self.assertRaises(ValueError):
+            services.void_orders(filters={'status': 'paid'})
+
+    def test_parse_csv(self):
+        data = io.BytesIO(
+            b"name,price,category,is_inventory_managed,stock\n"
+            b"Latte,32000,Coffee,yes,40\n"
+            b",1,,,\n"
+            b"Ice Tea,10000,Beverage,,5\n"
+        )
+        rows = services.parse_product_rows('catalog.csv', data)
+        self.assertEqual([r['name'] for r in rows], ['Latte', 'Ice Tea'])
+        self.assertEqual(rows[0]['stock'], 40)
+        self.assertEqual(rows[1]['stock'], 0)
+        self.assertIsNone(rows[1]['image_url'])
+
+    @patch('services.get_db_cursor')
+    def test_price_list_import_keeps_other_columns(self, mock_get_db_cursor):
+        rows = services.parse_product_rows('catalog.csv', io.BytesIO(b"name,price\nLatte,35000\n"))
+        self.assertEqual(
+            {k: rows[0][k] for k in ('category', 'is_inventory_managed', 'stock')},
+            {'category': None, 'is_inventory_managed': None, 'stock': None}
+        )
+
+        cursor = mock_get_db_cursor.return_value.__enter__.return_value
+        cursor.fetchall.side_effect = [[{'id': 1}], []]
+        cursor.fetchone.return_value = {'version': 2}
+        services.import_products(rows)
+
+        # NULLs in the file leave the matched product's values in place
+        self.assertEqual(cursor.copy_expert.call_args[0][1].getvalue(), '0,Latte,35000,,,,,\r\n')
+        update_sql = cursor.execute.call_args_list[2][0][0]
+        for column in ('category', 'is_inventory_managed', 'stock'):
+            self.assertIn(f"COALESCE(src.{column}, p.{column})", update_sql)
+        insert_sql = cursor.execute.call_args_list[3][0][0]
+        self.assertIn("COALESCE(is_inventory_managed, FALSE), COALESCE(stock, 0)", insert_sql)
+
+    def test_parse_xlsx(self):
+        import openpyxl
+        wb = openpyxl.Workbook()
+        wb.active.append(['Name', 'Price', 'Stock', 'Is_Inventory_Managed'])
+        wb.active.append(['Croissant', 15000, 20, True])
+        out = io.BytesIO()
+        wb.save(out)
+        out.seek(0)
+        rows = services.parse_product_rows('catalog.xlsx', out)
+        self.assertEqual(rows[0]['price'], Decimal(15000))
+        self.assertEqual(rows[0]['stock'], 20)
+
+    def test_parse_rejects_bad_rows(self):
+        with self.assertRaisesRegex(ValueError, 'Row 2'):
+            services.parse_product_rows('catalog.csv', io.BytesIO(b"name,price\nLatte,abc\n"))
+        with self.assertRaisesRegex(ValueError, 'price'):
+            services.parse_product_rows('catalog.csv', io.BytesIO(b"name\nLatte\n"))
+        for cells in (b"NaN,", b"1e20,", b"1000,https://example.com/" + b"x" * 250):
+            with self.assertRaisesRegex(ValueError, 'Row 2'):
+                services.parse_product_rows('catalog.csv', io.BytesIO(b"name,price,image_url\nLatte," + cells + b"\n"))
+        with self.assertRaisesRegex(ValueError, 'Row 2'):
+            services.parse_product_rows(
+                'catalog.csv', io.BytesIO(b"name,price,is_inventory_managed,stock\nLatte,1000,yes,3000000000\n"))
+
+    def test_parse_truncates_long_categories(self):
+        rows = services.parse_product_rows('catalog.csv', io.BytesIO(b"name,price,category\nLatte,1000," + b"c" * 80 + b"\n"))
+        self.assertEqual(rows[0]['category'], 'c' * 50)
+
+    @patch('services.get_db_cursor')
+    def test_import_uses_copy_and_set_based_upsert(self, mock_get_db_cursor):
+        cursor = mock_get_db_cursor.return_value.__enter__.return_value
+        cursor.fetchall.side_effect = [[{'id': 1}], [{'id': 2}, {'id': 3}]]
+        cursor.fetchone.return_value = {'version': 4}
+        rows = [
+            {'name': f'P{i}', 'price': Decimal(1000), 'category': None, 'image_url': None,
+             'is_inventory_managed': False, 'stock': 0, 'barcode': None}
+            for i in range(3)
+        ]
+        rows[1]['barcode'] = '8991234567890'
+
+        result = services.import_products(rows)
+
+        self.assertEqual(result, {'created': 2, 'updated': 1})
+        self.assertEqual(cursor.copy_expert.call_count, 1)
+        copied = cursor.copy_expert.call_args[0][1].getvalue().splitlines()
+        self.assertEqual(copied[0], '0,P0,1000,,,False,0,')
+        self.assertEqual(copied[1], '1,P1,1000,,,False,0,8991234567890')
+        # temp table, lock, update, insert, catalog version bump, notify
+        self.assertEqual(cursor.execute.call_count, 7)
+
+class TestDailySalesSummary(unittest.TestCase):
+
+    def test_void_moves_totals_from_paid_to_void(self):
+        order = {'created_at': datetime.datetime(2024, 1, 1, 9), 'payment_method': 'qris',
+                 'total_amount': Decimal(11000), 'tax_amount': Decimal(1000)}
+        other = dict(order, total_amount=Decimal(5500), tax_amount=Decimal(500))
+        deltas = {}
+        services._add_sales_delta(deltas, order, voided=True)
+        services._add_sales_delta(deltas, other, voided=True)
+        self.assertEqual(deltas, {
+            (datetime.date(2024, 1, 1), 'qris'): [-2, -16500, -1500, 2, 16500, 1500]
+        })
+
+    @patch('services.get_db_cursor')
+    def test_dashboard_reads_rollup(self, mock_get_db_cursor):
+        cursor = mock_get_db_cursor.return_value.__enter__.return_value
+        cursor.fetchone.return_value = {'daily': Decimal(100), 'monthly': Decimal(500)}
+
+        stats = services.get_dashboard_stats()
+
+        self.assertEqual(stats, {'daily_sales': Decimal(100), 'monthly_sales': Decimal(500)})
+        self.assertEqual(cursor.execute.call_count, 1)
+        sql = cursor.execute.call_args[0][0]
+        self.assertIn("FROM daily_sales_summary", sql)
+        self.assertNotIn("orders", sql)
+
+class TestShifts(unittest.TestCase):
+
+    def setUp(self):
+        auth.invalidate_user()
+
+    def shift(self, **kwargs):
+        return dict({'id': 4, 'cashier_id': 2, 'cashier': 'kasir', 'opened_at': datetime.datetime(2024, 1, 1, 8),
+                     'closed_at': datetime.datetime(2024, 1, 1, 17), 'opening_float': Decimal(200000),
+                     'counted_cash': Decimal(305000)}, **kwargs)
+
+    def test_void_moves_shift_totals_and_skips_orders_without_shift(self):
+        order = {'shift_id': 4, 'payment_method': 'cash', 'total_amount': Decimal(11000), 'tax_amount': Decimal(1000)}
+        deltas = {}
+        shifts.add_order_delta(deltas, order)
+        shifts.add_order_delta(deltas, order, voided=True)
+        shifts.add_order_delta(deltas, dict(order, shift_id=None))
+        self.assertEqual(deltas, {(4, 'cash'): [0, 0, 0, 1, 11000, 1000]})
+
+    @patch('shifts.get_db_cursor')
+    def test_close_reads_totals_and_stores_report(self, mock_get_db_cursor):
+        cursor = mock_get_db_cursor.return_value.__enter__.return_value
+        cursor.fetchone.return_value = self.shift()
+        cursor.fetchall.return_value = [
+            {'payment_method': 'cash', 'paid_count': 9, 'paid_total': Decimal(110000), 'paid_tax': Decimal(10000),
+             'void_count': 1, 'void_total': Decimal(11000), 'void_tax': Decimal(1000)},
+            {'payment_method': 'qris', 'paid_count': 3, 'paid_total': Decimal(55000), 'paid_tax': Decimal(5000),
+             'void_count': 0, 'void_total': Decimal(0), 'void_tax': Decimal(0)},
+        ]
+
+        report = shifts.close_shift(2, counted_cash=305000)
+
+        self.assertEqual(
+            {k: report[k] for k in ('order_count', 'gross', 'net', 'tax', 'void_count', 'void_total')},
+            {'order_count': 13, 'gross': 176000, 'net': 165000, 'tax': 15000, 'void_count': 1, 'void_total': 11000}
+        )
+        self.assertEqual((report['expected_cash'], report['cash_variance']), (310000, -5000))
+        close_sql, close_params = cursor.execute.call_args_list[0][0]
+        self.assertIn("closed_at IS NULL", close_sql)
+        self.assertEqual(close_params, (305000, 2))
+        # O(1) in the shift's orders: close, totals by payment method, store
+        self.assertEqual(cursor.execute.call_count, 3)
+        self.assertIn("z_report", cursor.execute.call_args[0][0])
+
+        cursor.fetchone.return_value = None
+        with self.assertRaisesRegex(ValueError, 'No open shift'):
+            shifts.close_shift(2)
+
+    @patch('shifts.get_db_cursor')
+    def test_one_open_shift_per_cashier(self, mock_get_db_cursor):
+        cursor = mock_get_db_cursor.return_value.__enter__.return_value
+        cursor.execute.side_effect = psycopg2.errors.UniqueViolation()
+        with self.assertRaisesRegex(ValueError, 'already open'):
+            shifts.open_shift(2, 100000)
+        for bad in (-1, 10 ** 15, float('inf'), 1.5, '100', True):
+            with self.assertRaises(ValueError):
+                shifts.open_shift(2, bad)
+            with self.assertRaises(ValueError):
+                shifts.close_shift(2, counted_cash=bad)
+
+    @patch('auth.get_db_cursor')
+    @patch('shifts.get_report')
+    def test_cashiers_see_only_their_own_reports(self, mock_get_report, mock_auth_cursor):
+        import app as app_module
+        mock_auth_cursor.return_value.__enter__.return_value.fetchone.return_value = {
+            'id': 2, 'username': 'kasir', 'role': 'cashier'
+        }
+        mock_get_report.return_value = shifts.build_report(self.shift(), [])
+
+        client = app_module.app.test_client()
+        with client.session_transaction() as sess:
+            sess['user_id'] = 2
+        res = client.get('/pos/shifts/4/report')
+        self.assertEqual(res.status_code, 200)
+        self.assertIn(b'Z-REPORT', res.data)
+        self.assertEqual(client.get('/pos/shifts/4/report?format=json').get_json()['expected_cash'], 200000)
+
+        mock_get_report.return_value = shifts.build_report(self.shift(cashier_id=3), [])
+        self.assertEqual(client.get('/pos/shifts/4/report').status_code, 404)
+
+class TestAnalytics(unittest.TestCase):
+
+    def setUp(self):
+        analytics.clear_cache()
+        auth.invalidate_user()
+
+    @patch('analytics.get_db_cursor')
+    def test_results_are_cached_per_range(self, mock_get_db_cursor):
+        cursor = mock_get_db_cursor.return_value.__enter__.return_value
+        cursor.fetchall.return_value = [
+            {'product_id': 3, 'name': 'Latte', 'quantity': 5, 'revenue': Decimal(160000)}
+        ]
+        day = datetime.date(2024, 1, 31)
+
+        rows = analytics.top_products(datetime.date(2024, 1, 1), day)
+        self.assertEqual(rows, [{'product_id': 3, 'name': 'Latte', 'quantity': 5, 'revenue': 160000}])
+        self.assertIn("FROM daily_product_sales", cursor.execute.call_args[0][0])
+
+        analytics.top_products(datetime.date(2024, 1, 1), day)
+        self.assertEqual(cursor.execute.call_count, 1)
+
+        analytics.top_products(datetime.date(2024, 1, 2), day)
+        self.assertEqual(cursor.execute.call_count, 2)
+
+    @patch('auth.get_db_cursor')
+    @patch('analytics.hourly_heatmap')
+    def test_endpoint(self, mock_heatmap, mock_auth_cursor):
+        import app as app_module
+        mock_auth_cursor.return_value.__enter__.return_value.fetchone.return_value = {
+            'id': 1, 'username': 'admin', 'role': 'admin'
+        }
+        mock_heatmap.return_value = [{'weekday': 1, 'hour': 9, 'orders': 4, 'total': 44000}]
+
+        client = app_module.app.test_client()
+        with client.session_transaction() as sess:
+            sess['user_id'] = 1
+        res = client.get('/admin/analytics/hourly?date_from=2024-01-01&date_to=2024-01-07')
+        self.assertEqual(res.get_json()['rows'][0]['orders'], 4)
+        mock_heatmap.assert_called_once_with(datetime.date(2024, 1, 1), datetime.date(2024, 1, 7))
+
+        self.assertEqual(client.get('/admin/analytics/nope').status_code, 404)
+        self.assertEqual(client.get('/admin/analytics/top-products?by=price').status_code, 400)
+        self.assertEqual(client.get('/admin/analytics/payments?date_from=2024-02-01&date_to=2024-01-01').status_code, 400)
+
+class TestCatalogCache(unittest.TestCase):
+
+    def setUp(self):
+        services._catalog_cache = {'version': None, 'products': None}
+
+    @patch('services.get_db_cursor')
+    def test_reloads_only_when_version_moves(self, mock_get_db_cursor):
+        cursor = mock_get_db_cursor.return_value.__enter__.return_value
+        cursor.fetchone.return_value = {'version': 3}
+        cursor.fetchall.return_value = [
+            {'id': 1, 'name': 'Latte', 'price': Decimal(32000), 'image_url': '/static/uploads/latte.jpg'}
+        ]
+
+        version, products = services.get_catalog(3)
+        self.assertEqual((version, products[0]['price']), (3, 32000))
+        self.assertEqual(mock_get_db_cursor.call_count, 1)
+
+        services.get_catalog(3)
+        self.assertEqual(mock_get_db_cursor.call_count, 1)
+
+        cursor.fetchone.return_value = {'version': 4}
+        self.assertEqual(services.get_catalog(4)[0], 4)
+        self.assertEqual(mock_get_db_cursor.call_count, 2)
+
+    @patch('auth.get_db_cursor')
+    @patch('services.get_catalog_version', return_value=9)
+    @patch('services.get_catalog')
+    def test_api_products_etag(self, mock_get_catalog, mock_version, mock_auth_cursor):
+        import app as app_module
+        mock_auth_cursor.return_value.__enter__.return_value.fetchone.return_value = {
+            'id': 2, 'username': 'cashier', 'role': 'cashier'
+        }
+        mock_get_catalog.return_value = (9, [{'id': 1, 'name': 'Latte', 'price': 32000}])
+
+        client = app_module.app.test_client()
+        with client.session_transaction() as sess:
+            sess['user_id'] = 2
+
+        res = client.get('/api/products')
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(res.headers['ETag'], '"catalog-9"')
+        self.assertEqual(res.get_json()[0]['name'], 'Latte')
+
+        res = client.get('/api/products', headers={'If-None-Match': '"catalog-9"'})
+        self.assertEqual(res.status_code, 304)
+        self.assertEqual(mock_get_catalog.call_count, 1)
+
+@unittest.skipIf(images.Image is None, "Pillow not installed")
+class TestImages(unittest.TestCase):
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.root)
+
+    def upload(self, color='red', filename='photo.png'):
+        from PIL import Image
+        data = io.BytesIO()
+        Image.new('RGBA', (800, 600), color).save(data, 'PNG')
+        data.seek(0)
+        return FileStorage(stream=data, filename=filename)
+
+    @patch('images.schedule_thumbnails')
+    def test_stores_by_content_hash_without_overwriting(self, mock_schedule):
+        first = images.store_upload(self.upload(filename='a.png'), self.root)
+        again = images.store_upload(self.upload(filename='b.png'), self.root)
+        other = images.store_upload(self.upload('blue'), self.root)
+
+        self.assertEqual(first, again)
+        self.assertNotEqual(first, other)
+        self.assertRegex(first, r'^/media/[0-9a-f]{64}\.png$')
+        stored = [f for _, _, files in os.walk(self.root) for f in files]
+        self.assertEqual(len(stored), 2)
+
+        with self.assertRaises(ValueError):
+            images.store_upload(FileStorage(stream=io.BytesIO(b'not an image'), filename='evil.png'), self.root)
+
+    @patch('images.schedule_thumbnails')
+    def test_thumbnails_and_cache_headers(self, mock_schedule):
+        import app as app_module
+        url = images.store_upload(self.upload(), self.root)
+        digest = url[len('/media/'):].split('.')[0]
+        urls = images.thumbnail_urls(url)
+        self.assertEqual(urls['thumbnail_url'], f"/media/thumbs/{digest}-400.webp")
+        self.assertEqual(images.thumbnail_urls('https://placehold.co/x.png')['thumbnail_url'], 'https://placehold.co/x.png')
+
+        images.make_thumbnails(self.root, digest, 'png')
+        from PIL import Image
+        with Image.open(images.thumbnail_path(self.root, digest, 400, 'jpg')) as im:
+            self.assertEqual((im.format, im.size), ('JPEG', (400, 300)))
+
+        client = app_module.app.test_client()
+        with patch.dict(app_module.app.config, {'MEDIA_FOLDER': self.root}):
+            res = client.get(urls['thumbnail_url'])
+            self.assertEqual(res.status_code, 200)
+            self.assertIn('immutable', res.headers['Cache-Control'])
+            res.close()
+            self.assertEqual(client.get(f"/media/thumbs/{digest}-123.webp").status_code, 404)
+
+    def test_original_urls_are_validated(self):
+        import app as app_module
+        digest = 'ab' * 32
+        os.makedirs(os.path.join(self.root, 'ab'))
+        for name in (f"{digest}.png", f"{digest}.exe", 'ab.png'):
+            with open(os.path.join(self.root, 'ab', name), 'wb') as f:
+                f.write(b'x')
+
+        client = app_module.app.test_client()
+        with patch.dict(app_module.app.config, {'MEDIA_FOLDER': self.root}):
+            res = client.get(f"/media/{digest}.png")
+            self.assertEqual(res.status_code, 200)
+            res.close()
+            for url in (f"/media/{digest}.exe", "/media/ab.png", f"/media/{digest.upper()}.png"):
+                self.assertEqual(client.get(url).status_code, 404)
+
+class TestCatalogEvents(unittest.TestCase):
+
+    @patch('services.execute_values')
+    def test_bump_notifies_with_changed_products(self, mock_execute_values):
+        cursor = MagicMock()
+        cursor.fetchone.return_value = {'version': 8}
+        services.bump_catalog_version(cursor, [4], stock_only=True)
+        sql, params = cursor.execute.call_args_list[-1][0]
+        self.assertIn("pg_notify", sql)
+        self.assertEqual(params['version'], 8)
+        self.assertEqual(params['channel'], services.CATALOG_CHANNEL)
+
+        # Other edits (e.g. an import changing categories) only announce the version
+        cursor.reset_mock()
+        services.bump_catalog_version(cursor, [4], deleted_ids=[2])
+        sql, params = cursor.execute.call_args_list[-1][0]
+        self.assertEqual(params, (services.CATALOG_CHANNEL, '{"version": 8}'))
+
+        cursor.reset_mock()
+        services.bump_catalog_version(cursor, [4], notify=False)
+        self.assertFalse(any("pg_notify" in c[0][0] for c in cursor.execute.call_args_list))
+
+    def test_slow_subscriber_is_told_to_resync(self):
+        broadcaster = events.Broadcaster(max_clients=1)
+        q = broadcaster.subscribe()
+        self.assertIsNone(broadcaster.subscribe())
+        for version in range(events.QUEUE_SIZE + 1):
+            broadcaster.publish(f'{{"version": {version}}}')
+        self.assertEqual(q.qsize(), 1)
+        self.assertEqual(q.get_nowait(), events.RESYNC)
+
+        broadcaster.unsubscribe(q)
+        self.assertEqual(len(broadcaster), 0)
+
+    @patch('auth.get_db_cursor')
+    @patch('events.ensure_listener')
+    def test_event_stream(self, mock_listener, mock_auth_cursor):
+        import app as app_module
+        mock_auth_cursor.return_value.__enter__.return_value.fetchone.return_value = {
+            'id': 2, 'username': 'cashier', 'role': 'cashier'
+        }
+        client = app_module.app.test_client()
+        with client.session_transaction() as sess:
+            sess['user_id'] = 2
+
+        res = client.get('/api/events', buffered=False)
+        self.assertEqual(res.mimetype, 'text/event-stream')
+        frames = iter(res.response)
+        self.assertTrue(next(frames).startswith(b'retry:'))
+        events.broadcaster.publish('{"version": 3}')
+        self.assertEqual(next(frames), b'data: {"version": 3}\n\n')
+        res.close()
+        self.assertEqual(len(events.broadcaster), 0)
+
+class TestProductSearch(unittest.TestCase):
+
+    @patch('services.get_db_cursor')
+    def test_short_queries_match_prefixes_and_barcodes_only(self, mock_get_db_cursor):
+        cursor = mock_get_db_cursor.return_value.__enter__.return_value
+        cursor.fetchall.return_value = []
+        services.search_products('La')
+        sql, params = cursor.execute.call_args[0]
+        self.assertIn("lower(p.name) LIKE %(prefix)s", sql)
+        self.assertNotIn("<%%", sql)
+        self.assertEqual((params['prefix'], params['raw']), ('la%', 'La'))
+
+    @patch('services.get_db_cursor')
+    def test_fuzzy_ranked_search_with_field_subset(self, mock_get_db_cursor):
+        cursor = mock_get_db_cursor.return_value.__enter__.return_value
+        cursor.fetchall.return_value = [
+            {'id': i, 'name': f'Latte {i}', 'price': Decimal(32000), 'image_url': '/static/uploads/latte.jpg'}
+            for i in range(3)
+        ]
+
+        result = services.search_products('  LATE 50%  ', fields=['id', 'name', 'price', 'thumbnail_url'], limit=2)
+
+        sql, params = cursor.execute.call_args[0]
+        self.assertIn("%(term)s <%% lower(p.name)", sql)
+        self.assertIn("word_similarity", sql)
+        self.assertTrue(sql.split('FROM')[0].strip().endswith("p.id, p.name, p.price, p.image_url"))
+        self.assertEqual((params['term'], params['contains'], params['limit']), ('late 50%', '%late 50\\%%', 3))
+        self.assertEqual(result['next_offset'], 2)
+        self.assertEqual(result['items'][0], {'id': 0, 'name': 'Latte 0', 'price': 32000,
+                                              'thumbnail_url': '/static/uploads/latte.jpg'})
+
+        with self.assertRaises(ValueError):
+            services.search_products('latte', fields=['password_hash'])
+
+class TestAudit(unittest.TestCase):
+
+    def setUp(self):
+        patcher = patch('audit._queue', audit.queue.Queue(3))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_record_captures_request_user(self):
+        app = flask.Flask(__name__)
+        with app.test_request_context(environ_base={'REMOTE_ADDR': '10.0.0.5'}):
+            flask.g.user = {'id': 2, 'username': 'cashier', 'role': 'cashier'}
+            audit.record('order.created', 41, {'total': Decimal(11000)})
+        occurred_at, event, entity_id, user_id, username, remote_addr, payload = audit._queue.get_nowait()
+        self.assertEqual((event, entity_id, user_id, username, remote_addr), ('order.created', 41, 2, 'cashier', '10.0.0.5'))
+        self.assertEqual(payload, '{"total": "11000"}')
+
+    @patch('audit.write_batch')
+    def test_full_queue_drops_and_reports_the_gap(self, mock_write_batch):
+        before = audit.stats()['dropped']
+        for i in range(5):
+            audit.record('user.login', i)
+        self.assertEqual(audit.stats()['dropped'] - before, 2)
+
+        with patch('audit.FLUSH_SECONDS', 0):
+            batch = audit._next_batch()
+        rows = audit._take_drop_marker() + batch
+        self.assertEqual(rows[0][1], 'audit.dropped')
+        self.assertEqual(rows[0][-1], '{"count": 2}')
+        self.assertEqual(audit._take_drop_marker(), [])
+
+    def test_payloads_jsonb_would_refuse_are_cleaned(self):
+        audit.record('user.login_failed', payload={'username': 'ad\x00min'})
+        audit.record('order.created', 1, {'discount': {'value': float('nan')}})
+        self.assertEqual(audit._queue.get_nowait()[-1], '{"username": "admin"}')
+        self.assertEqual(audit._queue.get_nowait()[-1], '{"unserializable": true}')
+
+    @patch('audit.write_batch')
+    def test_bad_records_are_isolated_not_retried(self, mock_write_batch):
+        rows = [(None, 'e', i, None, None, None, None) for i in range(5)]
+
+        def write(chunk):
+            if any(r[2] == 3 for r in chunk):
+                raise psycopg2.DataError('invalid input syntax for type json')
+
+        mock_write_batch.side_effect = write
+        before = audit.stats()
+        audit._write(rows)
+        after = audit.stats()
+        self.assertEqual(after['written'] - before['written'], 4)
+        self.assertEqual(after['rejected'] - before['rejected'], 1)
+
+    @patch('audit.get_db_cursor')
+    def test_batches_are_copied(self, mock_get_db_cursor):
+        cursor = mock_get_db_cursor.return_value.__enter__.return_value
+        audit.write_batch([(datetime.datetime(2024, 1, 1, 9), 'user.login', 2, 2, 'cashier', None, None)])
+        sql, buf = cursor.copy_expert.call_args[0]
+        self.assertTrue(sql.startswith("COPY audit_log (occurred_at, event"))
+        self.assertEqual(buf.getvalue(), '2024-01-01 09:00:00,user.login,2,2,cashier,,\r\n')
+
+    @patch('audit.get_db_cursor')
+    def test_query_pages_by_id(self, mock_get_db_cursor):
+        cursor = mock_get_db_cursor.return_value.__enter__.return_value
+        cursor.fetchall.return_value = [{'id': 9}, {'id': 7}, {'id': 4}]
+
+        result = audit.query(event='order.', user_id=2, before_id=10, limit=2)
+
+        self.assertEqual(result, {'rows': [{'id': 9}, {'id': 7}], 'next_before_id': 7})
+        sql, params = cursor.execute.call_args[0]
+        self.assertIn("event LIKE %s", sql)
+        self.assertIn("ORDER BY id DESC", sql)
+        self.assertEqual(params, ('order.%', 2, 10, 3))
+
+        audit.query(event='a\\b%c_d.')
+        self.assertEqual(cursor.execute.call_args[0][1], ('a\\\\b\\%c\\_d.%', 101))
+
+class TestSalesExport(unittest.TestCase):
+
+    def test_build_order_filters(self):
+        sql, params = services.build_order_filters(
+            date_from=datetime.date(2024, 1, 1), date_to=datetime.date(2024, 1, 31), status='paid'
+        )
+        self.assertEqual(sql, "WHERE o.created_at >= %s AND o.created_at < %s AND o.status = %s")
+        self.assertEqual(params, [datetime.date(2024, 1, 1), datetime.date(2024, 2, 1), 'paid'])
+        self.assertEqual(services.build_order_filters(), ("", []))
+
+    @patch('auth.get_db_cursor')
+    @patch('services.iter_sales_export')
+    def test_csv_export_streams_rows(self, mock_iter, mock_auth_cursor):
+        import app as app_module
+        mock_auth_cursor.return_value.__enter__.return_value.fetchone.return_value = {
+            'id': 1, 'username': 'admin', 'role': 'admin'
+        }
+        mock_iter.return_value = iter([
+            {'id': i, 'transaction_code': f'TRX-20240101-{i:04d}', 'created_at': datetime.datetime(2024, 1, 1),
+             'total_amount': Decimal(11000), 'tax_amount': Decimal(1000), 'discount_amount': Decimal(0),
+             'payment_method': 'cash', 'status': 'paid'}
+            for i in range(1, 1201)
+        ])
+
+        client = app_module.app.test_client()
+        with client.session_transaction() as sess:
+            sess['user_id'] = 1
+        res = client.get('/admin/sales/export?format=csv&status=paid&date_from=2024-01-01')
+
+        self.assertEqual(res.status_code, 200)
+        self.assertTrue(res.is_streamed)
+        lines = res.get_data(as_text=True).splitlines()
+        self.assertEqual(lines[0], 'ID,Transaction Code,Date,Total,Tax,Discount,Payment,Status')
+        self.assertEqual(len(lines), 1201)
+        filters = mock_iter.call_args[0][0]
+        self.assertEqual(filters['status'], 'paid')
+        self.assertEqual(filters['date_from'], datetime.date(2024, 1, 1))
+
+class TestListOrders(unittest.TestCase):
+
+    def make_orders(self, count):
+        return [
+            {'id': i, 'transaction_code': f'TRX-20240101-{i:04d}', 'created_at': datetime.datetime(2024, 1, 1, 12, 0, i),
+             'total_amount': Decimal(11000), 'tax_amount': Decimal(1000), 'discount_amount': Decimal(0),
+             'payment_method': 'cash', 'status': 'paid'}
+            for i in range(count, 0, -1)
+        ]
+
+    @patch('services.get_db_cursor')
+    def test_keyset_page(self, mock_get_db_cursor):
+        cursor = mock_get_db_cursor.return_value.__enter__.return_value
+        cursor.fetchall.return_value = self.make_orders(3)
+
+        page = services.list_orders({'code_prefix': 'TRX-2024_'}, cursor='2024-01-02T00:00:00_9', limit=2)
+
+        self.assertEqual([o['id'] for o in page['orders']], [3, 2])
+        self.assertEqual(page['next_cursor'], '2024-01-01T12:00:02_2')
+        sql, params = cursor.execute.call_args[0]
+        self.assertIn("(o.created_at, o.id) < (%s, %s)", sql)
+        self.assertIn("LIMIT %s", sql)
+        self.assertEqual(params, ('TRX-2024\\_%', datetime.datetime(2024, 1, 2), 9, 3))
+
+    @patch('services.get_db_cursor')
+    def test_last_page_has_no_cursor(self, mock_get_db_cursor):
+        cursor = mock_get_db_cursor.return_value.__enter__.return_value
+        cursor.fetchall.return_value = self.make_orders(1)
+        self.assertIsNone(services.list_orders(limit=2)['next_cursor'])
+
+    def test_invalid_cursor(self):
+        with self.assertRaises(ValueError):
+            services.decode_order_cursor('garbage')
+
+    @patch('auth.get_db_cursor')
+    @patch('services.list_orders')
+    def test_sales_page_renders(self, mock_list_orders, mock_auth_cursor):
+        import app as app_module
+        mock_auth_cursor.return_value.__enter__.return_value.fetchone.return_value = {
+            'id': 1, 'username': 'admin', 'role': 'admin'
+        }
+        mock_list_orders.return_value = {'orders': self.make_orders(2), 'next_cursor': 'abc_1'}
+
+        client = app_module.app.test_client()
+        with client.session_transaction() as sess:
+            sess['user_id'] = 1
+
+        res = client.get('/admin/sales?status=paid')
+        self.assertEqual(res.status_code, 200)
+        self.assertIn(b'TRX-20240101-0002', res.data)
+
+        res = client.get('/admin/sales/data?cursor=abc_1&limit=1000')
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(res.get_json()['next_cursor'], 'abc_1')
+        self.assertEqual(mock_list_orders.call_args[1], {'cursor': 'abc_1', 'limit': 200})
+
+class TestUserCache(unittest.TestCase):
+
+    def test_lru_and_ttl(self):
+        cache = auth.UserCache(maxsize=2, ttl=60)
+        cache.set(1, {'id': 1})
+        cache.set(2, {'id': 2})
+        cache.get(1)
+        cache.set(3, {'id': 3})
+        self.assertIsNone(cache.get(2))
+        self.assertEqual(cache.get(1), {'id': 1})
+
+        cache.invalidate(1)
+        self.assertIsNone(cache.get(1))
+
+        expired = auth.UserCache(ttl=0.001)
+        expired.set(1, {'id': 1})
+        time.sleep(0.01)
+        self.assertIsNone(expired.get(1))
+
+    @patch('auth.get_db_cursor')
+    def test_identity_lookup_hits_db_once(self, mock_get_db_cursor):
+        import app as app_module
+        cursor = mock_get_db_cursor.return_value.__enter__.return_value
+        cursor.fetchone.return_value = {'id': 42, 'username': 'cashier', 'role': 'cashier'}
+        auth.invalidate_user(42)
+
+        for _ in range(3):
+            with app_module.app.test_request_context():
+                flask.session['user_id'] = 42
+                auth.load_logged_in_user()
+                self.assertEqual(flask.g.user['username'], 'cashier')
+        self.assertEqual(cursor.execute.call_count, 1)
+
+        auth.invalidate_user(42)
+        with app_module.app.test_request_context():
+            flask.session['user_id'] = 42
+            auth.load_logged_in_user()
+        self.assertEqual(cursor.execute.call_count, 2)
+
+class TestIdempotentOrders(unittest.TestCase):
+
+    def setUp(self):
+        patcher = patch('services.ensure_order_partitions')
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    @patch('services._create_order')
+    @patch('services.get_db_cursor')
+    def test_retry_returns_original_order(self, mock_get_db_cursor, mock_create):
+        cursor = mock_get_db_cursor.return_value.__enter__.return_value
+        cursor.fetchone.return_value = {'id': 5, 'transaction_code': 'TRX-20240101-0005', 'total_amount': Decimal(11000)}
+
+        result = services.create_order([{'id': 1, 'quantity': 1}], 'cash', 'key-1')
+
+        self.assertEqual(result['order_id'], 5)
+        self.assertTrue(result['duplicate'])
+        mock_create.assert_not_called()
+
+    @patch('services._create_order')
+    @patch('services.get_db_cursor')
+    def test_batch_isolates_failures_and_dedupes(self, mock_get_db_cursor, mock_create):
+        cursor = mock_get_db_cursor.return_value.__enter__.return_value
+        cursor.fetchall.return_value = [
+            {'id': 1, 'transaction_code': 'TRX-20240101-0001', 'total_amount': Decimal(100), 'idempotency_key': 'old'}
+        ]
+
+        def create(cur, items, payment_method, key, discount=None, cashier_id=None, max_discount_percent=None):
+            if key == 'bad':
+                raise ValueError('Insufficient stock for Latte. Available: 0')
+            if key == 'huge':
+                raise psycopg2.errors.NumericValueOutOfRange()
+            return {'order_id': 2, 'transaction_code': 'TRX-20240101-0002', 'total': 200}
+
+        mock_create.side_effect = create
+
+        results = services.create_orders_batch([
+            {'idempotency_key': 'old', 'items': [], 'payment_method': 'cash'},
+            {'idempotency_key': 'new', 'items': [{'id': 1, 'quantity': 1}], 'payment_method': 'cash'},
+            {'idempotency_key': 'bad', 'items': [{'id': 2, 'quantity': 9}], 'payment_method': 'qris'},
+            {'idempotency_key': 'new', 'items': [{'id': 1, 'quantity': 1}], 'payment_method': 'cash'},
+            {'idempotency_key': 'huge', 'items': [{'id': 3, 'quantity': 1}], 'payment_method': 'cash'},
+        ])
+
+        self.assertEqual([r['status'] for r in results], ['duplicate', 'success', 'error', 'duplicate', 'error'])
+        self.assertEqual(mock_create.call_count, 3)
+        statements = [c[0][0] for c in cursor.execute.call_args_list]
+        self.assertIn("ROLLBACK TO SAVEPOINT queued_order", statements)
+        self.assertEqual(statements.count("RELEASE SAVEPOINT queued_order"), 1)
+
+class TestMetrics(unittest.TestCase):
+
+    def test_fingerprint_groups_by_shape(self):
+        small = metrics.fingerprint(b"INSERT INTO order_items VALUES (1,'a',2),(3,'b',4)")
+        large = metrics.fingerprint(b"INSERT INTO order_items VALUES (5,'c',6),(7,'d',8),(9,'e',10)")
+        self.assertEqual(small, large)
+        self.assertEqual(metrics.fingerprint("SELECT *\n  FROM orders WHERE id = 42"), "SELECT * FROM orders WHERE id = ?")
+
+    @patch('auth.get_db_cursor')
+    def test_request_metrics_and_server_timing(self, mock_auth_cursor):
+        import app as app_module
+        mock_auth_cursor.return_value.__enter__.return_value.fetchone.return_value = None
+        listener = metrics.Instrumentation()
+
+        @contextmanager
+        def fake_cursor(*args, **kwargs):
+            # Stand-in for two real statements reported by the cursor
+            listener.on_query("SELECT version FROM catalog_state", 0.002)
+            listener.on_query("SELECT * FROM products WHERE version > 3", 0.003)
+            yield MagicMock()
+
+        client = app_module.app.test_client()
+        with patch('metrics.SERVER_TIMING', True), patch('services.get_db_cursor', fake_cursor):
+            res = client.get('/auth/login')
+            self.assertIn('db;dur=0.00;desc="0 queries"', res.headers['Server-Timing'])
+
+            with client.session_transaction() as sess:
+                sess['user_id'] = 77
+            auth.user_cache.set(77, {'id': 77, 'username': 'cashier', 'role': 'cashier'})
+            res = client.get('/api/products?since=3')
+            self.assertIn('desc="2 queries"', res.headers['Server-Timing'])
+
+        text = metrics.render()
+        self.assertIn('pos_http_request_duration_seconds_count{endpoint="api_products",method="GET",status="200"}', text)
+        self.assertIn('pos_db_query_duration_seconds_bucket{query="SELECT * FROM products WHERE version > ?",le="0.005"}', text)
+
+        res = client.get('/metrics', environ_base={'REMOTE_ADDR': '10.0.0.9'})
+        self.assertEqual(res.status_code, 403)
+        res = client.get('/metrics')
+        self.assertEqual(res.status_code, 200)
+        # Relayed by a reverse proxy on the same host, or local access turned off
+        res = client.get('/metrics', headers={'X-Forwarded-For': '203.0.113.5'})
+        self.assertEqual(res.status_code, 403)
+        with patch('metrics.METRICS_LOCAL', False):
+            self.assertEqual(client.get('/metrics').status_code, 403)
+        with patch('metrics.METRICS_TOKEN', 'secret'):
+            res = client.get('/metrics', headers={'Authorization': 'Bearer secret', 'X-Forwarded-For': '203.0.113.5'})
+            self.assertEqual(res.status_code, 200)
+
+    def test_failed_requests_are_counted(self):
+        app = flask.Flask('metrics_test')
+        app.testing = True  # the exception propagates, so after_request hooks are skipped
+        app.before_request(metrics._before_request)
+        app.after_request(metrics._after_request)
+        app.teardown_request(metrics._teardown_request)
+
+        @app.route('/boom')
+        def boom():
+            raise RuntimeError("boom")
+
+        with self.assertRaises(RuntimeError):
+            app.test_client().get('/boom')
+        self.assertIn('pos_http_request_duration_seconds_count{endpoint="boom",method="GET",status="500"} 1',
+                      metrics.render())
+
+class TestStartup(unittest.TestCase):
+
+    @patch('auth.get_db_cursor')
+    def test_healthz_needs_no_database(self, mock_auth_cursor):
+        import app as app_module
+        res = app_module.app.test_client().get('/healthz')
+        self.assertEqual((res.status_code, res.data), (200, b'ok'))
+        mock_auth_cursor.assert_not_called()
+
+    @patch('services.ensure_order_partitions')
+    @patch('services.get_catalog')
+    @patch('db.get_pool')
+    def test_warm_up_opens_pools_and_loads_catalog(self, mock_get_pool, mock_get_catalog, mock_partitions):
+        import serve
+        serve.warm_up()
+        self.assertEqual([c[0][0] for c in mock_get_pool.call_args_list], list(db.TARGETS))
+        mock_get_catalog.assert_called_once_with()
+        mock_partitions.assert_called_once_with()
+
+        # A database that is down is left for the first request to report
+        mock_get_catalog.side_effect = psycopg2.OperationalError('down')
+        with self.assertLogs('pos.serve', 'WARNING'):
+            serve.warm_up()
+
+class FakeConnection:
+    def __init__(self):
+        self.closed = 0
+        self.rollbacks = 0
+        self.readonly = None
+
+    def cursor(self, name=None, cursor_factory=None):
+        return MagicMock()
+
+    def commit(self):
+        pass
+
+    def rollback(self):
+        self.rollbacks += 1
+
+    def close(self):
+        self.closed = 1
+
+    def get_transaction_status(self):
+        return psycopg2.extensions.TRANSACTION_STATUS_IDLE
+
+class TestConnectionPool(unittest.TestCase):
+
+    def make_pool(self, **kwargs):
+        self.connections = []
+
+        def connect(**conn_kwargs):
+            conn = FakeConnection()
+            self.connections.append(conn)
+            return conn
+
+        kwargs.setdefault('check_idle', None)
+        return db.ConnectionPool(connect=connect, **kwargs)
+
+    def test_reuses_connections(self):
+        pool = self.make_pool(minconn=1, maxconn=2)
+        conn = pool.getconn()
+        pool.putconn(conn)
+        self.assertIs(pool.getconn(), conn)
+        self.assertEqual(len(self.connections), 1)
+        self.assertEqual(pool.stats()['checkouts'], 2)
+
+    def test_times_out_when_exhausted(self):
+        pool = self.make_pool(minconn=0, maxconn=1, timeout=0.05)
+        pool.getconn()
+        with self.assertRaises(db.PoolTimeout):
+            pool.getconn()
+        stats = pool.stats()
+        self.assertEqual(stats['waits'], 1)
+        self.assertEqual(stats['timeouts'], 1)
+
+    def test_replaces_expired_and_closed_connections(self):
+        pool = self.make_pool(minconn=0, maxconn=1, max_age=0.01)
+        conn = pool.getconn()
+        pool.putconn(conn)
+        conn.closed = 1
+        fresh = pool.getconn()
+        self.assertIsNot(fresh, conn)
+        self.assertEqual(pool.stats()['size'], 1)
+
+    def test_get_db_cursor_returns_connection_to_pool(self):
+        pool = self.make_pool(minconn=0, maxconn=1)
+        with patch('db.get_pool', return_value=pool):
+            with self.assertRaises(RuntimeError):
+                with db.get_db_cursor():
+                    raise RuntimeError("boom")
+            with db.get_db_cursor():
+                pass
+        self.assertEqual(len(self.connections), 1)
+        self.assertEqual(pool.stats()['idle'], 1)
+
+    def test_reset_after_fork_leaves_inherited_connections_open(self):
+        pool = self.make_pool(minconn=1, maxconn=1)
+        with patch('db._pools', {'primary': pool}):
+            db.reset_pool_after_fork()
+            self.assertEqual(db._pools, {})
+        self.assertEqual(self.connections[0].closed, 0)
+
+class TestReadRouting(unittest.TestCase):
+
+    def setUp(self):
+        self.pools = {}
+        for target in ('primary', 'replica'):
+            pool = MagicMock()
+            pool.getconn.return_value = FakeConnection()
+            self.pools[target] = pool
+        targets = {'primary': (db.DB_CONFIG, db.POOL_CONFIG), 'replica': (db.REPLICA_CONFIG, db.POOL_CONFIG)}
+        self.replica_lag = patch('db.replica_lag', return_value=0.5)
+        for patcher in (patch('db.TARGETS', targets),
+                        patch('db.get_pool', side_effect=lambda target='primary': self.pools[target]),
+                        patch('db._replica_state', {'lag': None, 'checked': 0.0, 'down_until': 0.0}),
+                        self.replica_lag):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        db.set_last_write(None)
+        self.addCleanup(db.set_last_write, None)
+
+    def used(self, **kwargs):
+        with db.get_db_cursor(**kwargs):
+            pass
+        return next(t for t, pool in self.pools.items() if pool.putconn.called)
+
+    def test_readonly_transactions_go_to_a_current_replica(self):
+        conn = self.pools['replica'].getconn.return_value
+        with db.get_db_cursor(readonly=True):
+            self.assertTrue(conn.readonly)
+        self.assertIsNone(conn.readonly)  # reset before the pool reuses it
+        self.pools['replica'].putconn.assert_called_once_with(conn, discard=False)
+
+        with db.get_db_cursor(commit=True):
+            pass
+        self.pools['primary'].putconn.assert_called_once()
+
+    def test_lagging_or_unreachable_replica_falls_back_to_primary(self):
+        with patch('db.replica_lag', return_value=db.REPLICA_MAX_LAG + 1):
+            self.assertEqual(self.used(readonly=True), 'primary')
+
+        self.pools['replica'].getconn.side_effect = psycopg2.OperationalError("down")
+        self.assertEqual(self.used(readonly=True), 'primary')
+        self.assertGreater(db._replica_state['down_until'], time.monotonic())
+
+    def test_reads_stay_on_primary_after_own_write(self):
+        with db.get_db_cursor(commit=True):
+            pass
+        self.assertIsNotNone(db.last_write())
+        self.pools['primary'].reset_mock()
+        self.assertEqual(self.used(readonly=True), 'primary')
+
+        db.set_last_write(time.time() - db.REPLICA_MAX_LAG - 1)
+        self.assertEqual(db.read_target(), 'replica')
+
+    def test_lag_needs_a_streaming_receiver(self):
+        conn = self.pools['replica'].getconn.return_value
+        cursor = MagicMock()
+        cursor.fetchone.return_value = (12.5,)
+        conn.cursor = MagicMock(return_value=MagicMock(__enter__=MagicMock(return_value=cursor)))
+        self.replica_lag.stop()
+
+        self.assertEqual(db.replica_lag(), 12.5)
+        sql = cursor.execute.call_args[0][0]
+        self.assertIn("status = 'streaming'", sql)
+        self.assertIn("pg_last_xact_replay_timestamp()", sql)
+        self.pools['replica'].putconn.assert_called_once_with(conn, discard=False)
+
+    def test_named_cursor_closes_before_the_transaction_ends(self):
+        conn = self.pools['primary'].getconn.return_value
+        cursor = MagicMock(closed=False)
+
+        def close():
+            # Like psycopg2: the portal is gone once the transaction has ended
+            if conn.rollbacks:
+                raise psycopg2.ProgrammingError("named cursor isn't valid anymore")
+        cursor.close.side_effect = close
+        conn.cursor = MagicMock(return_value=cursor)
+
+        with db.get_db_cursor(name='sales_export'):
+            pass
+
+        cursor.close.assert_called_once()
+        self.pools['primary'].putconn.assert_called_once_with(conn, discard=False)
+
+    def test_readonly_cannot_commit(self):
+        with self.assertRaises(ValueError):
+            with db.get_db_cursor(commit=True, readonly=True):
+                pass
+
 if __name__ == '__main__':
     unittest.main()